@@ -1,9 +1,7 @@
 import streamlit as st
-import io
-import contextlib
 import time
-from implant_market_model import ImplantMarketModel
-import pandas as pd
+from simulation_worker import SimulationWorker, RunResults
+from result_cache import ResultCache
 import plotly.express as px
 import matplotlib.pyplot as plt
 
@@ -42,32 +40,82 @@ with st.sidebar:
     additive_adoption_preference = st.sidebar.slider('Additive Adoption Preference (0.50 means no preference for either manufacturer)', min_value=0.0, max_value=1.0, value=0.5)
     ae_probability_additive = st.sidebar.slider('Adverse Events Probability (silicon nitride)', min_value=0.0, max_value=1.0, value=0.3)
     ae_probability_subtractive = st.sidebar.slider('Adverse Events Probability (titanium)', min_value=0.0, max_value=1.0, value=0.3)
+    seed = st.sidebar.number_input('Random Seed', min_value=0, value=0)
+    use_cache = st.sidebar.checkbox('Reuse cached results for the same parameters and seed', value=True)
+    st.header('Display')
+    refresh_steps = st.sidebar.number_input('Refresh every k steps', min_value=1, value=5)
+    refresh_ms = st.sidebar.number_input('Refresh at most every N ms', min_value=0, value=250)
     run_button = st.button('Run Model')
+    stop_button = st.button('Stop')
 
 # col1, col2 = st.columns(2)
 col5, col6 = st.columns(2)
 
+manufacturer_id_mapping = {
+    0: 'additive',
+    1: 'subtractive'
+}
+
 if run_button:
-    # Create and run the model
-    model = ImplantMarketModel(num_providers, initial_num_patients, patient_incidence, 
-                               additive_adoption_preference, ae_probability_additive, ae_probability_subtractive)
-    
+    # Create the model and run it on a background thread, the page only shows what the worker publishes
+    previous_worker = st.session_state.get('worker')
+    if previous_worker is not None:
+        previous_worker.stop()
+    # The worker builds the model from these same arguments, so the cache key always matches the run
+    model_params = {
+        'num_providers': num_providers,
+        'initial_num_patients': initial_num_patients,
+        'patient_incidence': patient_incidence,
+        'additive_adoption_preference': additive_adoption_preference,
+        'ae_probability_additive': ae_probability_additive,
+        'ae_probability_subtractive': ae_probability_subtractive,
+        'seed': seed,
+        'engine': 'agent',
+        'record_mode': 'events'
+    }
+    run_params = {**model_params, 'time_period': time_period}
+    cache = ResultCache() if use_cache else None
+    cache_key = cache.key(run_params) if cache is not None else None
+    cached_run = cache.load(cache_key) if cache is not None else None
+    if cached_run is None:
+        worker = SimulationWorker((), time_period, summary_every=refresh_steps, cache=cache, cache_key=cache_key,
+                                  run_params=run_params, **model_params)
+        worker.start()
+        st.session_state.results = RunResults(manufacturer_id_mapping)
+    else:  # Show the stored run without simulating it again
+        worker = None
+        st.session_state.results = RunResults.from_cached(cached_run, manufacturer_id_mapping)
+    st.session_state.worker = worker
+    st.session_state.time_period = time_period
+
+if stop_button and st.session_state.get('worker') is not None:
+    st.session_state.worker.stop()  # The run ends after its current step and the results so far stay on the page
+
+if st.session_state.get('results') is not None:
+    worker = st.session_state.worker
+    results = st.session_state.results
+
     # Create placeholders for each element
+    status_placeholder = st.empty()
     output_placeholder = st.empty()
     result_placeholder = st.empty()
     divider_placehoder = st.empty()
-    
+    result_placeholder.subheader('Results')
+    divider_placehoder.divider()
+
     col1, col2 = st.columns(2)
     with col1:
-        chart_title_placeholder = st.empty()
+        st.write('Revenue by Manufacturer')
         chart_placeholder = st.empty()
     with col2:
-        chart_title_placeholder2 = st.empty()
+        st.write('Profit by Manufacturer')
         chart_placeholder2 = st.empty()
-    
+
     fighead_placeholder = st.empty()
     chart_placeholder3 = st.empty()
-    
+    st.write('Average Patient Utility by Manufacturer')
+    chart_placeholder4 = st.empty()
+
     col3, col4 = st.columns(2)
     with col3:
         fighead_placeholder2 = st.empty()
@@ -76,90 +124,45 @@ if run_button:
         fighead_placeholder3 = st.empty()
         table_placeholder3 = st.empty()
 
-    for i in range(time_period):  # Run for x steps
-        
-        output_buffer = io.StringIO()
-        with contextlib.redirect_stdout(output_buffer):
-            model.step()  # Run the steps outlined in implantmarketmodel
-        output_placeholder.code(output_buffer.getvalue())
-        time.sleep(0.2)
-
-        manufacturer_id_mapping = {
-            0: 'additive',
-            1: 'subtractive'
-        }
-
-        manufacturer_data = pd.DataFrame(model.manufacturer_rows)
-        manufacturer_data['manufacturer_id'] = manufacturer_data['manufacturer_id'].map(manufacturer_id_mapping)
-        # Filter data for additive and subtractive processes
-        additive_data = manufacturer_data[manufacturer_data['manufacturer_id'] == 'additive']
-        subtractive_data = manufacturer_data[manufacturer_data['manufacturer_id'] == 'subtractive']
-
-        provider_data = pd.DataFrame(model.provider_rows)
-        patient_data = pd.DataFrame(model.patient_rows)
-        patient_data['manufacturer_id'] = patient_data['manufacturer_id'].map(manufacturer_id_mapping)
-
-        # Display data in Streamlit
-        result_placeholder.subheader('Results')
-        divider_placehoder.divider()
-        
-        # Printout model summaries
-        manufacturer_summary = manufacturer_data.groupby('manufacturer_id').agg({
-            'revenue': 'sum',
-            'costs': 'sum',
-            'profit': 'sum'  ,
-            'inventory': 'sum'
-        })
-
-        # Add summary for patient_data grouped by health_state and manufacturer_id
-        # Filter for the last step
-        final_step = patient_data['step'].max()
-        final_step_data = patient_data[patient_data['step'] == final_step]
-        patient_health_summary = final_step_data.groupby(['manufacturer_id', 'health_status']).size().reset_index(
-            name='counts')
-
-        # Pivot the patient_health_summary DataFrame
-        patient_health_summary_pivot = patient_health_summary.pivot(index='manufacturer_id', columns='health_status',
-                                                                    values='counts')
+    revenue_chart = None
+    profit_chart = None
+    utility_chart = None
+    drawn_steps = 0  # Steps already in the line charts
+
+    def refresh():
+        global revenue_chart, profit_chart, utility_chart, drawn_steps
+        status_placeholder.write(f"Step {results.steps} of {st.session_state.time_period}" +
+                                 (" (done)" if results.done else " (running)"))
+        if results.error is not None:
+            status_placeholder.error(f"The simulation stopped with an error: {results.error}")
+        output_placeholder.code(results.log)
+        if results.steps == drawn_steps:
+            return
+
+        # Display the manufacturer charts, appending only the steps not drawn yet
+        if revenue_chart is None:
+            revenue_chart = chart_placeholder.line_chart(results.revenue_frame())
+            profit_chart = chart_placeholder2.line_chart(results.profit_frame())
+        else:
+            revenue_chart.add_rows(results.revenue_frame(drawn_steps))
+            profit_chart.add_rows(results.profit_frame(drawn_steps))
+        if results.utility:  # Average utility of each manufacturer's patients at every step, see RunMetrics
+            if utility_chart is None:
+                utility_chart = chart_placeholder4.line_chart(results.utility_frame())
+            else:
+                utility_chart.add_rows(results.utility_frame(drawn_steps))
+        drawn_steps = results.steps
+
+        # Display the costs table
+        fighead_placeholder2.write("Manufacturer Summary:")
+        table_placeholder2.write(results.manufacturer_summary())
 
-        # Add utility values TODO summarize utilities for every step of patient history instead of just last
-        utility_values = {
-            'minimal': 0.84,
-            'moderate': 0.61,
-            'severe': 0.55,
-            'crippled': 0.51,
-            'bedbound': 0.5
-        }
-
-        # Map health_status to utility values and multiply by counts
-        patient_health_summary['total_utility'] = patient_health_summary['health_status'].map(utility_values) * \
-                                                patient_health_summary['counts']
-
-        # Calculate total utility for each manufacturer
-        manufacturer_total_utility = patient_health_summary.groupby('manufacturer_id')['total_utility'].sum()
-        # print(manufacturer_total_utility)
-
-        # Calculate total number of patients for each manufacturer
-        manufacturer_patient_counts = patient_health_summary.groupby('manufacturer_id')['counts'].sum()
-        # print(manufacturer_patient_counts)
-
-        # Calculate average utility for each manufacturer
-        average_utility = manufacturer_total_utility / manufacturer_patient_counts.astype(float)
-        average_utility = average_utility.reset_index()
-        average_utility.columns = ['manufacturer_id', 'average_utility']
-
-        # Display the manufacturer charts
-        # afig = pd.melt(additive_data, id_vars=['step', 'manufacturer_id'], value_vars=['revenue', 'costs', 'profit'], var_name='metric', value_name='value')
-        # sfig = pd.melt(subtractive_data, id_vars=['step', 'manufacturer_id'], value_vars=['revenue', 'costs', 'profit'], var_name='metric', value_name='value')
-        chart_title_placeholder.write('Revenue by Manufacturer')
-        # chart_placeholder.line_chart(afig.pivot(index='step', columns='metric', values='value'))
-        chart_placeholder.line_chart(manufacturer_data.pivot(index='step', columns='manufacturer_id', values='revenue'))
-        chart_title_placeholder2.write('Profit by Manufacturer')
-        # chart_placeholder2.line_chart(sfig.pivot(index='step', columns='metric', values='value'))
-        chart_placeholder2.line_chart(manufacturer_data.pivot(index='step', columns='manufacturer_id', values='profit'))
-        
+        if results.health_summary is None or results.health_summary.empty:
+            return
         # Display the patient health status chart
         fighead_placeholder.write('Patient Health Summary by Manufacturer')
+        patient_health_summary_pivot = results.health_summary.pivot(index='manufacturer_id', columns='health_status',
+                                                                    values='counts')
         # Desired order of columns
         columns_order = ['minimal', 'moderate', 'severe', 'crippled', 'bedbound']
         # Filter columns_order to include only columns that exist in patient_health_summary_pivot
@@ -168,27 +171,20 @@ if run_button:
         # Reorder the columns in patient_health_summary_pivot using the filtered list
         patient_health_summary_pivot = patient_health_summary_pivot[filtered_columns_order]
         fig = px.bar(patient_health_summary_pivot.reset_index(), x='manufacturer_id',
-                    y=patient_health_summary_pivot.columns, barmode='group')
+                     y=patient_health_summary_pivot.columns, barmode='group')
         # Display the grouped bar chart in Streamlit
         chart_placeholder3.plotly_chart(fig)
 
-        # Display the costs and utilities tables
-        fighead_placeholder2.write("Manufacturer Summary:")
-        table_placeholder2.write(manufacturer_summary)
+        # Display the utilities table, the last step of the utility chart
         fighead_placeholder3.write("Average Utility Summary:")
-        table_placeholder3.write(average_utility)
-
-
-        # tab3, tab4, tab5 = st.tabs(["Manufacturer Data", "Provider Data", "Patient Data"])
-        
-    # with tab3:
-            # st.header('Manufacturer Data')
-        # st.dataframe(manufacturer_data)
-
-    # with tab4:
-            # st.header('Provider Data')
-        # st.dataframe(provider_data)
-        
-    # with tab5:
-            # st.header('Patient Data')
-        # st.dataframe(patient_data)
+        table_placeholder3.write(results.average_utility())
+
+    # Redraw after every refresh_steps new steps, checking the worker at most every refresh_ms
+    new_steps = refresh_steps  # Draw what is already there straight away, e.g. after pressing Stop
+    while not results.done:
+        new_steps += results.drain(worker.updates)
+        if new_steps >= refresh_steps or results.done:
+            refresh()
+            new_steps = 0
+        time.sleep(refresh_ms / 1000)
+    refresh()
@@ -0,0 +1,241 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from implant_market_model import ImplantMarketModel
+import numpy as np
+import pandas as pd
+import json
+import math
+import os
+import statistics
+import time
+import zlib
+
+# Batch runner
+# Runs many stochastic replications of several parameter scenarios on a process pool. Every replication gets its own
+# seed, derived from the base seed, the scenario name and the replication number, so the same job always gets the same
+# seed. Replications record no patient rows (record_mode="summary"), the model keeps the summaries as it runs, see
+# RunMetrics. Workers only send back those compact summaries (manufacturer revenue/costs/profit totals and average
+# utility), which are appended to a JSON lines results file as each job finishes, one line holding all rows of a job.
+# Running the same batch again skips every job already in that file, so an interrupted batch resumes where it stopped.
+# With common_random_numbers the scenarios are paired: replication r of every scenario gets the same seed, so their
+# RandomStreams substreams are the same draw for draw. Sharing the seed alone does not keep them paired, a sequential
+# stream drifts as soon as one scenario takes an extra draw, so each patient's surgery outcome, follow-up changes and
+# adverse events are keyed by the patient's id and draw count (see RandomStreams) and stay the same in every scenario
+# until that patient's own history differs. Spawning, assignment, routing (paired order by order) and the activation
+# order are still drawn sequentially. paired_differences then
+# compares each scenario with a baseline replication by replication, with confidence intervals, and reports the
+# variance reduction: the variance the difference would have with independent seeds over its paired variance.
+
+MODEL_PARAMETERS = ["num_providers", "initial_num_patients", "patient_incidence", "additive_adoption_preference",
+                    "ae_probability_additive", "ae_probability_subtractive"]  # ImplantMarketModel positional arguments
+
+
+COMMON_SEED_NAME = "common random numbers"  # Takes the place of the scenario name in paired seeds
+
+
+def replication_seed(base_seed, scenario, replication):
+    sequence = np.random.SeedSequence([base_seed, zlib.crc32(scenario.encode()), replication])
+    return int(sequence.generate_state(1)[0])
+
+
+def make_jobs(scenarios, replications, time_period, base_seed=0, engine="agent", common_random_numbers=False):
+    # scenarios: {scenario name: {model parameter: value}}
+    return [{
+        "scenario": scenario,
+        "replication": replication,
+        "seed": replication_seed(base_seed, COMMON_SEED_NAME if common_random_numbers else scenario, replication),
+        "params": params,
+        "time_period": time_period,
+        "engine": engine
+    } for scenario, params in scenarios.items() for replication in range(replications)]
+
+
+def job_key(row):
+    return row["scenario"], row["replication"], row["seed"]
+
+
+def run_replication(job):  # Runs in a worker process, returns one summary row per manufacturer
+    params = job["params"]
+    model = ImplantMarketModel(*[params[name] for name in MODEL_PARAMETERS], engine=job["engine"],
+                               record_mode="summary", seed=job["seed"], log_level="silent")
+    start = time.perf_counter()
+    for i in range(job["time_period"]):
+        model.step()
+    elapsed = time.perf_counter() - start
+
+    totals = model.run_metrics.manufacturer_summary()
+    utility = model.run_metrics.average_utility().set_index('manufacturer_id')['average_utility']
+    rows = []
+    for manufacturer_id, manufacturer_totals in totals.iterrows():
+        rows.append({
+            "scenario": job["scenario"],
+            "replication": job["replication"],
+            "seed": job["seed"],
+            **params,
+            "time_period": job["time_period"],
+            "manufacturer_id": int(manufacturer_id),
+            "revenue": float(manufacturer_totals['revenue']),
+            "costs": float(manufacturer_totals['costs']),
+            "profit": float(manufacturer_totals['profit']),
+            "average_utility": float(utility.get(manufacturer_id, np.nan)),  # NaN when no patient chose it
+            "patients_waiting": len(model.patients_needing_surgery),  # Backlog left at the end, same for every row
+            "seconds": elapsed
+        })
+    return rows
+
+
+def load_results(results_path):  # Rows already in the results file, ignoring a line cut off by an interruption
+    rows = []
+    if os.path.exists(results_path):
+        with open(results_path) as results_file:
+            for line in results_file:
+                try:
+                    rows.extend(json.loads(line))
+                except json.JSONDecodeError:
+                    pass
+    return rows
+
+
+def run_batch(scenarios, replications, time_period, results_path, base_seed=0, workers=None, engine="agent",
+              common_random_numbers=False):
+    # Returns the merged results table, one row per replication and manufacturer
+    jobs = make_jobs(scenarios, replications, time_period, base_seed, engine, common_random_numbers)
+    rows = load_results(results_path)
+    finished = {job_key(row) for row in rows}
+    pending = [job for job in jobs if job_key(job) not in finished]
+    print(f"{len(jobs) - len(pending)} of {len(jobs)} jobs already in {results_path}, running {len(pending)}")
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor, open(results_path, "a+") as results_file:
+        results_file.seek(0, os.SEEK_END)
+        if results_file.tell() > 0:
+            results_file.seek(results_file.tell() - 1)
+            if results_file.read(1) != "\n":  # Start a new line after a line cut off by an interruption
+                results_file.write("\n")
+        futures = {executor.submit(run_replication, job): job for job in pending}
+        for done, future in enumerate(as_completed(futures), start=1):
+            job_rows = future.result()
+            # One line per job, flushed so a finished job survives an interruption
+            results_file.write(json.dumps(job_rows) + "\n")
+            results_file.flush()
+            rows.extend(job_rows)
+
+            job = futures[future]
+            elapsed = time.perf_counter() - start
+            remaining = elapsed / done * (len(pending) - done)
+            print(f"[{done}/{len(pending)}] {job['scenario']} replication {job['replication']} done, "
+                  f"{elapsed:.0f}s elapsed, about {remaining:.0f}s left", flush=True)
+
+    results = pd.DataFrame(rows)
+    keys = {job_key(job) for job in jobs}  # Leave out rows of other batches sharing the file
+    return results[[job_key(row) in keys for row in rows]].reset_index(drop=True)
+
+
+def summarize_results(results):  # Mean and standard error over replications, per scenario and manufacturer
+    return results.groupby(['scenario', 'manufacturer_id'])[['revenue', 'costs', 'profit', 'average_utility']].agg(
+        ['mean', 'sem'])
+
+
+def t_quantile(confidence, dof):  # Two-sided Student t quantile: P(|T| < t_quantile) = confidence
+    if dof < 1:
+        raise ValueError(f"A t quantile needs at least one degree of freedom, got {dof}")
+    if dof > 30:  # Cornish-Fisher expansion of the normal quantile, within 1e-4 of the exact value from here on
+        z = statistics.NormalDist().inv_cdf((1 + confidence) / 2)
+        return (z + (z ** 3 + z) / (4 * dof) + (5 * z ** 5 + 16 * z ** 3 + 3 * z) / (96 * dof ** 2) +
+                (3 * z ** 7 + 19 * z ** 5 + 17 * z ** 3 - 15 * z) / (384 * dof ** 3))
+    low, high = 0.0, 1.0
+    while t_central_probability(high, dof) < confidence:
+        high *= 2
+    for i in range(100):  # Bisection on the exact distribution function
+        middle = (low + high) / 2
+        if t_central_probability(middle, dof) < confidence:
+            low = middle
+        else:
+            high = middle
+    return (low + high) / 2
+
+
+def t_central_probability(t, dof):  # P(|T| < t) for integer dof, closed form (Abramowitz and Stegun 26.7.3-4)
+    theta = math.atan(t / math.sqrt(dof))
+    cos_squared = math.cos(theta) ** 2
+    term, total = 1.0, 1.0
+    if dof % 2 == 0:
+        for k in range(2, dof, 2):
+            term *= cos_squared * (k - 1) / k
+            total += term
+        return math.sin(theta) * total
+    if dof == 1:
+        return 2 * theta / math.pi
+    for k in range(3, dof, 2):
+        term *= cos_squared * (k - 1) / k
+        total += term
+    return 2 / math.pi * (theta + math.sin(theta) * math.cos(theta) * total)
+
+
+def paired_differences(results, baseline, metrics=('revenue', 'costs', 'profit', 'average_utility'),
+                       confidence=0.95):
+    # Scenario minus baseline, paired by replication, for every other scenario, manufacturer and metric
+    base = results[results['scenario'] == baseline].set_index(['replication', 'manufacturer_id'])
+    rows = []
+    for scenario, scenario_results in results[results['scenario'] != baseline].groupby('scenario', sort=False):
+        scenario_results = scenario_results.set_index(['replication', 'manufacturer_id'])
+        pairs = base.join(scenario_results, how='inner', lsuffix='_baseline')
+        if (pairs['seed'] != pairs['seed_baseline']).any():
+            raise ValueError(f"Replications of {scenario!r} and {baseline!r} have different seeds, "
+                             "run the batch with common_random_numbers=True to pair them")
+        for manufacturer_id, manufacturer_pairs in pairs.groupby(level='manufacturer_id'):
+            for metric in metrics:
+                values = manufacturer_pairs[[metric + '_baseline', metric]].dropna()  # NaN utility: nobody chose it
+                rows.append({"scenario": scenario, "manufacturer_id": manufacturer_id, "metric": metric,
+                             **paired_difference(values[metric + '_baseline'], values[metric], confidence)})
+    return pd.DataFrame(rows)
+
+
+def paired_difference(baseline_values, values, confidence=0.95):  # Mean of values - baseline_values, paired by position
+    differences = values.to_numpy() - baseline_values.to_numpy()
+    n = len(differences)
+    mean = differences.mean() if n else np.nan
+    half_width = t_quantile(confidence, n - 1) * differences.std(ddof=1) / np.sqrt(n) if n > 1 else np.nan
+    paired_variance = differences.var(ddof=1) if n > 1 else np.nan
+    return {
+        "pairs": n,
+        "difference": mean,
+        "ci_low": mean - half_width,
+        "ci_high": mean + half_width,
+        # Variance the difference would have with independent seeds over its paired variance, 1 means no reduction
+        "variance_reduction": (values.var() + baseline_values.var()) / paired_variance if paired_variance > 0 else np.nan
+    }
+
+
+def main():
+    # Model parameters, as in main.py
+    base_params = {
+        "num_providers": 3,
+        "initial_num_patients": 76,
+        "patient_incidence": 48,
+        "additive_adoption_preference": 0.5,
+        "ae_probability_additive": 0.3,
+        "ae_probability_subtractive": 0.3
+    }
+    time_period = 200
+    replications = 100
+    common_random_numbers = True  # Pair the scenarios' replications, see paired_differences
+
+    # Scenarios override some of the base parameters
+    scenarios = {
+        "baseline": base_params,
+        "additive_ae_0.2": {**base_params, "ae_probability_additive": 0.2},
+        "subtractive_ae_0.4": {**base_params, "ae_probability_subtractive": 0.4},
+        "additive_preference_0.7": {**base_params, "additive_adoption_preference": 0.7}
+    }
+
+    results = run_batch(scenarios, replications, time_period, "batch_results.jsonl",
+                        common_random_numbers=common_random_numbers)
+    print("\nBatch Summary (mean and standard error over replications):")
+    print(summarize_results(results))
+    if common_random_numbers:
+        print("\nDifferences from the baseline (paired replications, 95% confidence intervals):")
+        print(paired_differences(results, "baseline").to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
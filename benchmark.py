@@ -0,0 +1,222 @@
+import argparse
+import datetime
+import itertools
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# Scaling benchmark suite
+# Runs ImplantMarketModel over population, provider, incidence and horizon sizes with fixed seeds, each case in a fresh
+# Python process so its peak RSS is its own. Suites:
+#   quick  four small cases, to run before every commit
+#   axes   one parameter at a time from BASE_CASE over the whole SCALING_AXES range, so each axis scales on its own
+#          and interactions between axes are not measured
+#   grid   every combination of GRID_AXES, which measures interactions such as providers x incidence on a
+#          smaller range
+# For every case it records wall time, steps per second, peak RSS and the size of the recorded output, and saves the
+# results as JSON. With --repeat each case runs several times and the fastest run is kept, which makes the comparison
+# less sensitive to a busy machine. The compare command checks a results file against a saved baseline and flags every
+# case that got slower (or used more memory) than the threshold allows, exiting with status 1 if any did.
+#
+#   python benchmark.py run --suite quick --repeat 3 --output bench.json
+#   python benchmark.py run --suite grid --engine cohort --output grid.json
+#   python benchmark.py compare baseline.json bench.json --threshold 0.10
+
+BASE_CASE = {"num_providers": 3, "initial_num_patients": 1_000, "patient_incidence": 48, "steps": 200}
+SCALING_AXES = {  # The "axes" suite varies one parameter at a time from BASE_CASE
+    "initial_num_patients": [1_000, 10_000, 100_000, 1_000_000],
+    "num_providers": [3, 30, 300, 1_000],
+    "patient_incidence": [48, 480, 4_800],
+    "steps": [200, 1_000, 3_650]
+}
+GRID_AXES = {  # The "grid" suite runs every combination, the other parameters as in BASE_CASE
+    "initial_num_patients": [1_000, 100_000],
+    "num_providers": [3, 30, 300],
+    "patient_incidence": [48, 480, 4_800]
+}
+MODEL_DEFAULTS = {"additive_adoption_preference": 0.5, "ae_probability_additive": 0.3,
+                  "ae_probability_subtractive": 0.3}
+ENGINES = ["agent", "cohort"]
+SUITES = ["quick", "axes", "grid"]
+SEED = 12345
+
+
+def make_cases(suite, engines=ENGINES):
+    if suite == "quick":  # Small enough to run before every commit
+        grid = [BASE_CASE, {**BASE_CASE, "initial_num_patients": 10_000}, {**BASE_CASE, "num_providers": 300},
+                {**BASE_CASE, "steps": 1_000}]
+    elif suite == "axes":
+        grid = [BASE_CASE] + [{**BASE_CASE, axis: value} for axis, values in SCALING_AXES.items()
+                              for value in values if value != BASE_CASE[axis]]
+    else:
+        grid = [{**BASE_CASE, **dict(zip(GRID_AXES, values))} for values in itertools.product(*GRID_AXES.values())]
+    cases = []
+    for engine in engines:
+        for params in grid:
+            name = (f"{engine}-patients{params['initial_num_patients']}-providers{params['num_providers']}"
+                    f"-incidence{params['patient_incidence']}-steps{params['steps']}")
+            cases.append({"name": name, "engine": engine, "seed": SEED, **MODEL_DEFAULTS, **params})
+    return cases
+
+
+# Running ---------------------------------------------------------------------------------------------
+def peak_rss_mb():  # Peak resident set size of this process, None where the resource module is missing (Windows)
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10  # Bytes on macOS, kilobytes on Linux
+
+
+def run_case(case):  # Runs inside the case's own process
+    from implant_market_model import ImplantMarketModel
+    from data_recorder import DataRecorder
+
+    output_dir = tempfile.mkdtemp(prefix="implant_benchmark_")
+    try:
+        recorder = DataRecorder(output_dir)
+        start = time.perf_counter()
+        model = ImplantMarketModel(case["num_providers"], case["initial_num_patients"], case["patient_incidence"],
+                                   case["additive_adoption_preference"], case["ae_probability_additive"],
+                                   case["ae_probability_subtractive"], engine=case["engine"], recorder=recorder,
+                                   record_mode="events", seed=case["seed"], log_level="silent")
+        setup_seconds = time.perf_counter() - start
+        for i in range(case["steps"]):
+            model.step()
+        recorder.close()
+        wall_seconds = time.perf_counter() - start
+        return {
+            **case,
+            "wall_seconds": wall_seconds,
+            "setup_seconds": setup_seconds,
+            "steps_per_second": case["steps"] / (wall_seconds - setup_seconds),
+            "peak_rss_mb": peak_rss_mb(),
+            "output_bytes": recorder.bytes_written(),
+            "patients": model.patient_count()
+        }
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+
+def run_case_process(case, timeout=None):  # Result of one run of the case in a fresh process
+    try:
+        completed = subprocess.run([sys.executable, os.path.abspath(__file__), "case", json.dumps(case)],
+                                   capture_output=True, text=True, timeout=timeout,
+                                   cwd=os.path.dirname(os.path.abspath(__file__)))
+    except subprocess.TimeoutExpired:
+        return {**case, "error": f"timed out after {timeout}s"}
+    if completed.returncode != 0:
+        return {**case, "error": (completed.stderr.strip().splitlines() or ["failed"])[-1]}
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def run_suite(cases, timeout=None, repeat=1):
+    results = []
+    for number, case in enumerate(cases, start=1):
+        print(f"[{number}/{len(cases)}] {case['name']}", end=" ", flush=True)
+        runs = []
+        for i in range(repeat):
+            runs.append(run_case_process(case, timeout))
+            if "error" in runs[-1]:
+                break
+        if "error" in runs[-1]:
+            print(runs[-1]["error"])
+            results.append(runs[-1])
+            continue
+        result = min(runs, key=lambda run: run["wall_seconds"])  # Fastest run, the least disturbed by other load
+        result["all_wall_seconds"] = [run["wall_seconds"] for run in runs]
+        result["peak_rss_mb"] = max((run["peak_rss_mb"] for run in runs if run["peak_rss_mb"] is not None),
+                                    default=None)
+        rss = "n/a" if result["peak_rss_mb"] is None else f"{result['peak_rss_mb']:.1f} MB"
+        print(f"{result['wall_seconds']:.2f}s, {result['steps_per_second']:.1f} steps/s, peak RSS {rss}, "
+              f"output {result['output_bytes'] / 2 ** 20:.2f} MB")
+        results.append(result)
+    return results
+
+
+def metadata():
+    import numpy
+    import pandas
+    return {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "pandas": pandas.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "commit": git_commit()
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+# Comparing -------------------------------------------------------------------------------------------
+def compare(baseline, current, threshold=0.10):  # Returns one line per shared case and the number of regressions
+    baseline_cases = {result["name"]: result for result in baseline["results"] if "error" not in result}
+    lines = []
+    regressions = 0
+    for result in current["results"]:
+        before = baseline_cases.get(result["name"])
+        if before is None or "error" in result:
+            continue
+        time_ratio = result["wall_seconds"] / before["wall_seconds"]
+        flags = []
+        if time_ratio > 1 + threshold:
+            flags.append("SLOWER")
+        if result["peak_rss_mb"] and before["peak_rss_mb"] and \
+                result["peak_rss_mb"] / before["peak_rss_mb"] > 1 + threshold:
+            flags.append("MORE MEMORY")
+        regressions += bool(flags)
+        lines.append(f"{result['name']}: {before['wall_seconds']:.2f}s -> {result['wall_seconds']:.2f}s "
+                     f"({time_ratio:.2f}x){' ' + ' '.join(flags) if flags else ''}")
+    return lines, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scaling benchmarks for ImplantMarketModel")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="run a benchmark suite and save the results as JSON")
+    run_parser.add_argument("--suite", choices=SUITES, default="quick")
+    run_parser.add_argument("--engine", choices=ENGINES, action="append", help="engines to run (default both)")
+    run_parser.add_argument("--filter", default="", help="only run cases whose name contains this text")
+    run_parser.add_argument("--timeout", type=float, help="seconds allowed per case")
+    run_parser.add_argument("--repeat", type=int, default=1, help="runs per case, the fastest is kept")
+    run_parser.add_argument("--output", default="benchmark_results.json")
+    compare_parser = commands.add_parser("compare", help="flag regressions against a saved baseline")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.10, help="allowed slowdown, 0.10 is 10%%")
+    case_parser = commands.add_parser("case", help=argparse.SUPPRESS)  # Used by run for each case process
+    case_parser.add_argument("case")
+    args = parser.parse_args()
+
+    if args.command == "case":
+        print(json.dumps(run_case(json.loads(args.case))))
+    elif args.command == "run":
+        cases = [case for case in make_cases(args.suite, args.engine or ENGINES) if args.filter in case["name"]]
+        results = run_suite(cases, args.timeout, args.repeat)
+        with open(args.output, "w") as output_file:
+            json.dump({"metadata": metadata(), "results": results}, output_file, indent=2)
+        print(f"Saved {len(results)} results to {args.output}")
+    else:
+        with open(args.baseline) as baseline_file, open(args.current) as current_file:
+            lines, regressions = compare(json.load(baseline_file), json.load(current_file), args.threshold)
+        print("\n".join(lines))
+        print(f"{regressions} of {len(lines)} cases regressed by more than {args.threshold:.0%}")
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
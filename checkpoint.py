@@ -0,0 +1,84 @@
+import gzip
+import pickle
+from data_recorder import DataRecorder, column_specs
+from model_log import ModelLog
+
+# Define checkpoints
+# A checkpoint is the complete state of an ImplantMarketModel after some step: the schedule and its step count, every
+# agent (patients or the cohort columns, provider queues and follow-up calendars, manufacturer production pipelines and
+# inventory), the waiting queue and the state of every random stream, plus the rows recorded so far. It is written as
+# a gzip-compressed pickle, so only load checkpoints you wrote yourself.
+# A restored model continues exactly as the original would have, draw for draw. The recorder, log stream, metrics sink
+# and profiler are not part of the checkpoint, they are passed to load_checkpoint and the saved rows are copied into
+# the new recorder, so its tables cover the whole run.
+# fork_checkpoint restores one checkpoint many times with different scenario parameters, so scenarios that share a
+# burn-in only simulate it once. The branches start from the same random state.
+#
+#   save_checkpoint(model, "burn_in.ckpt")
+#   model = load_checkpoint("burn_in.ckpt", recorder=DataRecorder("model_output"))
+#   branches = fork_checkpoint("burn_in.ckpt", [{"ae_probability_additive": 0.1}, {"ae_probability_additive": 0.5}])
+
+CHECKPOINT_VERSION = 3  # 2: the model's patients and providers' all_patients are dicts, 3: keyed draws
+SCENARIO_PARAMETERS = ["additive_adoption_preference", "ae_probability_additive", "ae_probability_subtractive",
+                       "patient_incidence"]  # Model parameters a restored model can change
+
+
+def save_checkpoint(model, path):
+    profiler = model.profiler
+    agents = model.schedule.agents if profiler is not None else []
+    for agent in agents:  # The timing wrappers cannot be pickled
+        profiler.uninstrument(agent)
+    try:
+        checkpoint = {
+            "version": CHECKPOINT_VERSION,
+            "step": model.schedule.steps,
+            "model": model,
+            "records": {name: (column_specs(table.columns), table.stored_table())
+                        for name, table in model.recorder.tables.items()}
+        }
+        with gzip.open(path, "wb", compresslevel=6) as checkpoint_file:
+            pickle.dump(checkpoint, checkpoint_file, protocol=pickle.HIGHEST_PROTOCOL)
+    finally:
+        for agent in agents:
+            profiler.instrument(agent)
+
+
+def read_checkpoint(path):  # The uncompressed checkpoint, each restore_model call unpickles its own copy
+    with gzip.open(path, "rb") as checkpoint_file:
+        return checkpoint_file.read()
+
+
+def restore_model(data, recorder=None, log_level=None, log_stream=None, metrics_sink=None, profiler=None,
+                  **scenario):
+    checkpoint = pickle.loads(data)
+    if checkpoint.get("version") != CHECKPOINT_VERSION:
+        raise ValueError(f"Unsupported checkpoint version {checkpoint.get('version')!r}, "
+                         f"expected {CHECKPOINT_VERSION}")
+    for name in scenario:
+        if name not in SCENARIO_PARAMETERS:
+            raise ValueError(f"Cannot change {name!r} on a restored model, expected one of {SCENARIO_PARAMETERS}")
+
+    model = checkpoint["model"]
+    model.recorder = DataRecorder() if recorder is None else recorder
+    for name, (columns, rows) in checkpoint["records"].items():
+        model.recorder.add_table(name, columns).restore(rows)
+    model.log = ModelLog(model.log.level if log_level is None else log_level, log_stream)
+    model.metrics_sink = metrics_sink
+    model.profiler = profiler
+    if profiler is not None:
+        profiler.attach(model)
+    for name, value in scenario.items():
+        setattr(model, name, value)
+    return model
+
+
+def load_checkpoint(path, recorder=None, log_level=None, log_stream=None, metrics_sink=None, profiler=None,
+                    **scenario):  # scenario: new values for SCENARIO_PARAMETERS
+    return restore_model(read_checkpoint(path), recorder, log_level, log_stream, metrics_sink, profiler, **scenario)
+
+
+def fork_checkpoint(path, scenarios, recorders=None, log_level=None):
+    # One restored model per scenario dict, recorders gives each branch its own recorder (in memory by default)
+    data = read_checkpoint(path)
+    recorders = recorders or [None] * len(scenarios)
+    return [restore_model(data, recorder, log_level, **scenario) for scenario, recorder in zip(scenarios, recorders)]
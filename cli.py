@@ -0,0 +1,257 @@
+import argparse
+import gzip
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from provider_assignment import ASSIGNMENT_POLICIES
+from waiting_queue import QUEUE_POLICIES
+
+# Headless command-line entry point
+# Runs ImplantMarketModel with no per-step output, for schedulers and batch scripts. Parameters come from flags, from a
+# TOML or JSON config file of the same names (flags win over the config, the config over DEFAULTS), and the run writes
+# only the tables asked for, in the chosen format and at the chosen granularity:
+#   --format       csv, csv.gz or parquet, one file per table in --output-dir
+#   --granularity  "step" writes every step, "every" the steps that are a multiple of --every (and the last step),
+#                  "final" only the last step
+#   --tables       any of manufacturer, provider, patient (patient rows are rebuilt from the event log in one pass,
+#                  one selected step at a time, see event_log.iter_cross_sections)
+# The run is recorded to a scratch Parquet DataRecorder inside --output-dir, which is removed after the export. On exit
+# it prints a summary with the runtime, peak memory, the files written and the average utility, and --summary-json also
+# saves it as JSON.
+#
+#   python cli.py --steps 3650 --seed 1 --format parquet --granularity every --every 30 --tables manufacturer provider
+#   python cli.py --config scenario.toml --output-dir runs/scenario --format csv.gz
+
+DEFAULTS = {  # Same run as main.py
+    "num_providers": 3,
+    "initial_num_patients": 76,
+    "patient_incidence": 48,
+    "additive_adoption_preference": 0.5,
+    "ae_probability_additive": 0.3,
+    "ae_probability_subtractive": 0.3,
+    "steps": 200,
+    "seed": 0,
+    "engine": "agent",
+    "assignment_policy": "random",
+    "queue_policy": "fifo",
+    "output_dir": "model_output",
+    "format": "csv",
+    "granularity": "step",
+    "every": 1,
+    "tables": ["manufacturer", "provider", "patient"],
+    "summary_json": None
+}
+MODEL_PARAMS = ["num_providers", "initial_num_patients", "patient_incidence", "additive_adoption_preference",
+                "ae_probability_additive", "ae_probability_subtractive"]  # Positional arguments of the model
+OUTPUT_FORMATS = {"csv": ".csv", "csv.gz": ".csv.gz", "parquet": ".parquet"}
+GRANULARITIES = ["step", "every", "final"]
+TABLES = ["manufacturer", "provider", "patient"]
+EXPORT_CHUNK_ROWS = 100_000  # Rebuilt patient rows are written in chunks of about this many rows
+
+
+def load_config(path):  # {name: value} from a .toml or .json file, names as in DEFAULTS
+    if path.endswith(".toml"):
+        try:
+            import tomllib
+        except ImportError:  # Python before 3.11
+            import tomli as tomllib
+        with open(path, "rb") as config_file:
+            config = tomllib.load(config_file)
+    else:
+        with open(path) as config_file:
+            config = json.load(config_file)
+    config = {name.replace("-", "_"): value for name, value in config.items()}
+    unknown = sorted(set(config) - set(DEFAULTS))
+    if unknown:
+        raise ValueError(f"Unknown config keys {unknown} in {path}, expected names from {sorted(DEFAULTS)}")
+    return config
+
+
+def resolve_settings(args):  # DEFAULTS, overridden by the config file, overridden by the flags given
+    settings = dict(DEFAULTS)
+    if args.config is not None:
+        settings.update(load_config(args.config))
+    settings.update({name: value for name, value in vars(args).items() if name in DEFAULTS and value is not None})
+    if settings["format"] not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown format {settings['format']!r}, expected one of {list(OUTPUT_FORMATS)}")
+    if settings["granularity"] not in GRANULARITIES:
+        raise ValueError(f"Unknown granularity {settings['granularity']!r}, expected one of {GRANULARITIES}")
+    if settings["assignment_policy"] not in ASSIGNMENT_POLICIES:  # Checked here too for values from a config file
+        raise ValueError(f"Unknown assignment_policy {settings['assignment_policy']!r}, "
+                         f"expected one of {ASSIGNMENT_POLICIES}")
+    if settings["queue_policy"] not in QUEUE_POLICIES:
+        raise ValueError(f"Unknown queue_policy {settings['queue_policy']!r}, expected one of {QUEUE_POLICIES}")
+    if settings["every"] < 1:
+        raise ValueError(f"every must be at least one step, got {settings['every']}")
+    if settings["steps"] < 1:
+        raise ValueError(f"steps must be at least one, got {settings['steps']}")
+    unknown = sorted(set(settings["tables"]) - set(TABLES))
+    if unknown:
+        raise ValueError(f"Unknown tables {unknown}, expected some of {TABLES}")
+    return settings
+
+
+def selected_steps(steps, granularity, every):  # Recorded steps to write, steps are numbered from 1 to steps
+    if granularity == "step":
+        return list(range(1, steps + 1))
+    if granularity == "final":
+        return [steps]
+    return sorted(set(range(every, steps + 1, every)) | {steps})
+
+
+# Writing ---------------------------------------------------------------------------------------------
+class TableWriter:  # Appends DataFrames to one output file in the chosen format
+    def __init__(self, path, file_format):
+        self.path = path
+        self.file_format = file_format
+        self.rows = 0
+        self.handle = None  # Text handle for CSV, ParquetWriter for Parquet, opened with the first frame
+        self.schema = None
+
+    def write(self, frame):
+        if self.file_format == "parquet":
+            table = pa.Table.from_pandas(frame, schema=self.schema, preserve_index=False)
+            if self.handle is None:
+                self.schema = table.schema
+                self.handle = pq.ParquetWriter(self.path, self.schema)
+            self.handle.write_table(table)
+        else:
+            if self.handle is None:
+                self.handle = gzip.open(self.path, "wt", newline="") if self.file_format == "csv.gz" else \
+                    open(self.path, "w", newline="")
+            frame.to_csv(self.handle, header=self.rows == 0, index=False)
+        self.rows += len(frame)
+
+    def close(self):
+        if self.handle is None:  # Nothing selected, still leave an (empty) file behind
+            if self.file_format == "parquet":
+                return
+            self.handle = gzip.open(self.path, "wt") if self.file_format == "csv.gz" else open(self.path, "w")
+        self.handle.close()
+
+
+def export_tables(recorder, settings, steps):  # Write the selected steps of each table, returns {table: (path, rows)}
+    from event_log import iter_cross_sections
+
+    written = {}
+    step_set = set(steps)
+    for table in settings["tables"]:
+        path = os.path.join(settings["output_dir"], table + OUTPUT_FORMATS[settings["format"]])
+        writer = TableWriter(path, settings["format"])
+        try:
+            if table != "patient":
+                for frame in recorder.iter_frames(table):  # Stream the chunks, only a chunk is in memory at a time
+                    frame = frame[frame["step"].isin(step_set)]
+                    if len(frame):
+                        writer.write(frame)
+            else:  # Rebuild the cross sections asked for while streaming the event log once
+                chunk, chunk_rows = [], 0
+                for step, frame in iter_cross_sections(recorder.iter_frames("patient_events"), steps):
+                    chunk.append(frame)
+                    chunk_rows += len(frame)
+                    if chunk_rows >= EXPORT_CHUNK_ROWS:
+                        writer.write(pd.concat(chunk, ignore_index=True))
+                        chunk, chunk_rows = [], 0
+                if chunk_rows:
+                    writer.write(pd.concat(chunk, ignore_index=True))
+        finally:
+            writer.close()
+        written[table] = (path, writer.rows)
+    return written
+
+
+# Running ---------------------------------------------------------------------------------------------
+def run(settings):  # Run the model headless and export its tables, returns the exit summary
+    from implant_market_model import ImplantMarketModel
+    from data_recorder import DataRecorder
+    from benchmark import peak_rss_mb
+
+    os.makedirs(settings["output_dir"], exist_ok=True)
+    scratch_dir = tempfile.mkdtemp(prefix=".recording_", dir=settings["output_dir"])
+    try:
+        start = time.perf_counter()
+        recorder = DataRecorder(scratch_dir, file_format="parquet")
+        # Patient rows are only recorded (as events) when the patient table is wanted
+        record_mode = "events" if "patient" in settings["tables"] else "summary"
+        model = ImplantMarketModel(*[settings[name] for name in MODEL_PARAMS], engine=settings["engine"],
+                                   recorder=recorder, record_mode=record_mode, seed=settings["seed"],
+                                   assignment_policy=settings["assignment_policy"],
+                                   queue_policy=settings["queue_policy"], log_level="silent")
+        for i in range(settings["steps"]):
+            model.step()
+        recorder.close()
+        run_seconds = time.perf_counter() - start
+        written = export_tables(recorder, settings,
+                                selected_steps(settings["steps"], settings["granularity"], settings["every"]))
+        wall_seconds = time.perf_counter() - start
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    average_utility = model.run_metrics.average_utility()
+    return {
+        "settings": settings,
+        "seed": model.seed,
+        "run_seconds": run_seconds,
+        "wall_seconds": wall_seconds,
+        "steps_per_second": settings["steps"] / run_seconds,
+        "peak_rss_mb": peak_rss_mb(),
+        "patients": model.patient_count(),
+        "files": {table: {"path": path, "rows": rows} for table, (path, rows) in written.items()},
+        "average_utility": {str(manufacturer_id): float(utility) for manufacturer_id, utility
+                            in zip(average_utility["manufacturer_id"], average_utility["average_utility"])}
+    }
+
+
+def print_summary(summary):
+    rss = "n/a" if summary["peak_rss_mb"] is None else f"{summary['peak_rss_mb']:.1f} MB"
+    print(f"Ran {summary['settings']['steps']} steps (seed {summary['seed']}) in {summary['run_seconds']:.2f}s, "
+          f"{summary['steps_per_second']:.1f} steps/s, {summary['wall_seconds']:.2f}s with the export")
+    print(f"Peak memory {rss}, {summary['patients']} patients")
+    for table, output in summary["files"].items():
+        print(f"  {table}: {output['rows']} rows -> {output['path']}")
+    print("Average utility: " + ", ".join(f"{manufacturer_id} {utility:.3f}"
+                                          for manufacturer_id, utility in summary["average_utility"].items()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run ImplantMarketModel headless and write the chosen tables")
+    parser.add_argument("--config", help="TOML or JSON file with any of the settings below, flags take precedence")
+    parser.add_argument("--num-providers", type=int)
+    parser.add_argument("--initial-num-patients", type=int)
+    parser.add_argument("--patient-incidence", type=int)
+    parser.add_argument("--additive-adoption-preference", type=float)
+    parser.add_argument("--ae-probability-additive", type=float)
+    parser.add_argument("--ae-probability-subtractive", type=float)
+    parser.add_argument("--steps", type=int, help="steps to run, 1 step = 1 day")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--engine", choices=["agent", "cohort"])
+    parser.add_argument("--assignment-policy", choices=ASSIGNMENT_POLICIES)
+    parser.add_argument("--queue-policy", choices=QUEUE_POLICIES)
+    parser.add_argument("--output-dir")
+    parser.add_argument("--format", choices=list(OUTPUT_FORMATS))
+    parser.add_argument("--granularity", choices=GRANULARITIES)
+    parser.add_argument("--every", type=int, help="write every k-th step with --granularity every")
+    parser.add_argument("--tables", nargs="+", choices=TABLES)
+    parser.add_argument("--summary-json", help="also save the exit summary to this file")
+    args = parser.parse_args(argv)
+
+    try:
+        settings = resolve_settings(args)
+    except (OSError, ValueError) as error:
+        parser.error(str(error))
+    summary = run(settings)
+    print_summary(summary)
+    if settings["summary_json"] is not None:
+        with open(settings["summary_json"], "w") as summary_file:
+            json.dump(summary, summary_file, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
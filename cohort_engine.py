@@ -0,0 +1,317 @@
+import numpy as np
+from healthcare_provider_agent import HealthcareProviderAgent
+from patient_agent import HEALTH_STATES
+from event_log import PATIENT_EVENTS, PATIENT_EVENT_BITS
+from waiting_queue import WaitingQueue
+from random_streams import keyed_uniforms, patient_key
+
+# Define PatientCohort
+# Struct-of-arrays alternative to one PatientAgent object per patient, used when ImplantMarketModel runs with
+# engine="cohort". Every patient is a row index into the NumPy columns below, so waiting, surgery outcomes and
+# follow-ups are updated in batch instead of through one Python step() call per patient per day.
+# Integer columns use -1 where PatientAgent would hold None.
+# Waiting days are an approximation: a PatientAgent counts a day of waiting if it is still waiting when its own step()
+# runs, before or after its provider's in RandomActivation's shuffled order. The cohort has no such order, so a patient
+# whose waiting ended or began this step (surgery, urgent re-surgery) gets the day on a 50% coin, see advance_waiting.
+# Every other aggregate follows the agent engine exactly, but waiting days only match it in distribution.
+
+MINIMAL = HEALTH_STATES.index("minimal")
+SEVERE = HEALTH_STATES.index("severe")
+BEDBOUND = HEALTH_STATES.index("bedbound")
+OUTCOME_CATEGORIES = ["same", "improved", "worsened"]
+
+
+class PatientCohort:
+    columns = {  # Column name: (dtype, value for a freshly spawned patient)
+        "health_status": (np.int8, 0),  # Index into HEALTH_STATES
+        "previous_health_status": (np.int8, -1),  # Second to last entry of the health status history
+        "outcome_category": (np.int8, -1),  # Index into OUTCOME_CATEGORIES counted by the provider
+        "provider_index": (np.int32, -1),  # Position in model.providers
+        "manufacturer_index": (np.int8, -1),  # Position in model.manufacturers
+        "assigned_y_n": (np.bool_, False),
+        "received_surgery": (np.bool_, False),
+        "needs_urgent_surgery": (np.bool_, False),
+        "days_waiting_for_surgery": (np.int32, 0),
+        "step_spawned": (np.int32, 0),
+        "step_received_treatment": (np.int32, -1),
+        "next_follow_up_index": (np.int8, 0),
+        "next_follow_up": (np.int32, -1),
+        "pending_events": (np.uint8, 0),  # Bitmask of PATIENT_EVENT_BITS noted this step, for record_mode="events"
+        "draw_key": (np.uint64, 0),  # Keys the patient's own random draws, as PatientAgent.draw_key
+        "draws": (np.int32, 0),  # Keyed draws taken so far
+    }
+
+    def __init__(self, model, initial_capacity=1024):
+        self.model = model
+        self.rng = model.streams.generator  # Stream name: NumPy Generator, see RandomStreams
+        self.size = 0  # Number of patients spawned so far
+        self.capacity = 0  # Number of rows allocated in each column
+        self.unique_ids = []  # Same ids as the PatientAgent mode, row i belongs to unique_ids[i]
+        for name, (dtype, fill) in self.columns.items():
+            setattr(self, name, np.empty(0, dtype=dtype))
+        self.reserve(initial_capacity)
+        self.manufacturer_ids = [manufacturer.unique_id for manufacturer in model.manufacturers]
+        self.additive_manufacturers = np.array([m.type_of_manufacturer == 'additive' for m in model.manufacturers])
+        self.waiting = WaitingQueue(model.queue_policy, self.waiting_priority(model.queue_policy))  # Unassigned rows
+
+    def __len__(self):
+        return self.size
+
+    def __getstate__(self):  # Only the spawned rows are pickled, e.g. into a checkpoint
+        state = self.__dict__.copy()
+        for name in self.columns:
+            state[name] = getattr(self, name)[:self.size].copy()
+        state["capacity"] = self.size
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.waiting.priority = self.waiting_priority(self.waiting.policy)
+
+    def reserve(self, capacity):  # Grow every column geometrically so spawning stays amortized O(1) per patient
+        if capacity <= self.capacity:
+            return
+        capacity = max(capacity, 2 * self.capacity)
+        for name, (dtype, fill) in self.columns.items():
+            column = np.full(capacity, fill, dtype=dtype)
+            column[:self.size] = getattr(self, name)[:self.size]
+            setattr(self, name, column)
+        self.capacity = capacity
+
+    # Spawning and assignment -----------------------------------------------------------------------
+    def spawn(self, unique_ids):
+        count = len(unique_ids)
+        self.reserve(self.size + count)
+        rows = slice(self.size, self.size + count)
+        self.health_status[rows] = self.rng["spawning"].integers(SEVERE, BEDBOUND + 1, size=count)  # severe, crippled or bedbound
+        self.step_spawned[rows] = self.model.schedule.steps
+        self.draw_key[rows] = [patient_key(unique_id) for unique_id in unique_ids]
+        self.unique_ids.extend(unique_ids)
+        self.size += count
+        self.waiting.extend(range(rows.start, rows.stop))
+        self.note_events(np.arange(rows.start, rows.stop), "spawn")
+
+    def waiting_mask(self):  # Same condition PatientAgent.step uses to count a day of waiting
+        return self.needs_urgent_surgery[:self.size] | ~self.received_surgery[:self.size]
+
+    def waiting_priority(self, policy):  # Same priorities as ImplantMarketModel.waiting_priority, for rows
+        if policy == "longest_waiting":
+            return lambda row: self.model.schedule.steps - int(self.days_waiting_for_surgery[row])
+        return lambda row: -int(self.health_status[row])
+
+    def assign_patients(self):  # Returns the queue of rows still waiting for a provider
+        chosen = self.model.provider_assignment.assign(len(self.waiting))  # Same policy as PatientAgent mode
+        self.admit_patients(np.array(self.waiting.pop_many(len(chosen)), dtype=np.intp), chosen)
+        return self.waiting
+
+    def admit_patients(self, rows, provider_indices):
+        if len(rows) == 0:
+            return
+        providers = self.model.providers
+        self.assigned_y_n[rows] = True
+        self.provider_index[rows] = provider_indices
+
+        # Routing rates only change during the schedule step, so each provider computes its preference once
+        preferences = np.zeros(len(providers))
+        for i in np.unique(provider_indices).tolist():
+            preferences[i] = providers[i].get_additive_adoption_preference()
+        additive = self.rng["routing"].random(len(rows)) < preferences[provider_indices]
+
+        # Then a manufacturer of the chosen type, drawn only when the type has more than one
+        manufacturer_index = np.empty(len(rows), dtype=np.int64)
+        for type_of_manufacturer, chosen in (('additive', additive), ('subtractive', ~additive)):
+            positions = self.model.manufacturer_registry.type_positions(type_of_manufacturer)
+            count = int(chosen.sum())
+            if count == 0:
+                continue
+            manufacturer_index[chosen] = positions[0] if len(positions) == 1 else \
+                positions[self.rng["routing"].integers(len(positions), size=count)]
+        self.manufacturer_index[rows] = manufacturer_index
+        self.model.run_metrics.patients_assigned(manufacturer_index, self.health_status[rows])
+        orders = np.bincount(manufacturer_index, minlength=len(self.model.manufacturers))
+        for i in np.flatnonzero(orders).tolist():
+            self.model.manufacturers[i].order_implant(int(orders[i]))
+
+        for row, i in zip(rows.tolist(), provider_indices.tolist()):
+            providers[i].surgery_patients.append(row)
+        self.note_events(rows, "assignment")
+
+    # Step ------------------------------------------------------------------------------------------
+    def advance_waiting(self, waiting_before):
+        waiting_after = self.waiting_mask()
+        count = len(waiting_before)  # Patients are never spawned during the schedule step
+        self.days_waiting_for_surgery[:count] += waiting_before & waiting_after
+        # Patients that had surgery or became urgent this step would have stepped before or after their provider
+        # with equal chance under RandomActivation
+        changed = np.flatnonzero(waiting_before ^ waiting_after)
+        self.days_waiting_for_surgery[changed[self.rng["schedule"].random(len(changed)) < 0.5]] += 1
+
+    def uniforms(self, stream, rows):  # Batch version of PatientAgent.draw, rows must be distinct
+        values = keyed_uniforms(self.model.streams.keys[stream], self.draw_key[rows], self.draws[rows])
+        self.draws[rows] += 1
+        return values
+
+    def draw_states(self, stream, table, rows, states=None):
+        # One outcome of a CategoricalTable per row, as its index in states (or the outcome itself, for integer outcomes)
+        codes = np.array(table.outcomes if states is None else [states.index(state) for state in table.outcomes])
+        return codes[np.searchsorted(table.cumulative_weights, self.uniforms(stream, rows), side='right')]
+
+    # Recording -------------------------------------------------------------------------------------
+    def note_events(self, rows, event):  # Batch version of ImplantMarketModel.note_patient_event
+        if self.model.record_mode == "events" and len(rows):
+            self.pending_events[rows] |= PATIENT_EVENT_BITS[event]
+
+    def row_columns(self, rows, step):  # Same fields ImplantMarketModel records for each PatientAgent
+        return {
+            "step": np.full(len(rows), step),
+            "patient_id": [self.unique_ids[row] for row in rows.tolist()],
+            "health_status": self.health_status[rows],  # Codes match the HEALTH_STATES categories
+            "received_surgery": self.received_surgery[rows],
+            "days_waiting_for_surgery": self.days_waiting_for_surgery[rows],
+            "step_received_treatment": self.step_received_treatment[rows],
+            "manufacturer_id": self.manufacturer_index[rows],  # Codes match the model's manufacturer order
+            "next_follow_up": self.next_follow_up[rows],
+            "needs_urgent_surgery": self.needs_urgent_surgery[rows],
+            "step_followup_treatment": np.full(len(rows), -1)
+        }
+
+    def record(self, patient_table, step):  # One row per patient
+        patient_table.append_columns(self.row_columns(np.arange(self.size), step))
+
+    def record_events(self, events_table, step):  # One row per event noted this step, with the patient's state
+        noted = np.flatnonzero(self.pending_events[:self.size])
+        masks = self.pending_events[noted]
+        # Expand each bitmask into (row, event code) pairs, grouped by row like the PatientAgent event log
+        has_event = (masks[:, None] >> np.arange(len(PATIENT_EVENTS), dtype=np.uint8)) & 1
+        row_positions, events = np.nonzero(has_event)
+        columns = self.row_columns(noted[row_positions], step)
+        columns["event"] = events
+        events_table.append_columns(columns)
+        self.pending_events[noted] = 0
+
+
+# Define CohortHealthcareProviderAgent
+# Same decisions as HealthcareProviderAgent, but surgery_patients and all_patients hold PatientCohort row indices
+# and surgeries and follow-ups are applied to the cohort columns in batch.
+class CohortHealthcareProviderAgent(HealthcareProviderAgent):
+
+    def update_outcome_statistics(self, rows):  # Batch version of HealthcareProviderAgent.update_outcome_statistics
+        cohort = self.model.cohort
+        before = cohort.previous_health_status[rows]
+        after = cohort.health_status[rows]
+        category = np.where(before == after, 0, np.where(before > after, 1, 2))
+
+        # Move each patient's count from their previous category to the new one
+        manufacturer_index = cohort.manufacturer_index[rows]
+        previous_category = cohort.outcome_category[rows]
+        counted = previous_category >= 0
+        changes = np.zeros((len(cohort.manufacturer_ids), len(OUTCOME_CATEGORIES)), dtype=np.int64)
+        np.add.at(changes, (manufacturer_index, category), 1)
+        np.subtract.at(changes, (manufacturer_index[counted], previous_category[counted]), 1)
+        cohort.outcome_category[rows] = category
+
+        for i, manufacturer_id in enumerate(cohort.manufacturer_ids):
+            if changes[i].any():
+                counts = self.outcome_counts.setdefault(manufacturer_id, dict.fromkeys(OUTCOME_CATEGORIES, 0))
+                for category_name, change in zip(OUTCOME_CATEGORIES, changes[i].tolist()):
+                    counts[category_name] += change
+
+    # Surgery ---------------------------------------------------------------------------------------
+    def perform_surgeries(self, rows):
+        cohort = self.model.cohort
+        manufacturers = self.model.manufacturers
+        operated = []
+        for row in rows:  # Inventory is shared, so patients are served one at a time in queue order
+            chosen_manufacturer = manufacturers[cohort.manufacturer_index[row]]
+            if chosen_manufacturer.inventory > 0:
+                chosen_manufacturer.deliver_implant(1)
+                self.surgeries_performed_step += 1
+                self.cumulative_surgeries_performed += 1
+                self.record_surgery()
+                operated.append(row)
+        if not operated:
+            return
+
+        step = self.model.schedule.steps
+        operated_set = set(operated)
+        operated = np.array(operated, dtype=np.intp)
+        first_surgeries = operated[cohort.step_received_treatment[operated] < 0]
+        self.all_patients.update(dict.fromkeys(first_surgeries.tolist()))
+        cohort.previous_health_status[operated] = cohort.health_status[operated]
+        cohort.health_status[operated] = cohort.draw_states("surgery", self.surgery_outcomes, operated)
+        self.model.run_metrics.health_changed_many(cohort.manufacturer_index[operated],
+                                                   cohort.previous_health_status[operated],
+                                                   cohort.health_status[operated])
+        cohort.step_received_treatment[operated] = step
+        cohort.received_surgery[operated] = True
+        cohort.needs_urgent_surgery[operated] = False
+        cohort.next_follow_up_index[operated] = 0
+        cohort.next_follow_up[operated] = step + self.follow_up_intervals[0]
+        for row in operated.tolist():
+            self.follow_up_calendar.schedule(step + self.follow_up_intervals[0], row)
+        self.update_outcome_statistics(operated)
+        cohort.note_events(operated, "surgery")
+        cohort.note_events(operated[cohort.health_status[operated] != cohort.previous_health_status[operated]],
+                           "health change")
+        self.surgery_patients = [row for row in self.surgery_patients if row not in operated_set]
+
+    # Follow-up -------------------------------------------------------------------------------------
+    def perform_follow_ups(self, rows):
+        if self.model.profiler is not None:
+            self.model.profiler.count("follow_ups", len(rows))
+        cohort = self.model.cohort
+        cohort.next_follow_up_index[rows] += 1
+        changes = cohort.draw_states("follow_up", self.follow_up_changes, rows, ["improved", "stable", "worse"])
+
+        health = cohort.health_status[rows]
+        worse = (changes == 2) & (health != BEDBOUND)  # Only patients that actually got worse can need urgent surgery
+        cohort.previous_health_status[rows] = health
+        cohort.health_status[rows] = np.where(changes == 0, MINIMAL, np.where(worse, BEDBOUND, health))
+        self.model.run_metrics.health_changed_many(cohort.manufacturer_index[rows], health, cohort.health_status[rows])
+        self.update_outcome_statistics(rows)
+        cohort.note_events(rows, "follow-up")
+        cohort.note_events(rows[cohort.health_status[rows] != health], "health change")
+
+        worse_rows = rows[worse]
+        if len(worse_rows):
+            ae_chance = np.where(cohort.additive_manufacturers[cohort.manufacturer_index[worse_rows]],
+                                 self.model.ae_probability_additive, self.model.ae_probability_subtractive)
+            urgent_rows = worse_rows[cohort.uniforms("adverse_events", worse_rows) < ae_chance]
+            cohort.needs_urgent_surgery[urgent_rows] = True
+            cohort.received_surgery[urgent_rows] = False
+            self.surgery_patients.extend(urgent_rows.tolist())  # Add patients back to surgery_patients for urgent surgery
+            cohort.note_events(urgent_rows, "urgent")
+
+        # Schedule the next follow-up from the step of the last surgery, -1 once all intervals are done
+        index = cohort.next_follow_up_index[rows].astype(np.intp)
+        has_next = index < len(self.follow_up_intervals)
+        intervals = np.array(self.follow_up_intervals)
+        next_follow_up = np.where(
+            has_next, cohort.step_received_treatment[rows] + intervals[np.minimum(index, len(intervals) - 1)], -1)
+        cohort.next_follow_up[rows] = next_follow_up
+        for row, follow_up in zip(rows[has_next].tolist(), next_follow_up[has_next].tolist()):
+            self.follow_up_calendar.schedule(follow_up, row)
+
+        # Nothing more will happen to patients past their last follow-up. Their rows stay in the cohort, which is
+        # already compact, but retire_patients drops them from all_patients like the PatientAgent engine does
+        if self.model.retire_patients:
+            finished = rows[~has_next & ~cohort.needs_urgent_surgery[rows]].tolist()
+            for row in finished:
+                del self.all_patients[row]
+            self.retired_patients += len(finished)
+
+    # Step ------------------------------------------------------------------------------------------
+    def step(self):
+        cohort = self.model.cohort
+        # Prioritize patients marked for urgent surgery
+        self.perform_surgeries([row for row in self.surgery_patients if cohort.needs_urgent_surgery[row]])
+        # Handle regular surgery
+        self.perform_surgeries([row for row in self.surgery_patients if not cohort.needs_urgent_surgery[row]])
+        # Handle follow-ups due this step, skipping stale appointments and patients waiting for urgent surgery
+        due = np.array(self.follow_up_calendar.pop_due(self.model.schedule.steps), dtype=np.intp)
+        due = np.unique(due[(cohort.next_follow_up[due] == self.model.schedule.steps) & cohort.received_surgery[due]])
+        if len(due):
+            self.perform_follow_ups(due)
+
+        # Update patient_capacity
+        self.patient_capacity = self.patient_max_capacity - len(self.surgery_patients)
@@ -0,0 +1,58 @@
+from implant_market_model import ImplantMarketModel
+import pandas as pd
+import time
+
+
+# Runs the same parameters with the PatientAgent ("agent") and PatientCohort ("cohort") engines, reporting the time per
+# step and the aggregate results of each so the two modes can be checked against each other
+def run_engine(engine, params, time_period, replications):
+    runs = []
+    for replication in range(replications):
+        model = ImplantMarketModel(*params, engine=engine, seed=replication, log_level="silent")
+        start = time.perf_counter()
+        for i in range(time_period):
+            model.step()
+        elapsed = time.perf_counter() - start
+
+        manufacturer_data = model.recorder.read_frame('manufacturer')
+        final_step_data = model.recorder.read_frame('patient', step=model.schedule.steps)
+        run = {
+            "engine": engine,
+            "replication": replication,
+            "seconds_per_step": elapsed / time_period,
+            "total_revenue": manufacturer_data.groupby('manufacturer_id', observed=True)['revenue'].last().sum(),
+            "patients": len(final_step_data),
+            "received_surgery": final_step_data['received_surgery'].mean(),
+            "days_waiting_for_surgery": final_step_data['days_waiting_for_surgery'].mean()
+        }
+        # Share of patients in each health state at the final step
+        run.update(final_step_data['health_status'].astype(str).value_counts(normalize=True).to_dict())
+        runs.append(run)
+    return runs
+
+
+def main():
+    # Model parameters
+    num_providers = 3
+    initial_num_patients = 76
+    patient_incidence = 48
+    time_period = 200
+    additive_adoption_preference = 0.5
+    ae_probability_additive = 0.3
+    ae_probability_subtractive = 0.3
+    replications = 5
+    params = (num_providers, initial_num_patients, patient_incidence, additive_adoption_preference,
+              ae_probability_additive, ae_probability_subtractive)
+
+    results = pd.DataFrame(run_engine("agent", params, time_period, replications) +
+                           run_engine("cohort", params, time_period, replications))
+    summary = results.drop(columns='replication').groupby('engine').agg(['mean', 'sem'])
+    print("Engine Comparison (mean and standard error over replications):")
+    print(summary.T)
+
+    seconds_per_step = results.groupby('engine')['seconds_per_step'].mean()
+    print(f"\nCohort speedup: {seconds_per_step['agent'] / seconds_per_step['cohort']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+import array
+import glob
+import json
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# Define DataRecorder
+# Columnar replacement for the per-step lists of row dicts. Each table stores typed columns (integer-coded categories,
+# nullable ints with -1 as the missing value) in compact array buffers, and every chunk_size rows the buffers are
+# converted to an Arrow table. Chunks are written to one Parquet or Arrow IPC file each under output_dir/<table>/,
+# or kept in memory as Arrow tables when there is no output_dir, so peak memory is bounded by the chunk size.
+# Results are read back lazily through pyarrow datasets, optionally filtered to a single step.
+
+# Category columns are stored as their int16 codes (Parquet cannot round-trip dictionaries of ints) and turned back
+# into dictionary columns when read.
+
+# close() also writes a tables.json manifest (column kinds, categories and chunk files) next to the chunks, so a
+# finished output_dir can be opened again for reading with DataRecorder.load.
+
+# Column kind: (array typecode, NumPy dtype)
+COLUMN_KINDS = {
+    "int32": ("i", np.int32),
+    "nullable_int32": ("i", np.int32),  # -1 is recorded as missing (None)
+    "float64": ("d", np.float64),
+    "bool": ("b", np.int8),
+    "category": ("h", np.int16),  # Code into the column's categories, -1 is recorded as missing (None)
+    "string": (None, None),  # Kept as a list of values, written as strings
+}
+FILE_FORMATS = {"parquet": ".parquet", "arrow": ".arrow"}
+MANIFEST = "tables.json"
+
+
+class TableRecorder:
+    def __init__(self, name, columns, recorder):
+        self.name = name
+        self.recorder = recorder
+        self.columns = []  # (name, kind, categories)
+        self.encoders = []  # Functions turning a recorded value into its stored code, None to store as is
+        for column in columns:
+            column_name, kind = column[0], column[1]
+            categories = list(column[2]) if len(column) > 2 else None
+            if kind not in COLUMN_KINDS:
+                raise ValueError(f"Unknown column kind {kind!r} for {name}.{column_name}")
+            self.columns.append((column_name, kind, categories))
+            if kind == "category":
+                codes = {category: code for code, category in enumerate(categories)}
+                self.encoders.append(lambda value, codes=codes: -1 if value is None else codes[value])
+            elif kind == "nullable_int32":
+                self.encoders.append(lambda value: -1 if value is None else value)
+            else:
+                self.encoders.append(None)
+        self.schema = pa.schema([pa.field(column_name, self.arrow_type(kind))
+                                 for column_name, kind, _ in self.columns])  # Schema of the stored chunks
+        self.chunks = []  # Arrow tables (in memory) or file paths (on disk)
+        self.rows_recorded = 0
+        self.reset_buffers()
+
+    @staticmethod
+    def arrow_type(kind):
+        return {"int32": pa.int32(), "nullable_int32": pa.int32(), "float64": pa.float64(), "bool": pa.bool_(),
+                "category": pa.int16(), "string": pa.string()}[kind]
+
+    def reset_buffers(self):
+        self.buffers = [[] if kind == "string" else array.array(COLUMN_KINDS[kind][0]) for _, kind, _ in self.columns]
+
+    def __len__(self):  # Rows waiting in the buffers
+        return len(self.buffers[0])
+
+    # Recording -------------------------------------------------------------------------------------
+    def append_row(self, values):  # One row, values in column order
+        for buffer, encode, value in zip(self.buffers, self.encoders, values):
+            buffer.append(value if encode is None else encode(value))
+        self.rows_recorded += 1
+
+    def append_dict(self, row):  # One row given as {column name: value}
+        self.append_row([row[column_name] for column_name, _, _ in self.columns])
+
+    def append_columns(self, values):  # Many rows given as {column name: array}, categories already coded
+        count = None
+        for (column_name, kind, _), buffer in zip(self.columns, self.buffers):
+            column = values[column_name]
+            if kind == "string":
+                buffer.extend(column)
+            else:
+                column = np.asarray(column, dtype=COLUMN_KINDS[kind][1])
+                buffer.frombytes(np.ascontiguousarray(column).tobytes())
+            count = len(column)
+        self.rows_recorded += count
+
+    def buffer_table(self):  # Convert the buffered rows to an Arrow table in the stored schema
+        arrays = []
+        for (column_name, kind, categories), buffer in zip(self.columns, self.buffers):
+            if kind == "string":
+                arrays.append(pa.array([str(value) for value in buffer], type=pa.string()))
+                continue
+            # Copy so the array buffer is not exported while recording continues
+            data = np.frombuffer(buffer, dtype=COLUMN_KINDS[kind][1]).copy() if len(buffer) else \
+                np.empty(0, dtype=COLUMN_KINDS[kind][1])
+            if kind == "bool":
+                arrays.append(pa.array(data.astype(bool)))
+            elif kind in ("nullable_int32", "category"):
+                arrays.append(pa.array(data, mask=data < 0))
+            else:
+                arrays.append(pa.array(data))
+        return pa.Table.from_arrays(arrays, schema=self.schema)
+
+    def flush(self):  # Move the buffered rows into a chunk
+        if len(self) == 0:
+            return
+        self.write_chunk(self.buffer_table())
+        self.reset_buffers()
+
+    def write_chunk(self, table):  # Store an Arrow table in the stored schema as the next chunk
+        output_dir = self.recorder.table_dir(self.name)
+        if output_dir is None:
+            self.chunks.append(table)
+        else:
+            path = os.path.join(output_dir, f"part-{len(self.chunks):05d}{FILE_FORMATS[self.recorder.file_format]}")
+            if self.recorder.file_format == "parquet":
+                pq.write_table(table, path)
+            else:
+                with pa.OSFile(path, "wb") as sink, pa.ipc.new_file(sink, self.schema) as writer:
+                    writer.write_table(table)
+            self.chunks.append(path)
+
+    def restore(self, table):  # Append rows saved with stored_table, e.g. from a checkpoint
+        if table.num_rows:
+            self.write_chunk(table)
+            self.rows_recorded += table.num_rows
+
+    # Reading ---------------------------------------------------------------------------------------
+    def dataset(self):  # Flushed chunks only
+        if self.recorder.output_dir is None:
+            return ds.InMemoryDataset(self.chunks, schema=self.schema)
+        file_format = "parquet" if self.recorder.file_format == "parquet" else "ipc"
+        return ds.dataset(self.chunks, schema=self.schema, format=file_format)
+
+    def buffered_table(self, columns=None, row_filter=None):  # Rows not flushed yet, filtered like the dataset
+        table = self.buffer_table()
+        if row_filter is not None:
+            table = table.filter(row_filter)
+        return table if columns is None else table.select(columns)
+
+    def stored_table(self):  # Every row so far with category codes as stored, for restore
+        return pa.concat_tables([self.dataset().to_table(), self.buffer_table()])
+
+    def decode(self, table):  # Turn category codes back into dictionary columns
+        for column_name, kind, categories in self.columns:
+            if kind == "category" and column_name in table.column_names:
+                codes = table[column_name].combine_chunks()
+                position = table.column_names.index(column_name)
+                table = table.set_column(position, column_name,
+                                         pa.DictionaryArray.from_arrays(codes, pa.array(categories)))
+        return table
+
+    def read_table(self, columns=None, step=None):  # Flushed chunks plus the rows still buffered
+        row_filter = None if step is None else pc.field("step") == step
+        return self.decode(pa.concat_tables([self.dataset().to_table(columns=columns, filter=row_filter),
+                                             self.buffered_table(columns, row_filter)]))
+
+    def iter_batches(self, columns=None, step=None):  # Stream decoded tables without materializing the whole run
+        row_filter = None if step is None else pc.field("step") == step
+        for batch in self.dataset().to_batches(columns=columns, filter=row_filter):
+            yield self.decode(pa.Table.from_batches([batch]))
+        yield self.decode(self.buffered_table(columns, row_filter))
+
+
+class DataRecorder:
+    def __init__(self, output_dir=None, chunk_size=100_000, file_format="parquet"):
+        if file_format not in FILE_FORMATS:
+            raise ValueError(f"Unknown file format {file_format!r}, expected one of {list(FILE_FORMATS)}")
+        self.output_dir = output_dir  # None keeps chunks in memory
+        self.chunk_size = chunk_size  # Rows per chunk
+        self.file_format = file_format
+        self.tables = {}
+
+    def add_table(self, name, columns):
+        table_dir = self.table_dir(name)
+        if table_dir is not None:
+            os.makedirs(table_dir, exist_ok=True)
+            for path in glob.glob(os.path.join(table_dir, "part-*")):  # Remove chunks left over from an earlier run
+                os.remove(path)
+        self.tables[name] = TableRecorder(name, columns, self)
+        return self.tables[name]
+
+    def table_dir(self, name):
+        return None if self.output_dir is None else os.path.join(self.output_dir, name)
+
+    def __getitem__(self, name):
+        return self.tables[name]
+
+    def end_step(self):  # Flush every table whose buffer has reached the chunk size
+        for table in self.tables.values():
+            if len(table) >= self.chunk_size:
+                table.flush()
+
+    def close(self):
+        for table in self.tables.values():
+            table.flush()
+        if self.output_dir is not None:
+            self.write_manifest()
+
+    def write_manifest(self):
+        manifest = {"file_format": self.file_format, "tables": {
+            name: {"columns": [list(column) for column in table.columns],
+                   "chunks": [os.path.relpath(path, self.output_dir) for path in table.chunks],
+                   "rows": table.rows_recorded}
+            for name, table in self.tables.items()}}
+        with open(os.path.join(self.output_dir, MANIFEST), "w") as manifest_file:
+            json.dump(manifest, manifest_file)
+
+    @classmethod
+    def load(cls, output_dir):  # Reopen the tables of a closed recorder's output_dir, for reading only
+        with open(os.path.join(output_dir, MANIFEST)) as manifest_file:
+            manifest = json.load(manifest_file)
+        recorder = cls(output_dir, file_format=manifest["file_format"])
+        for name, table in manifest["tables"].items():
+            recorder.tables[name] = TableRecorder(name, column_specs(table["columns"]), recorder)
+            recorder.tables[name].chunks = [os.path.join(output_dir, path) for path in table["chunks"]]
+            recorder.tables[name].rows_recorded = table["rows"]
+        return recorder
+
+    def bytes_written(self):
+        return sum(os.path.getsize(path) for table in self.tables.values() for path in table.chunks
+                   if isinstance(path, str))
+
+    # Reading ---------------------------------------------------------------------------------------
+    def read_frame(self, name, columns=None, step=None):
+        return to_frame(self.tables[name].read_table(columns, step))
+
+    def iter_frames(self, name, columns=None, step=None):
+        for table in self.tables[name].iter_batches(columns, step):
+            if table.num_rows:
+                yield to_frame(table)
+
+
+def column_specs(columns):  # TableRecorder.columns back to the column tuples add_table takes
+    return [tuple(column[:2]) if column[2] is None else tuple(column) for column in columns]
+
+
+def to_frame(table):  # Arrow to pandas with nullable ints kept as integers and categories as Categoricals
+    return table.to_pandas(types_mapper={pa.int32(): pd.Int32Dtype()}.get)
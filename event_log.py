@@ -0,0 +1,188 @@
+import itertools
+import numpy as np
+import pandas as pd
+
+# Patient event log
+# With record_mode="events" ImplantMarketModel does not snapshot every patient every step. Instead it records a row in
+# the "patient_events" table only for the patients something happened to, one row per event, carrying the patient's
+# state at the end of that step. Between two events a patient's recorded fields stay the same, except for
+# days_waiting_for_surgery which grows by one per step while the patient is waiting (PatientAgent.step), so the full
+# per-step patient table can be rebuilt from the events on demand.
+# iter_cross_sections rebuilds the cross-sections of many steps in one pass over the event log, keeping only each
+# patient's latest state, so an export of every step (or of every k-th step) streams one step's rows at a time instead
+# of building the whole per-step table or re-reading the log for each step.
+
+PATIENT_EVENTS = ["spawn", "assignment", "surgery", "follow-up", "health change", "urgent", "referral"]
+PATIENT_EVENT_BITS = {event: 1 << bit for bit, event in enumerate(PATIENT_EVENTS)}  # Events noted in a step are OR-ed
+PATIENT_COLUMNS = ["step", "patient_id", "health_status", "received_surgery", "days_waiting_for_surgery",
+                   "step_received_treatment", "manufacturer_id", "next_follow_up", "needs_urgent_surgery",
+                   "step_followup_treatment"]  # Columns of the snapshot "patient" table
+
+
+def event_bits(events_mask):  # Split an event bitmask into the events it contains
+    return [bit for bit in range(len(PATIENT_EVENTS)) if events_mask >> bit & 1]
+
+
+def end_of_step_states(events, last_step=None):  # One row per patient and step with an event, in spawn order
+    events = events[events['step'] <= last_step] if last_step is not None else events
+    states = events.drop(columns='event').drop_duplicates(['patient_id', 'step'], keep='last')
+    spawn_order = pd.Series(np.arange(states['patient_id'].nunique()), index=states['patient_id'].unique())
+    states = states.assign(spawn_order=states['patient_id'].map(spawn_order).to_numpy())
+    return states.sort_values(['spawn_order', 'step'], kind='stable')
+
+
+def advance(states, steps_ahead):  # Move recorded states forward, counting the days spent waiting
+    states = states.copy()
+    waiting = (states['needs_urgent_surgery'] | ~states['received_surgery']).to_numpy()
+    states['step'] = pd.array(states['step'].to_numpy(dtype='int64') + steps_ahead, dtype='Int32')
+    states['days_waiting_for_surgery'] = pd.array(states['days_waiting_for_surgery'].to_numpy(dtype='int64') +
+                                                  np.where(waiting, steps_ahead, 0), dtype='Int32')
+    return states
+
+
+def reconstruct_cross_section(events, step):
+    # Patient table rows of a single step, from the last event of each patient at or before that step
+    states = end_of_step_states(events, step).drop_duplicates('patient_id', keep='last')
+    states = advance(states, step - states['step'].to_numpy(dtype='int64'))
+    return states[PATIENT_COLUMNS].reset_index(drop=True)
+
+
+def reconstruct_patient_frame(events, last_step=None):
+    # Full per-step patient table, each event state repeated until the patient's next event (or last_step)
+    last_step = int(events['step'].max()) if last_step is None else last_step
+    states = end_of_step_states(events, last_step)
+    next_step = states.groupby('spawn_order')['step'].shift(-1).fillna(last_step + 1).to_numpy(dtype='int64')
+    lengths = next_step - states['step'].to_numpy(dtype='int64')
+    repeated = np.repeat(np.arange(len(states)), lengths)
+    steps_ahead = np.arange(len(repeated)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    frame = advance(states.iloc[repeated], steps_ahead)
+    frame = frame.sort_values(['step', 'spawn_order'], kind='stable')
+    return frame[PATIENT_COLUMNS].reset_index(drop=True)
+
+
+class CrossSections:
+    # Latest recorded state of every patient seen so far, in spawn order, updated a block of events at a time.
+    # Columns are NumPy arrays (category codes, bools, or int values with a missing mask) grown geometrically
+    def __init__(self, events):  # events: any frame of the event log, for the column dtypes
+        self.positions = {}  # patient_id: row, in order of first event
+        self.size = 0  # Patients seen up to the latest events added
+        self.patient_ids = events['patient_id'].iloc[:0].reset_index(drop=True)  # Of the first size rows, built as needed
+        self.dtypes = {name: events[name].dtype for name in PATIENT_COLUMNS if name != 'patient_id'}
+        self.values = {}
+        self.missing = {}  # Integer column: True where the value is missing
+        for name, dtype in self.dtypes.items():
+            if isinstance(dtype, pd.CategoricalDtype):
+                self.values[name] = np.empty(0, dtype=np.int16)
+            elif dtype == bool:
+                self.values[name] = np.empty(0, dtype=bool)
+            else:
+                self.values[name] = np.empty(0, dtype=np.int64)
+                self.missing[name] = np.empty(0, dtype=bool)
+
+    def reserve(self, capacity):
+        if capacity <= len(self.values['step']):
+            return
+        capacity = max(capacity, 2 * len(self.values['step']))
+        for columns in (self.values, self.missing):
+            for name in columns:
+                columns[name] = np.resize(columns[name], capacity)
+
+    def rows(self, events):  # Row of each event's patient, new patients numbered in order of their first event
+        positions = self.positions
+        rows = np.array([positions.setdefault(patient_id, len(positions))
+                         for patient_id in events['patient_id'].tolist()], dtype=np.intp)
+        self.reserve(len(positions))
+        return rows
+
+    def columns(self, events):  # The events' recorded fields as (values, missing) NumPy arrays
+        columns = {}
+        for name in self.values:
+            column = events[name]
+            if name in self.missing:
+                columns[name] = (column.to_numpy(dtype='int64', na_value=0), column.isna().to_numpy())
+            elif isinstance(column.dtype, pd.CategoricalDtype):
+                columns[name] = (column.cat.codes.to_numpy(), None)
+            else:
+                columns[name] = (column.to_numpy(), None)
+        return columns
+
+    def add(self, rows, columns, block):  # The events at positions block (a slice) of rows and columns, in step order
+        rows = rows[block]
+        if not len(rows):
+            return
+        # Only each patient's last event counts, every event row of a step has the same state
+        reversed_rows = rows[::-1]
+        _, last = np.unique(reversed_rows, return_index=True)
+        latest = len(rows) - 1 - last
+        self.size = max(self.size, int(rows.max()) + 1)
+        for name, (values, missing) in columns.items():
+            self.values[name][rows[latest]] = values[block][latest]
+            if missing is not None:
+                self.missing[name][rows[latest]] = missing[block][latest]
+
+    def cross_section(self, step):  # Patient table rows of step, which must not be before the latest events added
+        size = self.size
+        if len(self.patient_ids) < size:  # Only the ids of the patients new since the last cross-section are converted
+            new_ids = pd.Series(list(itertools.islice(self.positions, len(self.patient_ids), size)),
+                                dtype=self.patient_ids.dtype)
+            self.patient_ids = pd.concat([self.patient_ids, new_ids], ignore_index=True)
+        columns = {}
+        for name in PATIENT_COLUMNS:
+            if name == 'patient_id':
+                columns[name] = self.patient_ids.array
+                continue
+            dtype = self.dtypes[name]
+            values = self.values[name][:size]
+            if isinstance(dtype, pd.CategoricalDtype):
+                columns[name] = pd.Categorical.from_codes(values, dtype=dtype)
+            elif name not in self.missing:
+                columns[name] = values.copy()
+            else:
+                if name == 'step':  # Move each state forward, counting the days spent waiting
+                    values = np.full(size, step)
+                elif name == 'days_waiting_for_surgery':
+                    waiting = self.values['needs_urgent_surgery'][:size] | ~self.values['received_surgery'][:size]
+                    values = values + np.where(waiting, step - self.values['step'][:size], 0)
+                columns[name] = pd.arrays.IntegerArray(values.astype(np.int32), self.missing[name][:size].copy())
+        return pd.DataFrame(columns, copy=False)
+
+
+def iter_cross_sections(event_frames, steps):
+    # (step, patient table rows of that step) for each of steps in increasing order, in one pass over event_frames:
+    # DataFrames of the event log in step order, e.g. DataRecorder.iter_frames('patient_events'). The events between
+    # two of the steps are applied as one block
+    targets = np.array(sorted(set(steps)), dtype=np.int64)
+    next_target = 0
+    cross_sections = None
+    last_step = 0
+    for events in event_frames:
+        if not len(events):
+            continue
+        event_steps = events['step'].to_numpy(dtype='int64')
+        if event_steps[0] < last_step or (np.diff(event_steps) < 0).any():
+            raise ValueError('The event log must come in step order')
+        last_step = event_steps[-1]
+        if cross_sections is None:
+            cross_sections = CrossSections(events)
+        rows = cross_sections.rows(events)
+        columns = cross_sections.columns(events)
+        # Events up to and including targets[k] are in block k
+        blocks = np.searchsorted(targets, event_steps, side='left')
+        starts = np.concatenate([[0], np.flatnonzero(np.diff(blocks)) + 1])
+        ends = np.append(starts[1:], len(event_steps))
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            while next_target < blocks[start]:  # Every event up to this target has been added
+                yield int(targets[next_target]), cross_sections.cross_section(targets[next_target])
+                next_target += 1
+            cross_sections.add(rows, columns, slice(start, end))
+    for step in targets[next_target:].tolist():
+        yield step, (cross_sections.cross_section(step) if cross_sections is not None else
+                     pd.DataFrame(columns=PATIENT_COLUMNS))
+
+
+def read_patient_cross_section(recorder, step):
+    return reconstruct_cross_section(recorder.read_frame('patient_events'), step)
+
+
+def read_patient_frame(recorder, last_step=None):
+    return reconstruct_patient_frame(recorder.read_frame('patient_events'), last_step)
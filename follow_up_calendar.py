@@ -0,0 +1,17 @@
+# Define FollowUpCalendar
+# Follow-up appointments bucketed by the step they are due, so a provider only looks at the patients due on the
+# current step instead of scanning every patient it has ever operated on.
+# Entries are not removed when a patient's schedule changes (e.g., urgent re-surgery), so callers check that the
+# patient is still due when the bucket is popped.
+class FollowUpCalendar:
+    def __init__(self):
+        self.appointments = {}  # step: [patients due at that step]
+
+    def schedule(self, step, patient):
+        self.appointments.setdefault(step, []).append(patient)
+
+    def pop_due(self, step):  # Remove and return every appointment booked for this step
+        return self.appointments.pop(step, [])
+
+    def __len__(self):
+        return sum(len(patients) for patients in self.appointments.values())
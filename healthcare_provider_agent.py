@@ -1,5 +1,7 @@
 from mesa import Agent
-import random
+from follow_up_calendar import FollowUpCalendar
+from patient_agent import HEALTH_STATE_RANK, HealthState
+from variate_supply import CategoricalTable
 
 
 # Define HealthcareProviderAgent
@@ -9,21 +11,66 @@ import random
 # TODO after collecting patient stats use that to determine which manufacturer to recommend
 # TODO If implant not available go to other manufacturer
 
+# Tables of the provider's decisions, also read by the expected-value model in markov_cohort.py
+PATIENT_MAX_CAPACITY = 15  # Surgery patients a provider takes on
+FOLLOW_UP_INTERVALS = [6 * 7, 3 * 30, 6 * 30, 365, 2 * 365]  # 6 weeks, 3 month, 6 month, 1 year, 2 years
+OUTCOME_PROBABILITIES = {  # Post-surgery health state probabilities
+    "minimal": 0.5,
+    "moderate": 0.30,
+    "severe": 0.1,
+    "crippled": 0.05,
+    "bedbound": 0.05
+}
+IMPROVEMENT_PROBABILITIES = {  # Health state change probabilities at each follow-up
+    "improved": 0.33,
+    "stable": 0.62,
+    "worse": 0.05
+}
+
 
 class HealthcareProviderAgent(Agent):
     def __init__(self, unique_id, model):
         super().__init__(unique_id, model)
-        self.patient_max_capacity = 15  # Max capacity
+        self.patient_max_capacity = PATIENT_MAX_CAPACITY  # Max capacity
         self.surgery_patients = []  # Keep track of patients needing surgery only, patients should be removed after receiving surgery
         self.patient_capacity = self.patient_max_capacity - len(self.surgery_patients)  # Capacity is max_capacity - patients needing surgery
-        self.all_patients = []  # Keep track of all patients
-        self.follow_up_intervals = [6 * 7, 3 * 30, 6 * 30, 365, 2 * 365]  # 6 weeks, 3 month, 6 month, 1 year, 2 years
+        self.all_patients = {}  # Keep track of all patients, as dict keys in order of first surgery so retiring is O(1)
+        self.retired_patients = 0  # Patients moved from all_patients to the model's archive after their last follow-up
+        self.follow_up_intervals = list(FOLLOW_UP_INTERVALS)  # 6 weeks, 3 month, 6 month, 1 year, 2 years
+        self.follow_up_calendar = FollowUpCalendar()  # Patients bucketed by the step of their next follow-up
         self.surgery_history = []  # Record the number of surgeries performed in each step
         self.surgeries_performed_step = 0  # Record the number of surgeries performed in each step
+        self.cumulative_surgeries_performed = 0  # Surgeries performed on all_patients, including urgent re-surgeries
+        self.outcome_counts = {}  # manufacturer_id: counts of all_patients whose last outcome was same/improved/worsened
+        self.outcome_probabilities = dict(OUTCOME_PROBABILITIES)  # Post-surgery health state probabilities
+        self.improvement_probabilities = dict(IMPROVEMENT_PROBABILITIES)  # Health state change probabilities at each follow-up
+        self.outcome_states = [HEALTH_STATE_RANK[state] for state in self.outcome_probabilities]  # Same order
+        # Routing is drawn per order, in assignment order, so a scenario's i-th order gets the same variate as the
+        # baseline's and order counts (revenue) stay paired. The outcome tables below are drawn with the patient's own
+        # keyed draws instead, see PatientAgent.draw
+        self.routing_draws = model.variates.uniform("routing")  # Pre-drawn, see VariateSupply
+        self.surgery_outcomes = CategoricalTable(self.outcome_states, self.outcome_probabilities.values())
+        self.follow_up_changes = CategoricalTable(self.improvement_probabilities,
+                                                  self.improvement_probabilities.values())
 
     def admit_patient(self, patient):  # Receive patients, get implant, perform surgery
         patient.assigned_y_n = True  # Mark the patient as assigned
-        patient.health_status_history.append(('pre-surgery', patient.health_status))  # Have patient record their pre-surgery health status
+        patient.record_health('pre-surgery', self.model.schedule.steps)  # Have patient record their pre-surgery health status
+        additive_adoption_preference = self.get_additive_adoption_preference()
+        # Use a random number to determine if the patient will go to additive or subtractive
+        routing = self.model.streams.random["routing"]  # Picks among several manufacturers of the chosen type
+        if self.routing_draws.draw() < additive_adoption_preference:
+            chosen_manufacturer = self.model.manufacturer_registry.choose('additive', routing)
+        else:
+            chosen_manufacturer = self.model.manufacturer_registry.choose('subtractive', routing)
+
+        # Patient reserves implant on assignment
+        chosen_manufacturer.order_implant(1)  # Order implant from manufacturer
+        patient.manufacturer_id = chosen_manufacturer.unique_id  # Record the manufacturer ID, provider will take this from patient
+        self.model.run_metrics.patient_assigned(self.model.manufacturer_registry.position(patient.manufacturer_id),
+                                                patient.health_status)
+
+    def get_additive_adoption_preference(self):
         health_states = self.get_patient_health_states()  # Get the health states
 
         # Calculate the total rate of improvement for each manufacturer
@@ -31,18 +78,8 @@ class HealthcareProviderAgent(Agent):
         if additive_manufacturer_rate == 0:
             additive_manufacturer_rate = 1
         # Adjust the additive_adoption_preference based on the rates
-        additive_adoption_preference = (self.model.additive_adoption_preference * additive_manufacturer_rate)
         # print("Additive Rate: ", additive_manufacturer_rate)
-        # print("Additive Adoption Preference: ", additive_adoption_preference)
-        # Use a random number to determine if the patient will go to additive or subtractive
-        if random.random() < additive_adoption_preference:
-            chosen_manufacturer = next((m for m in self.model.manufacturers if m.type_of_manufacturer == 'additive'), None)
-        else:
-            chosen_manufacturer = next((m for m in self.model.manufacturers if m.type_of_manufacturer == 'subtractive'), None)
-
-        # Patient reserves implant on assignment
-        chosen_manufacturer.order_implant(1)  # Order implant from manufacturer
-        patient.manufacturer_id = chosen_manufacturer.unique_id  # Record the manufacturer ID, provider will take this from patient
+        return self.model.additive_adoption_preference * additive_manufacturer_rate
 
     # Surgery ---------------------------------------------------------------------------------------
     def record_surgery(self):
@@ -51,23 +88,15 @@ class HealthcareProviderAgent(Agent):
 
     def perform_surgery(self, patient):  # TODO make this different for manufacturer (i.e., type of implant)
         # Check if the manufacturer has inventory
-        chosen_manufacturer = next((m for m in self.model.manufacturers if m.unique_id == patient.manufacturer_id), None)
+        chosen_manufacturer = self.model.manufacturer_registry.get(patient.manufacturer_id)
         if chosen_manufacturer.inventory > 0:
             chosen_manufacturer.deliver_implant(1)  # Get implant from manufacturer
             self.surgeries_performed_step += 1  # Increment surgeries_performed
+            self.cumulative_surgeries_performed += 1
             self.record_surgery()  # Record the surgery
-            outcome_probabilities = {
-                "minimal": 0.5,
-                "moderate": 0.30,
-                "severe": 0.1,
-                "crippled": 0.05,
-                "bedbound": 0.05
-            }
-            patient.health_status = random.choices(
-                population=list(outcome_probabilities.keys()),
-                weights=list(outcome_probabilities.values()),
-                k=1
-            )[0]
+            first_surgery = patient.step_received_treatment is None  # Urgent re-surgery patients are already in all_patients
+            health_before_surgery = patient.health_status
+            patient.health_status = self.surgery_outcomes.outcome(patient.draw("surgery"))  # With outcome_probabilities
 
             # Record the step when the patient received treatment
             patient.step_received_treatment = self.model.schedule.steps
@@ -76,96 +105,107 @@ class HealthcareProviderAgent(Agent):
             patient.received_surgery = True
             patient.needs_urgent_surgery = False  # Reset urgent surgery flag, ok since those receiving regular surgery will be FALSE anyway
             # Record the step when the patient received surgery and their post-surgery health status
-            patient.health_status_history.append(('post-surgery', patient.health_status))  # Record post-surgery health status, if second post-surgery in history means they received urgent surgery
+            patient.record_health('post-surgery', self.model.schedule.steps)  # Record post-surgery health status, if second post-surgery in history means they received urgent surgery
             # Remove patient from surgery_patients list after surgery
             self.surgery_patients.remove(patient)  # Remove patient from surgery_patients list after surgery
-            # Add patient to all_patients list after surgery
-            self.all_patients.append(patient)
+            # Add patient to all_patients list after their first surgery
+            if first_surgery:
+                self.all_patients[patient] = None
+            self.update_outcome_statistics(patient)
+            self.model.run_metrics.health_changed(self.model.manufacturer_registry.position(patient.manufacturer_id),
+                                                  health_before_surgery, patient.health_status)
+            self.model.note_patient_event(patient, "surgery")
+            if patient.health_status != health_before_surgery:
+                self.model.note_patient_event(patient, "health change")
             # Finally, schedule all the follow-ups
-            patient.follow_up_steps = [self.model.schedule.steps + interval for interval in self.follow_up_intervals]
+            patient.follow_up_steps = tuple(self.model.schedule.steps + interval for interval in self.follow_up_intervals)
             # Then set the next follow-up for the patient using the follow_up_steps list and next_follow_up_index
-            patient.next_follow_up = patient.follow_up_steps.pop(patient.next_follow_up_index)
+            patient.next_follow_up_index = 0
+            patient.next_follow_up = patient.follow_up_steps[patient.next_follow_up_index]
+            self.follow_up_calendar.schedule(patient.next_follow_up, patient)
 
     # Follow-up -------------------------------------------------------------------------------------
     def perform_follow_up(self, patient):
+        if self.model.profiler is not None:
+            self.model.profiler.count("follow_ups")
         patient.next_follow_up_index += 1  # Increment next_follow_up_index, so we can get the patient's next follow-up step at the end of the method
+        health_before_follow_up = patient.health_status
 
-        improvement_probabilities = {
-            "improved": 0.33,
-            "stable": 0.62,
-            "worse": 0.05
-        }
-
-        new_status = random.choices(
-            population=list(improvement_probabilities.keys()),
-            weights=list(improvement_probabilities.values()),
-            k=1
-        )[0]
+        new_status = self.follow_up_changes.outcome(patient.draw("follow_up"))  # With improvement_probabilities
 
         if new_status == "improved":  # Chance for health_state to move to better if not already minimal
-            if patient.health_status != "minimal":
-                patient.health_status = "minimal"
+            if patient.health_status != HealthState.MINIMAL:
+                patient.health_status = HealthState.MINIMAL
         elif new_status == "worse":  # Chance for health_state to move to worse if not already bedbound
-            if patient.health_status != "bedbound":
-                patient.health_status = "bedbound"
+            if patient.health_status != HealthState.BEDBOUND:
+                patient.health_status = HealthState.BEDBOUND
                 # Determine if patient needs urgent surgery for those who got worse
                 
                 # Check manufacturer_id for patient
-                chosen_manufacturer = next((m for m in self.model.manufacturers if m.unique_id == patient.manufacturer_id), None)
+                chosen_manufacturer = self.model.manufacturer_registry.get(patient.manufacturer_id)
                 if chosen_manufacturer.type_of_manufacturer == 'additive':
                     ae_chance = self.model.ae_probability_additive
                 else:
                     ae_chance = self.model.ae_probability_subtractive
-                if random.random() < ae_chance:  # 50% chance of needing urgent surgery
+                if patient.draw("adverse_events") < ae_chance:  # 50% chance of needing urgent surgery
                     patient.needs_urgent_surgery = True
                     patient.received_surgery = False
                     self.surgery_patients.append(patient)  # Add patient back to surgery_patients list for urgent surgery
 
         # Update patient's health_status_history
-        patient.health_status_history.append(('follow-up at step ' + str(self.model.schedule.steps),
-                                              patient.health_status))  # Record follow-up health status with model step
-        # Schedule the next follow-up based on the patient's follow_up_steps list
-        patient.next_follow_up = patient.follow_up_steps.pop(patient.next_follow_up_index)
+        patient.record_health('follow-up', self.model.schedule.steps)  # Record follow-up health status with model step
+        self.update_outcome_statistics(patient)
+        self.model.run_metrics.health_changed(self.model.manufacturer_registry.position(patient.manufacturer_id),
+                                              health_before_follow_up, patient.health_status)
+        self.model.note_patient_event(patient, "follow-up")
+        if patient.health_status != health_before_follow_up:
+            self.model.note_patient_event(patient, "health change")
+        if patient.needs_urgent_surgery and not patient.received_surgery:
+            self.model.note_patient_event(patient, "urgent")
+        # Schedule the next follow-up based on the patient's follow_up_steps list, None once all are done
+        if patient.next_follow_up_index < len(patient.follow_up_steps):
+            patient.next_follow_up = patient.follow_up_steps[patient.next_follow_up_index]
+            self.follow_up_calendar.schedule(patient.next_follow_up, patient)
+        else:
+            patient.next_follow_up = None
+            if not patient.needs_urgent_surgery:  # Nothing more will happen to this patient
+                self.model.note_finished_patient(patient)
 
     # Analysis --------------------------------------------------------------------------------------
-    # This method summarizes the before and after health states for each manufacturer. Only the last health status and
-    # second to last is considered for each patient. Then the counts turned into rates for each manufacturer to determine
-    # the effectiveness of the implants.
+    # These methods summarize the before and after health states for each manufacturer. Only the last health status and
+    # second to last is considered for each patient. The counts are kept up to date whenever a surgery or follow-up adds
+    # to a patient's history, then turned into rates for each manufacturer to determine the effectiveness of the implants.
+    def update_outcome_statistics(self, patient):
+        before_health_state, after_health_state = patient.last_health_states()  # Second to last and last health state
+
+        # Compare the before and after health states and categorize them (lower is better)
+        if before_health_state == after_health_state:
+            category = "same"
+        elif before_health_state > after_health_state:
+            category = "improved"
+        else:
+            category = "worsened"
+
+        # Move this patient's count from their previous category to the new one
+        if patient.manufacturer_id not in self.outcome_counts:
+            self.outcome_counts[patient.manufacturer_id] = {"same": 0, "improved": 0, "worsened": 0}
+        if patient.outcome_category is not None:
+            self.outcome_counts[patient.manufacturer_id][patient.outcome_category] -= 1
+        self.outcome_counts[patient.manufacturer_id][category] += 1
+        patient.outcome_category = category
+
     def get_patient_health_states(self):
+        if self.model.profiler is not None:
+            self.model.profiler.count("health_state_queries")
         health_states = {}
-        health_state_order = ["minimal", "moderate", "severe", "crippled", "bedbound"]  # Define the order of health states
-
-        for patient in self.all_patients:
-            manufacturer_id = patient.manufacturer_id
-            before_health_state = patient.health_status_history[-2][1]  # Get the second to last health state
-            after_health_state = patient.health_status_history[-1][1]  # Get the last health state
-
-            # Compare the before and after health states and categorize them
-            if before_health_state is None or before_health_state == after_health_state:
-                category = "same"
-            elif health_state_order.index(before_health_state) > health_state_order.index(after_health_state):
-                category = "improved"
-            else:
-                category = "worsened"
-
-            # Increment the count of this category for this manufacturer
-            if manufacturer_id not in health_states:
-                health_states[manufacturer_id] = {"same": 0, "improved": 0, "worsened": 0}
-            health_states[manufacturer_id][category] += 1
-
         # Convert counts to rates
-        for manufacturer_id, categories in health_states.items():
+        for manufacturer_id, categories in self.outcome_counts.items():
             total = sum(categories.values())
-            for category, count in categories.items():
-                health_states[manufacturer_id][category] = count / total
-
+            health_states[manufacturer_id] = {category: count / total for category, count in categories.items()}
         return health_states
 
     def get_cumulative_surgeries_performed(self):
-        surgeries_performed = 0
-        for patient in self.all_patients:
-            surgeries_performed += sum(1 for status in patient.health_status_history if status[0] == 'post-surgery')
-        return surgeries_performed
+        return self.cumulative_surgeries_performed
 
     # Step ------------------------------------------------------------------------------------------
     def step(self):
@@ -177,9 +217,9 @@ class HealthcareProviderAgent(Agent):
         # Handle regular surgery
         for patient in [p for p in self.surgery_patients if not p.needs_urgent_surgery]:
             self.perform_surgery(patient)
-        # Handle follow-ups
-        for patient in [p for p in self.all_patients if p.received_surgery]:
-            if self.model.schedule.steps == patient.next_follow_up:
+        # Handle follow-ups due this step, skipping stale appointments and patients waiting for urgent surgery
+        for patient in self.follow_up_calendar.pop_due(self.model.schedule.steps):
+            if patient.received_surgery and self.model.schedule.steps == patient.next_follow_up:
                 self.perform_follow_up(patient)
 
         # Update patient_capacity
@@ -1,92 +1,206 @@
 import mesa
 from mesa.time import RandomActivation
+import numpy as np
 import pandas as pd
 # Import your agent classes
 from manufacturer_agent import ManufacturerAgent
 from healthcare_provider_agent import HealthcareProviderAgent
-from patient_agent import PatientAgent
-import random
+from patient_agent import PatientAgent, HealthState, HEALTH_STATES
+from cohort_engine import PatientCohort, CohortHealthcareProviderAgent
+from data_recorder import DataRecorder
+from event_log import PATIENT_EVENTS, PATIENT_EVENT_BITS, event_bits
+from random_streams import RandomStreams
+from variate_supply import VariateSupply, CategoricalTable
+from provider_assignment import ProviderAssignment
+from waiting_queue import WaitingQueue
+from model_log import ModelLog
+from manufacturer_registry import ManufacturerRegistry
+from patient_archive import PatientArchive
+from run_metrics import RunMetrics
 
 class ImplantMarketModel(mesa.Model):
-    def __init__(self, num_providers, initial_num_patients, patient_incidence, additive_adoption_preference, ae_probability_additive, ae_probability_subtractive):  
+    def __init__(self, num_providers, initial_num_patients, patient_incidence, additive_adoption_preference, ae_probability_additive, ae_probability_subtractive, engine="agent", recorder=None, record_mode="snapshot", seed=None, assignment_policy="random", queue_policy="fifo", log_level="silent", log_stream=None, metrics_sink=None, profiler=None, manufacturer_types=("additive", "subtractive"), retire_patients=True, patient_id_prefix=""):
         super().__init__()
+        # All draws come from the model's own seeded substreams, see RandomStreams
+        self.streams = RandomStreams(seed)
+        self.seed = self.streams.seed  # Pass as seed to repeat this run
+        self.random = self.streams.random["schedule"]  # Used by RandomActivation to shuffle the agents
+        # Per-event draws of PatientAgent mode come in blocks from the streams' NumPy Generators, see VariateSupply
+        self.variates = VariateSupply(self.streams)
+        self.spawn_health = self.variates.categorical("spawning", CategoricalTable(
+            [HealthState.SEVERE, HealthState.CRIPPLED, HealthState.BEDBOUND], [1, 1, 1]))  # Initial health of a new patient
+        if engine not in ("agent", "cohort"):
+            raise ValueError(f"Unknown engine {engine!r}, expected 'agent' or 'cohort'")
+        self.engine = engine  # "agent" for one PatientAgent per patient, "cohort" for the NumPy PatientCohort
+        if record_mode not in ("snapshot", "events", "summary"):
+            raise ValueError(f"Unknown record_mode {record_mode!r}, expected 'snapshot', 'events' or 'summary'")
+        # "snapshot" records every patient every step, "events" only their changes, "summary" no patient rows at all
+        # (run_metrics still has the summaries)
+        self.record_mode = record_mode
+        self.log = ModelLog(log_level, log_stream)  # "silent" (no per-step output), "info" or "verbose", see ModelLog
+        self.metrics_sink = metrics_sink  # Receives each step's metrics when set, see model_log.py
+        self.profiler = profiler  # Times the phases of each step when set, see StepProfiler
         self.additive_adoption_preference = additive_adoption_preference
         self.ae_probability_additive = ae_probability_additive
         self.ae_probability_subtractive = ae_probability_subtractive
         self.schedule = RandomActivation(self)
         self.manufacturers = []
         self.providers = []
-        self.patients = []
+        self.provider_by_id = {}  # unique_id: provider, finds a retiring patient's provider
+        # Active PatientAgents as the keys of a dict, in spawn order, so a retiring patient is removed in O(1), see
+        # retire_patients
+        self.patients = {}
+        self.patient_id_prefix = patient_id_prefix  # Prepended to patient ids, keeps them unique across the regions of a ShardedSimulation
+        # Patients past their last follow-up are moved out of the schedule, patients and provider all_patients into
+        # the archive at the end of the step they finish in. The cohort engine keeps their rows and only drops them from
+        # the providers' all_patients, see CohortHealthcareProviderAgent.perform_follow_ups
+        self.retire_patients = retire_patients
+        self.finished_patients = []  # Finished this step, archived at the end of the step
+        self.patient_archive = PatientArchive(keep_rows=record_mode != "summary")
+        self.patients_spawned = 0  # Initial and spawned PatientAgents, numbers the new patient ids
         self.patient_incidence = patient_incidence
+        self.new_patients_count = 0  # Patients spawned in the current step
         self.patients_waiting = []
-        # For tracking patients needing assignment
-        self.patients_needing_surgery = []
-        # For recording data
-        self.manufacturer_rows = []
-        self.provider_rows = []
-        self.patient_rows = []
-
-        # Create one additive and one subtractive manufacturer
-        additive_manufacturer = ManufacturerAgent(0, self, 'additive', 1.0)
-        subtractive_manufacturer = ManufacturerAgent(1, self, 'subtractive', 1.0)
+        # For tracking patients needing assignment, pushed on spawn and popped on assignment ("fifo", "longest_waiting"
+        # or "most_severe" first)
+        self.queue_policy = queue_policy
+        self.patients_needing_surgery = WaitingQueue(queue_policy, self.waiting_priority(queue_policy))
+        # For recording data, kept in memory unless a recorder writing to disk is passed in
+        self.recorder = DataRecorder() if recorder is None else recorder
+        self.patient_events = {} if record_mode == "events" else None  # PatientAgent: bitmask of events this step
+
+        # Create one manufacturer per entry of manufacturer_types, by default one additive and one subtractive
+        # manufacturer. Providers look them up by id or type in the registry
+        self.manufacturer_registry = ManufacturerRegistry()
+        for type_of_manufacturer in manufacturer_types:
+            manufacturer = ManufacturerAgent(len(self.manufacturers), self, type_of_manufacturer, 1.0)
+            self.manufacturers.append(manufacturer)
+            self.manufacturer_registry.add(manufacturer)
+            self.add_to_schedule(manufacturer)
         # self.manufacturer_cumulative_outcomes = {
         #     0: {"minimal": 0, "moderate": 0, "severe": 0, "crippled": 0, "bedbound": 0},
         #     1: {"minimal": 0, "moderate": 0, "severe": 0, "crippled": 0, "bedbound": 0}}
-        self.manufacturers.extend([additive_manufacturer, subtractive_manufacturer])
-        self.schedule.add(additive_manufacturer)
-        self.schedule.add(subtractive_manufacturer)
+        manufacturer_ids = [manufacturer.unique_id for manufacturer in self.manufacturers]
+        # Run summaries kept up to date as patients are assigned and change health, see RunMetrics
+        self.run_metrics = RunMetrics(manufacturer_ids)
+
+        # Recorded tables, see DataRecorder for the column kinds
+        self.recorder.add_table("manufacturer", [
+            ("step", "int32"),
+            ("manufacturer_id", "category", manufacturer_ids),
+            ("revenue", "float64"),
+            ("costs", "float64"),
+            ("profit", "float64"),
+            ("production", "int32"),
+            ("inventory", "int32")
+        ])
+        self.recorder.add_table("provider", [
+            ("step", "int32"),
+            ("provider_id", "int32"),
+            ("surgery_patients", "int32"),
+            ("cumulative_patients", "int32"),
+            ("additive_preference", "float64")
+        ])
+        if record_mode != "summary":
+            patient_table = "patient" if record_mode == "snapshot" else "patient_events"
+            self.recorder.add_table(patient_table, [
+                ("step", "int32"),
+                ("patient_id", "string")
+            ] + ([] if record_mode == "snapshot" else [("event", "category", PATIENT_EVENTS)]) + [
+                ("health_status", "category", HEALTH_STATES),
+                ("received_surgery", "bool"),
+                ("days_waiting_for_surgery", "int32"),
+                ("step_received_treatment", "nullable_int32"),
+                ("manufacturer_id", "category", manufacturer_ids),
+                ("next_follow_up", "nullable_int32"),
+                ("needs_urgent_surgery", "bool"),
+                ("step_followup_treatment", "nullable_int32")
+            ])
 
         # Create Healthcare Provider Agents
+        provider_class = CohortHealthcareProviderAgent if engine == "cohort" else HealthcareProviderAgent
         for i in range(num_providers):
-            provider = HealthcareProviderAgent(i + 2, self)  # Create a new provider
+            provider = provider_class(i + len(self.manufacturers), self)  # Create a new provider
             self.providers.append(provider)  # Add to provider list
-            self.schedule.add(provider)  # Add to model schedule so that each step it will be active
+            self.provider_by_id[provider.unique_id] = provider
+            self.add_to_schedule(provider)  # Add to model schedule so that each step it will be active
+        # Assigns waiting patients to providers with capacity left, "random" or "least_loaded"
+        self.provider_assignment = ProviderAssignment(self.providers, self.streams.generator["assignment"],
+                                                      assignment_policy)
+
+        # Create Patient Agents, or their rows in the cohort (cohort patients are not on the schedule)
+        self.cohort = None
+        if engine == "cohort":
+            self.cohort = PatientCohort(self)
+            self.cohort.spawn([self.patient_id(j + num_providers + len(self.manufacturers))
+                               for j in range(initial_num_patients)])
+        else:
+            for j in range(initial_num_patients):
+                patient = PatientAgent(self.patient_id(j + num_providers + len(self.manufacturers)), self)  # Create a new patient
+                self.patients_spawned += 1
+                self.patients[patient] = None  # Add to patient list
+                self.add_to_schedule(patient)  # Add to model schedule so that each step it will be active
+                self.patients_needing_surgery.push(patient)
+                self.note_patient_event(patient, "spawn")
 
-        # Create Patient Agents
-        for j in range(initial_num_patients):
-            patient = PatientAgent(j + num_providers + 2, self)  # Create a new patient
-            self.patients.append(patient)  # Add to patient list
-            self.schedule.add(patient)  # Add to model schedule so that each step it will be active
+    def add_to_schedule(self, agent):
+        self.schedule.add(agent)
+        if self.profiler is not None:
+            self.profiler.instrument(agent)
 
     def try_spawn_patient(self):
-        new_patients_count = random.randint(0, self.patient_incidence)
-        for _ in range(new_patients_count):
-            new_patient_id = "Patient_" + str(len(self.patients) + 1)
-            new_patient = PatientAgent(new_patient_id, self)
-            self.schedule.add(new_patient)
-            self.patients.append(new_patient)
-            #print(f"New patient {new_patient_id} spawned") # Uncomment if want to see each individual patient spawned
-        if new_patients_count > 0:
-            print(f"{new_patients_count} new patients spawned this step")
+        new_patients_count = self.streams.random["spawning"].randint(0, self.patient_incidence)
+        self.new_patients_count = new_patients_count
+        if self.cohort is not None:
+            self.cohort.spawn([self.patient_id("Patient_" + str(len(self.cohort) + k + 1))
+                               for k in range(new_patients_count)])
+        else:
+            for _ in range(new_patients_count):
+                new_patient_id = self.patient_id("Patient_" + str(self.patients_spawned + 1))
+                new_patient = PatientAgent(new_patient_id, self)
+                self.patients_spawned += 1
+                self.add_to_schedule(new_patient)
+                self.patients[new_patient] = None
+                self.patients_needing_surgery.push(new_patient)
+                self.note_patient_event(new_patient, "spawn")
+                #print(f"New patient {new_patient_id} spawned") # Uncomment if want to see each individual patient spawned
+        if new_patients_count > 0 and self.log.info_enabled:
+            self.log.write(f"{new_patients_count} new patients spawned this step")
 
     def step(self):
-        print(f"Current step: {self.schedule.steps}")
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.start_step(self.schedule.steps)
+        if self.log.info_enabled:
+            self.log.write(f"Current step: {self.schedule.steps}")
 
         # Try to spawn new patients
         self.try_spawn_patient()
+        if profiler is not None:
+            profiler.lap("spawn")
 
-        # Update the list of patients needing surgery who are not assigned yet
-        self.patients_needing_surgery = [p for p in self.patients if not p.assigned_y_n]
-
-        # ---------------------------------------------------------------------------------------------
-        # Assign patients to providers
-        for patient in self.patients_needing_surgery:
-            available_providers = [provider for provider in self.providers if len(provider.surgery_patients) < provider.patient_max_capacity]
-            if available_providers:
-                provider = random.choice(available_providers)  # Select a provider randomly from the list of available providers
-                patient.provider_id = provider.unique_id  # Assign the provider ID to the patient
-                provider.surgery_patients.append(patient)  # Add patient to surgery_patients list first
-                provider.admit_patient(patient)  # Provider will then assign the patient to a manufacturer
-                self.patients_needing_surgery.remove(patient)  # Remove patient from master list of patients needing surgery
-
-        # ---------------------------------------------------------------------------------------------
-        # Execute all agents' step methods
-        self.schedule.step()
+        if self.cohort is not None:
+            # Assign waiting cohort rows to providers, run manufacturers and providers, then count the day of
+            # waiting for every patient in one batch
+            self.patients_needing_surgery = self.cohort.assign_patients()
+            waiting = self.cohort.waiting_mask()
+            if profiler is not None:
+                profiler.lap("assignment")
+            self.schedule.step()
+            if profiler is not None:
+                profiler.lap("agents")
+            self.cohort.advance_waiting(waiting)
+            if profiler is not None:
+                profiler.lap("waiting")
+        else:
+            self.agent_step()
 
         # ---------------------------------------------------------------------------------------------
         # Record data for each agent at every step
-        print(f"Patients waiting for surgery: {len(self.patients_needing_surgery)}")
+        if self.log.info_enabled:
+            self.log.write(f"Patients waiting for surgery: {len(self.patients_needing_surgery)}")
 
+        manufacturer_rows = []
         for manufacturer in self.manufacturers:
             new_row = {
                 "step": self.schedule.steps,
@@ -94,42 +208,213 @@ class ImplantMarketModel(mesa.Model):
                 "revenue": round(manufacturer.sales_revenue, 2),
                 "costs": round(manufacturer.get_costs(), 2),
                 "profit": round(manufacturer.get_profit(), 2),
-                "production": manufacturer.production_history,
+                "production": manufacturer.implants_produced,
                 #"orders": manufacturer.total_orders,
                 "inventory": manufacturer.inventory#,
                 #"pending": manufacturer.pending_implants,
                 #"production_steps": manufacturer.next_production_steps
             }
-            print(f"Manufacturer new_row: {new_row}")
-            self.manufacturer_rows.append(new_row)
+            if self.log.verbose_enabled:
+                self.log.write(f"Manufacturer new_row: {new_row}")
+            self.recorder["manufacturer"].append_dict(new_row)
+            manufacturer_rows.append(new_row)
 
+        provider_rows = []
         for provider in self.providers:
             new_row = {
                 "step": self.schedule.steps,
                 "provider_id": provider.unique_id,
                 #"surgeries_performed": provider.surgeries_performed_step,
                 "surgery_patients": len(provider.surgery_patients),
-                "cumulative_patients": len(provider.all_patients),
+                "cumulative_patients": len(provider.all_patients) + provider.retired_patients,
                 "additive_preference": self.additive_adoption_preference
             }
-            print(f"Provider new_row: {new_row}")
-            self.provider_rows.append(new_row)
+            if self.log.verbose_enabled:
+                self.log.write(f"Provider new_row: {new_row}")
+            self.recorder["provider"].append_dict(new_row)
+            provider_rows.append(new_row)
 
-        for patient in self.patients:
-            new_row = {
+        self.run_metrics.end_step(self.schedule.steps, manufacturer_rows)
+        if self.metrics_sink is not None:
+            self.metrics_sink.emit({
                 "step": self.schedule.steps,
-                "patient_id": patient.unique_id,
-                "health_status": patient.health_status,
-                "received_surgery": patient.received_surgery,
-                "days_waiting_for_surgery": patient.days_waiting_for_surgery,
-                "step_received_treatment": patient.step_received_treatment,
-                "manufacturer_id": patient.manufacturer_id,
-                #"days_since_surgery": patient.days_since_surgery,
-                "next_follow_up": patient.next_follow_up,
-                #"change_state": patient.change_state,
-                "needs_urgent_surgery": patient.needs_urgent_surgery,
-                "step_followup_treatment": patient.step_followup_treatment
-            }
-            self.patient_rows.append(new_row)
+                "new_patients": self.new_patients_count,
+                "patients_waiting": len(self.patients_needing_surgery),
+                "manufacturers": manufacturer_rows,
+                "providers": provider_rows,
+                # Average utility of each manufacturer's patients, None while a manufacturer has none
+                "utility": [None if np.isnan(utility) else float(utility)
+                            for utility in self.run_metrics.utility_values[-1].tolist()]
+            })
+
+        if self.record_mode == "events":
+            self.record_patient_events()
+        elif self.record_mode == "snapshot":
+            if self.cohort is not None:
+                self.cohort.record(self.recorder["patient"], self.schedule.steps)
+            else:
+                self.record_patients()
+        self.recorder.end_step()  # Flush any table that has filled a chunk
+        if self.finished_patients:
+            self.archive_finished_patients()
+
+        if self.log.info_enabled:
+            self.log.write("-------------------")
+        if profiler is not None:
+            profiler.end_step(self)
+
+    def agent_step(self):
+        # ---------------------------------------------------------------------------------------------
+        # Assign patients to providers, in queue order until every provider is full
+        chosen = self.provider_assignment.assign(len(self.patients_needing_surgery))
+        for patient, i in zip(self.patients_needing_surgery.pop_many(len(chosen)), chosen.tolist()):
+            provider = self.providers[i]
+            patient.provider_id = provider.unique_id  # Assign the provider ID to the patient
+            provider.surgery_patients.append(patient)  # Add patient to surgery_patients list first
+            provider.admit_patient(patient)  # Provider will then assign the patient to a manufacturer
+            self.note_patient_event(patient, "assignment")
+        if self.profiler is not None:
+            self.profiler.lap("assignment")
+
+        # ---------------------------------------------------------------------------------------------
+        # Execute all agents' step methods
+        self.schedule.step()
+        if self.profiler is not None:
+            self.profiler.lap("agents")
+
+    # Checkpoints, see checkpoint.py ----------------------------------------------------------------
+    def __getstate__(self):
+        # The recorder, log stream, metrics sink and profiler belong to the caller and are attached again on load
+        state = self.__dict__.copy()
+        state["recorder"] = None
+        state["log"] = ModelLog(self.log.level)
+        state["metrics_sink"] = None
+        state["profiler"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.cohort is None:  # The cohort sets the priority of its own queue
+            self.patients_needing_surgery.priority = self.waiting_priority(self.queue_policy)
+
+    # Patient lifecycle -----------------------------------------------------------------------------
+    def patient_id(self, unique_id):
+        return f"{self.patient_id_prefix}{unique_id}" if self.patient_id_prefix else unique_id
+
+    def patient_count(self):  # Patients spawned so far, active and archived
+        if self.cohort is not None:
+            return len(self.cohort)
+        return self.patients_spawned
+
+    def note_finished_patient(self, patient):  # Called by providers after a patient's last follow-up
+        if self.retire_patients:
+            self.finished_patients.append(patient)
+
+    def archive_finished_patients(self):  # O(finished patients), the active patients are not scanned
+        self.patient_archive.add(self.finished_patients, self.patient_columns(self.finished_patients),
+                                 self.schedule.steps)
+        for patient in self.finished_patients:
+            self.schedule.remove(patient)
+            if hasattr(patient, "remove"):  # Mesa 2.1+ also keeps every agent in the model
+                patient.remove()
+            del self.patients[patient]
+            provider = self.provider_by_id[patient.provider_id]
+            del provider.all_patients[patient]
+            provider.retired_patients += 1
+        self.finished_patients = []
+
+    # Regions, see sharded_simulation.py ------------------------------------------------------------
+    def implant_demand(self):  # Surgery patients waiting for an implant, per manufacturer position
+        demand = [0] * len(self.manufacturers)
+        for provider in self.providers:
+            for patient in provider.surgery_patients:
+                if self.cohort is not None:
+                    demand[self.cohort.manufacturer_index[patient]] += 1
+                else:
+                    demand[self.manufacturer_registry.position(patient.manufacturer_id)] += 1
+        return demand
+
+    def free_capacity(self):  # Patients the providers can still take on
+        return int(self.provider_assignment.free_capacity().clip(min=0).sum())
+
+    def release_waiting(self, count):
+        # Remove up to count unassigned patients, the last in queue order, to refer them to another region's model.
+        # Returns what admit_referrals needs to recreate them
+        if self.cohort is not None:
+            raise ValueError("Referrals between regions need engine='agent'")
+        released = self.patients_needing_surgery.pop_last(count)
+        for patient in released:
+            if self.patient_events is not None:  # Not recorded here any more, the admitting region records it
+                self.patient_events.pop(patient, None)
+            self.schedule.remove(patient)
+            if hasattr(patient, "remove"):  # Mesa 2.1+ also keeps every agent in the model
+                patient.remove()
+            del self.patients[patient]
+        return [{"unique_id": patient.unique_id, "health_status": int(patient.health_status),
+                 "step_spawned": patient.step_spawned, "days_waiting_for_surgery": patient.days_waiting_for_surgery}
+                for patient in released]
+
+    def admit_referrals(self, referrals):  # Queue patients released by another region, recorded as a referral here
+        for referral in referrals:
+            patient = PatientAgent(referral["unique_id"], self, HealthState(referral["health_status"]))
+            patient.step_spawned = referral["step_spawned"]
+            patient.days_waiting_for_surgery = referral["days_waiting_for_surgery"]
+            self.add_to_schedule(patient)
+            self.patients[patient] = None
+            self.patients_needing_surgery.push(patient)
+            self.note_patient_event(patient, "referral")
+
+    def waiting_priority(self, policy):  # Queue priority of a waiting PatientAgent, lower is assigned first
+        if policy == "longest_waiting":
+            return lambda patient: self.schedule.steps - patient.days_waiting_for_surgery  # Step the wait started
+        return lambda patient: -patient.health_status
+
+    # Recording -----------------------------------------------------------------------------------
+    def note_patient_event(self, patient, event):  # Mark an event for the event log, no-op when taking snapshots
+        if self.patient_events is not None:
+            self.patient_events[patient] = self.patient_events.get(patient, 0) | PATIENT_EVENT_BITS[event]
+
+    def patient_columns(self, patients):  # Recorded patient fields, column by column
+        manufacturer_codes = {manufacturer.unique_id: code for code, manufacturer in enumerate(self.manufacturers)}
+        return {
+            "patient_id": [patient.unique_id for patient in patients],
+            "health_status": [patient.health_status for patient in patients],  # HealthState codes
+            "received_surgery": [patient.received_surgery for patient in patients],
+            "days_waiting_for_surgery": [patient.days_waiting_for_surgery for patient in patients],
+            "step_received_treatment": [nullable(patient.step_received_treatment) for patient in patients],
+            "manufacturer_id": [manufacturer_codes.get(patient.manufacturer_id, -1) for patient in patients],
+            #"days_since_surgery": patient.days_since_surgery,
+            "next_follow_up": [nullable(patient.next_follow_up) for patient in patients],
+            #"change_state": patient.change_state,
+            "needs_urgent_surgery": [patient.needs_urgent_surgery for patient in patients],
+            "step_followup_treatment": [nullable(patient.step_followup_treatment) for patient in patients]
+        }
+
+    def record_patients(self):  # Record one row per patient, archived patients included
+        columns = self.patient_columns(self.patients)
+        columns["step"] = [self.schedule.steps] * len(self.patients)
+        self.recorder["patient"].append_columns(columns)
+        if len(self.patient_archive):
+            archived = dict(self.patient_archive.columns)
+            archived["step"] = [self.schedule.steps] * len(self.patient_archive)
+            self.recorder["patient"].append_columns(archived)
+
+    def record_patient_events(self):  # Record one row per event noted this step, with the patient's current state
+        if self.cohort is not None:
+            self.cohort.record_events(self.recorder["patient_events"], self.schedule.steps)
+            return
+        patients = []
+        events = []
+        for patient, events_mask in self.patient_events.items():
+            for event in event_bits(events_mask):
+                patients.append(patient)
+                events.append(event)
+        columns = self.patient_columns(patients)
+        columns["step"] = [self.schedule.steps] * len(patients)
+        columns["event"] = events
+        self.recorder["patient_events"].append_columns(columns)
+        self.patient_events.clear()
+
 
-        print("-------------------")
\ No newline at end of file
+def nullable(value):  # Recorded nullable ints use -1 for None
+    return -1 if value is None else value
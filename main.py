@@ -1,5 +1,7 @@
 from implant_market_model import ImplantMarketModel
-import pandas as pd
+from data_recorder import DataRecorder
+from step_profiler import StepProfiler
+from result_cache import ResultCache
 
 
 def main():
@@ -10,67 +12,67 @@ def main():
     time_period = 200   # 1 step = 1 day, so 10 years 3650
     additive_adoption_preference = 0.5  # Used in provider agent, starts at 50% preference for additive manufacturing
     # to be modified over time
-    ae_probability = 0.3  # Probability of adverse events
+    ae_probability_additive = 0.3  # Probability of adverse events (silicon nitride)
+    ae_probability_subtractive = 0.3  # Probability of adverse events (titanium)
+    log_level = "silent"  # "info" prints each step's counts, "verbose" also the recorded rows, see ModelLog
+    profile = False  # Time each phase of the step, report written to model_output/profile
+    seed = 0  # Seeded runs are reproducible and cached, None for a fresh random run every time
+    use_cache = True  # Reuse the results of an earlier run with the same parameters, seed and model code
 
-    # Create and run the model
-    model = ImplantMarketModel(num_providers, initial_num_patients, patient_incidence, additive_adoption_preference, ae_probability)
-    for i in range(time_period):  # Run for x steps
-        model.step()  # Run the steps outlined in implantmarketmodel
+    # The model is built from these same arguments, so the cache key always matches the run
+    model_params = {
+        "num_providers": num_providers,
+        "initial_num_patients": initial_num_patients,
+        "patient_incidence": patient_incidence,
+        "additive_adoption_preference": additive_adoption_preference,
+        "ae_probability_additive": ae_probability_additive,
+        "ae_probability_subtractive": ae_probability_subtractive,
+        "seed": seed,
+        "engine": "agent",
+        "record_mode": "events"
+    }
+    run_params = {**model_params, "time_period": time_period}
+    cache = ResultCache() if use_cache and seed is not None and not profile else None
+    cache_key = cache.key(run_params) if cache is not None else None
+    cached_run = cache.load(cache_key) if cache is not None else None
+
+    if cached_run is not None:
+        print(f"Loaded cached run from {cached_run.entry_dir}")
+        summaries = cached_run.summaries
+    else:
+        # Recorded data is streamed to Parquet chunks for the manufacturer, provider and patient_events tables, under
+        # model_output or in the cache entry. Patients are recorded as an event log (only the steps something
+        # happened to them), see event_log.py
+        staging_dir = cache.staging_dir() if cache is not None else None
+        recorder = DataRecorder(cache.recorder_dir(staging_dir) if cache is not None else "model_output",
+                                file_format="parquet")
 
-    # Write the DataFrames to CSV files after the model has finished running
-    manufacturer_data = pd.DataFrame(model.manufacturer_rows)
-    manufacturer_data.to_csv('manufacturer_data.csv', index=False)
-    provider_data = pd.DataFrame(model.provider_rows)
-    provider_data.to_csv('provider_data.csv', index=False)
-    patient_data = pd.DataFrame(model.patient_rows)
-    patient_data.to_csv('patient_data.csv', index=False)
+        # Create and run the model
+        profiler = StepProfiler() if profile else None
+        model = ImplantMarketModel(**model_params, recorder=recorder, profiler=profiler, log_level=log_level)
+        for i in range(time_period):  # Run for x steps
+            model.step()  # Run the steps outlined in implantmarketmodel
+        recorder.close()  # Write the last partial chunks
+        if profiler is not None:
+            profiler.write_report("model_output/profile")
+            print(profiler.report())
+
+        # Summaries the model kept up to date during the run, see RunMetrics
+        summaries = model.run_metrics.summaries()
+        if cache is not None:
+            cache.store(cache_key, staging_dir, run_params, summaries)
 
     # Printout model summaries
-    manufacturer_summary = manufacturer_data.groupby('manufacturer_id').agg({
-        'revenue': 'sum',
-        'costs': 'sum',
-        'profit': 'sum'#,
-        #'implants_produced': 'sum'
-    })
     print("Manufacturer Summary:")
-    print(manufacturer_summary)
+    print(summaries["manufacturer_summary"])
 
     # Add summary for patient_data grouped by health_state and manufacturer_id
-    # Filter for the last step
-    final_step = patient_data['step'].max()
-    final_step_data = patient_data[patient_data['step'] == final_step]
-    patient_health_summary = final_step_data.groupby(['manufacturer_id', 'health_status']).size().reset_index(
-        name='counts')
     print("\nPatient Health Summary:")
-    print(patient_health_summary)
-
-    # Add utility values
-    utility_values = {
-        'minimal': 0.84,
-        'moderate': 0.61,
-        'severe': 0.55,
-        'crippled': 0.51,
-        'bedbound': 0.5
-    }
-    # Map health_status to utility values and multiply by counts
-    patient_health_summary['total_utility'] = patient_health_summary['health_status'].map(utility_values) * \
-                                              patient_health_summary['counts']
-
-    # Calculate total utility for each manufacturer
-    manufacturer_total_utility = patient_health_summary.groupby('manufacturer_id')['total_utility'].sum()
-    # print(manufacturer_total_utility)
-
-    # Calculate total number of patients for each manufacturer
-    manufacturer_patient_counts = patient_health_summary.groupby('manufacturer_id')['counts'].sum()
-    # print(manufacturer_patient_counts)
-
-    # Calculate average utility for each manufacturer
-    average_utility = manufacturer_total_utility / manufacturer_patient_counts.astype(float)
-    average_utility = average_utility.reset_index()
-    average_utility.columns = ['manufacturer_id', 'average_utility']
+    print(summaries["patient_health_summary"])
 
+    # Average utility for each manufacturer, see UTILITY_VALUES in summaries.py
     print("\nAverage Utility Summary:")
-    print(average_utility)
+    print(summaries["average_utility"])
 
 
 if __name__ == "__main__":
@@ -1,4 +1,9 @@
 from mesa import Agent
+from production_pipeline import ProductionPipeline
+
+LEAD_TIMES = {"additive": 1, "subtractive": 2}  # Steps from scheduling production to implants in inventory
+BASE_PRODUCTION_COST = 10  # Example base cost
+PROFIT_MARGIN = 0.3  # Example profit margin
 
 # Define ManufacturerAgent
 # On-time manufacturing of implants for additive, silicon nitride, means that implants can be produced immediately
@@ -10,37 +15,39 @@ from mesa import Agent
 # TODO add chance of machine breakdowns
 class ManufacturerAgent(Agent):
 
-    def __init__(self, unique_id, model, type_of_manufacturer, cost_modifier):
+    def __init__(self, unique_id, model, type_of_manufacturer, cost_modifier, lead_time=None):
         super().__init__(unique_id, model)
         self.type_of_manufacturer = type_of_manufacturer  # Either additive or subtractive
         self.machines = 2
         # self.initial_inventory = 0 # Define initial inventory
         self.inventory = 0
         self.total_orders = 0  # Keep track of total orders
-        self.base_production_cost = 10  # Example base cost
+        self.implants_ordered = 0  # Orders over the whole run
+        self.base_production_cost = BASE_PRODUCTION_COST  # Example base cost
         self.cost_modifier = cost_modifier  # How much cheaper should subtractive be, set in main
         self.adjusted_production_cost = self.base_production_cost * self.cost_modifier
         self.production_capacity = 100  # Example capacity to replenish inventory, per machine
         self.sales_revenue = 0
-        self.profit_margin = 0.3  # Example profit margin
+        self.profit_margin = PROFIT_MARGIN  # Example profit margin
         #self.production_strategy = lambda step: 1 if step % 2 == 0 else 0.5  # Example strategy
         self.pending_implants = 0  # Record the number of implants to produce in a future step
         self.next_production_steps = 0  # Record the step when implants will be produced
-        self.production_history = {}
+        self.lead_time = LEAD_TIMES[type_of_manufacturer] if lead_time is None else lead_time
+        self.production_pipeline = ProductionPipeline(self.lead_time)  # Implants scheduled and not produced yet
+        self.implants_produced = 0  # Implants produced in the current step
 
     def schedule_implant_production(self):  # Schedule implants to be produced in future steps only if there are orders
         # ... (existing code)
-        if self.type_of_manufacturer == 'subtractive':
-            self.production_history[self.model.schedule.steps + 2] = self.total_orders  # Change this line
-        else:
-            self.production_history[self.model.schedule.steps + 1] = self.total_orders  # Change this line
+        self.production_pipeline.schedule(self.model.schedule.steps, self.total_orders)  # Ready after lead_time steps
         self.total_orders = 0  # Reset total orders
 
     def produce_implant(self, quantity):  # Produce implants and store in inventory
         self.inventory += quantity  # Add implants to inventory
+        self.implants_produced += quantity
 
     def order_implant(self, quantity):
         self.total_orders += quantity  # Increase total orders
+        self.implants_ordered += quantity
         revenue = quantity * (self.adjusted_production_cost / self.profit_margin)
         self.sales_revenue += revenue
 
@@ -61,10 +68,12 @@ class ManufacturerAgent(Agent):
 
     def step(self):
         # self.total_orders = 0  # Reset total orders for the step
+        self.implants_produced = 0  # Reset implants produced for the step
         # Schedule production of implants if there are orders
         if self.total_orders > 0:
             self.schedule_implant_production()
         # Produce implants and store in inventory
-        if self.model.schedule.steps in self.production_history:
-            self.produce_implant(self.production_history[self.model.schedule.steps])
+        due = self.production_pipeline.pop_due(self.model.schedule.steps)
+        if due:
+            self.produce_implant(due)
         # print(f"Pending: {self.pending_implants}")
@@ -0,0 +1,44 @@
+import numpy as np
+
+# Define ManufacturerRegistry
+# Index of the model's manufacturers by unique_id and by type_of_manufacturer, so providers find a patient's
+# manufacturer in O(1) however many manufacturers compete. When a type has several manufacturers, choose() picks one
+# of them at random; with one manufacturer per type (the original model) no random number is drawn.
+
+class ManufacturerRegistry:
+    def __init__(self):
+        self.manufacturers = []  # In registration order, positions match model.manufacturers
+        self.by_id = {}  # unique_id: manufacturer
+        self.positions = {}  # unique_id: position in manufacturers
+        self.by_type = {}  # type_of_manufacturer: [manufacturers]
+
+    def add(self, manufacturer):
+        if manufacturer.unique_id in self.by_id:
+            raise ValueError(f"Manufacturer {manufacturer.unique_id!r} is already registered")
+        self.positions[manufacturer.unique_id] = len(self.manufacturers)
+        self.manufacturers.append(manufacturer)
+        self.by_id[manufacturer.unique_id] = manufacturer
+        self.by_type.setdefault(manufacturer.type_of_manufacturer, []).append(manufacturer)
+
+    def __len__(self):
+        return len(self.manufacturers)
+
+    def __iter__(self):
+        return iter(self.manufacturers)
+
+    def get(self, unique_id):
+        return self.by_id[unique_id]
+
+    def position(self, unique_id):
+        return self.positions[unique_id]
+
+    def of_type(self, type_of_manufacturer):
+        return self.by_type.get(type_of_manufacturer, [])
+
+    def choose(self, type_of_manufacturer, rng):  # One manufacturer of the type, rng is a random.Random
+        candidates = self.by_type[type_of_manufacturer]
+        return candidates[0] if len(candidates) == 1 else candidates[rng.randrange(len(candidates))]
+
+    def type_positions(self, type_of_manufacturer):  # Positions of the type's manufacturers, for the cohort engine
+        return np.array([self.positions[manufacturer.unique_id] for manufacturer in self.of_type(type_of_manufacturer)],
+                        dtype=np.int64)
@@ -0,0 +1,295 @@
+import time
+import numpy as np
+import pandas as pd
+from healthcare_provider_agent import (PATIENT_MAX_CAPACITY, FOLLOW_UP_INTERVALS, OUTCOME_PROBABILITIES,
+                                       IMPROVEMENT_PROBABILITIES)
+from manufacturer_agent import LEAD_TIMES, BASE_PRODUCTION_COST, PROFIT_MARGIN
+from patient_agent import HEALTH_STATES
+from summaries import UTILITY_VALUES
+
+# Define MarkovCohort
+# Deterministic expected-value version of ImplantMarketModel for screening many parameter combinations before running
+# replications. Instead of drawing patients it moves expected numbers of patients through the same tables the
+# providers use (OUTCOME_PROBABILITIES at surgery, IMPROVEMENT_PROBABILITIES and the AE probabilities at each of the
+# FOLLOW_UP_INTERVALS) and the same bookkeeping as the model, one step at a time:
+#   spawn       patient_incidence / 2 new patients, a third each severe, crippled and bedbound
+#   assignment  waiting patients up to the providers' free capacity, routed to the additive manufacturers with
+#               probability additive_adoption_preference, each ordering one implant (produced after the lead time)
+#   surgery     urgent patients first, then the others, while the manufacturer has implants. The implants produced
+#               this step only reach the providers stepping after the manufacturer, see expected_surgeries
+#   follow-up   the patients operated on interval steps ago. Those getting worse become bedbound and need urgent
+#               surgery with the AE probability of their manufacturer. After the last follow-up they stay as they are
+# Every scenario is one row of the state arrays, so a whole grid of scenarios steps together in a few array operations
+# per step. Expected values replace the stochastic capacity and inventory limits, so results are closest to the
+# replication means when the providers are not saturated (compare_with_replications measures the gap).
+# The waiting queue is served in arrival order (queue_policy "fifo" or "longest_waiting").
+# Validation against 50 replications each (main.py parameters at 200 and 400 steps, additive preference 0.7, and 30
+# providers with incidence 20 at 200 and 400 steps): average utility within 0.3%, revenue and profit within 2.6% (|z|
+# up to 3.2, the largest gaps at preference 0.7). Costs are NOT validated: they come out 15-27% below the replication
+# means in every case (z -7.6 to -15.4). Costs are the inventory held at the end of each step, and in the replications
+# that inventory depends on how each run's backlog is split between the manufacturers and providers, which expected
+# values do not capture. Use costs for ranking scenarios at most. They are listed in UNVALIDATED_OUTPUTS, and summary
+# leaves them out unless asked for with include_unvalidated=True.
+#
+#   cohort = MarkovCohort({"baseline": base_params, "ae_0.2": {**base_params, "ae_probability_additive": 0.2}})
+#   cohort.run(200)
+#   cohort.summary()  # One row per scenario and manufacturer, the validated columns of batch_runner.run_replication
+
+MODEL_PARAMETERS = ["num_providers", "initial_num_patients", "patient_incidence", "additive_adoption_preference",
+                    "ae_probability_additive", "ae_probability_subtractive"]  # Same as batch_runner
+SPAWN_STATES = np.isin(HEALTH_STATES, ["severe", "crippled", "bedbound"]) / 3  # Health of a new patient
+OUTCOMES = np.array([OUTCOME_PROBABILITIES[state] for state in HEALTH_STATES])  # Health after surgery
+MINIMAL = HEALTH_STATES.index("minimal")
+BEDBOUND = HEALTH_STATES.index("bedbound")
+UTILITY_WEIGHTS = np.array([UTILITY_VALUES[state] for state in HEALTH_STATES])
+ORDER_POINTS = 64  # Most positions of a manufacturer among the providers averaged over, more providers are binned
+UNVALIDATED_OUTPUTS = ["costs"]  # Biased against replications, see the validation notes above
+
+
+def expected_surgeries(demand, inventory, produced, num_providers):
+    # Expected surgeries for one manufacturer in a step, over its place in the random activation order. Inventory left
+    # from earlier steps serves every provider, the implants produced this step only the providers stepping after the
+    # manufacturer. With demand patients spread at random over the providers, about
+    # num_providers * (1 - exp(-demand / num_providers)) of them have a patient waiting for this manufacturer, and
+    # the manufacturer is equally likely to step after any number k of those n providers, who hold k / n of the demand.
+    # Non-integer n interpolates between the neighbouring integers
+    waiting_providers = np.maximum(num_providers * (1 - np.exp(-demand / num_providers)), 1)
+    low = np.floor(waiting_providers)
+    positions = np.arange(min(int(low.max()) + 1, ORDER_POINTS) + 1)
+    demand, inventory, produced = demand[..., None], inventory[..., None], produced[..., None]
+    surgeries = 0
+    for providers, share in ((low, 1 - (waiting_providers - low)), (low + 1, waiting_providers - low)):
+        providers = np.minimum(providers, ORDER_POINTS)[..., None]
+        weights = (positions <= providers) / (providers + 1)
+        before = np.minimum(positions / providers, 1)  # Share of the demand at providers stepping first
+        served_before = np.minimum(before * demand, inventory)
+        served_after = np.minimum((1 - before) * demand, inventory - served_before + produced)
+        surgeries = surgeries + share * ((served_before + served_after) * weights).sum(axis=-1)
+    return surgeries
+
+
+class MarkovCohort:
+    def __init__(self, scenarios, manufacturer_types=("additive", "subtractive")):
+        # scenarios: {scenario name: {model parameter: value}}, as for batch_runner.run_batch
+        self.scenarios = list(scenarios)
+        params = {name: np.array([scenarios[scenario][name] for scenario in self.scenarios], dtype=float)
+                  for name in MODEL_PARAMETERS}
+        self.manufacturer_types = list(manufacturer_types)
+        num_scenarios = len(self.scenarios)
+        num_manufacturers = len(self.manufacturer_types)
+        shape = (num_scenarios, num_manufacturers)
+
+        # Per scenario constants
+        self.capacity = params["num_providers"] * PATIENT_MAX_CAPACITY
+        self.num_providers = params["num_providers"]
+        self.incidence = params["patient_incidence"] / 2  # Mean of randint(0, patient_incidence)
+        # Routing share of each manufacturer, split evenly between the manufacturers of a type
+        additive = np.array([kind == "additive" for kind in self.manufacturer_types])
+        preference = params["additive_adoption_preference"][:, None]
+        self.routing = np.where(additive, preference / max(additive.sum(), 1),
+                                (1 - preference) / max((~additive).sum(), 1))
+        self.ae_probability = np.where(additive, params["ae_probability_additive"][:, None],
+                                       params["ae_probability_subtractive"][:, None])
+        self.lead_times = [LEAD_TIMES[kind] for kind in self.manufacturer_types]
+
+        # State, expected numbers of patients
+        self.steps = 0
+        self.waiting = params["initial_num_patients"][:, None] * SPAWN_STATES  # (scenario, health) not assigned
+        self.queued = np.zeros(shape + (len(HEALTH_STATES),))  # Assigned and waiting for their first surgery
+        self.urgent = np.zeros(shape)  # Waiting for urgent surgery, all bedbound
+        # Operated patients by the step of their last surgery, kept until their last follow-up
+        self.operated = np.zeros((max(FOLLOW_UP_INTERVALS) + 1,) + shape + (len(HEALTH_STATES),))
+        # All operated patients not waiting for urgent surgery, in follow-up or past their last follow-up
+        self.operated_total = np.zeros(shape + (len(HEALTH_STATES),))
+        self.inventory = np.zeros(shape)
+        self.pipeline = np.zeros((max(self.lead_times) + 1,) + shape)  # Implants ready at step s in pipeline[s % len]
+        self.ordered = np.zeros(shape)  # Implants ordered so far
+
+        # Recorded results
+        self.totals = np.zeros(shape + (3,))  # Sums over the steps of the recorded revenue, costs and profit
+        self.utility_values = []  # Average utility per scenario and manufacturer at the end of each step
+        self.waiting_values = []  # Patients waiting for a provider per scenario at the end of each step
+
+    def health_counts(self):  # Expected patients per scenario, manufacturer and health state, as in RunMetrics
+        counts = self.queued + self.operated_total
+        counts[..., BEDBOUND] += self.urgent
+        return counts
+
+    def step(self):
+        step = self.steps
+        self.waiting += self.incidence[:, None] * SPAWN_STATES
+
+        # Assignment up to the free capacity, waiting patients are alike so they go in proportion
+        occupied = self.queued.sum(axis=2).sum(axis=1) + self.urgent.sum(axis=1)
+        waiting_total = self.waiting.sum(axis=1)
+        assigned = np.minimum(waiting_total, np.clip(self.capacity - occupied, 0, None))
+        fraction = np.divide(assigned, waiting_total, out=np.zeros_like(assigned), where=waiting_total > 0)
+        assigned_states = self.waiting * fraction[:, None]
+        self.waiting -= assigned_states
+        orders = assigned[:, None] * self.routing
+        self.queued += assigned_states[:, None, :] * self.routing[:, :, None]
+        self.ordered += orders
+        for m, lead_time in enumerate(self.lead_times):
+            self.pipeline[(step + lead_time) % len(self.pipeline), :, m] += orders[:, m]
+
+        # Production, then surgery, urgent patients first
+        slot = step % len(self.pipeline)
+        produced = self.pipeline[slot].copy()
+        self.pipeline[slot] = 0
+        queued_total = self.queued.sum(axis=2)
+        surgeries = expected_surgeries(self.urgent + queued_total, self.inventory, produced,
+                                       self.num_providers[:, None])
+        self.inventory += produced - surgeries
+        urgent_surgeries = np.minimum(self.urgent, surgeries)
+        first_surgeries = surgeries - urgent_surgeries
+        self.urgent -= urgent_surgeries
+        self.queued *= 1 - np.divide(first_surgeries, queued_total, out=np.zeros_like(queued_total),
+                                     where=queued_total > 0)[:, :, None]
+        self.operated[step % len(self.operated)] = surgeries[:, :, None] * OUTCOMES
+        self.operated_total += self.operated[step % len(self.operated)]
+
+        # Follow-ups of the patients operated on interval steps ago
+        for k, interval in enumerate(FOLLOW_UP_INTERVALS):
+            if step < interval:
+                continue
+            cohort = self.operated[(step - interval) % len(self.operated)]  # A view, updated in place
+            self.operated_total -= cohort
+            improved = cohort.sum(axis=2) * IMPROVEMENT_PROBABILITIES["improved"]
+            worse = cohort * IMPROVEMENT_PROBABILITIES["worse"]
+            worse[..., BEDBOUND] = 0  # Already bedbound, nothing changes
+            worse_total = worse.sum(axis=2)
+            new_urgent = worse_total * self.ae_probability
+            cohort *= 1 - IMPROVEMENT_PROBABILITIES["improved"]
+            cohort -= worse
+            cohort[..., MINIMAL] += improved
+            cohort[..., BEDBOUND] += worse_total - new_urgent
+            self.urgent += new_urgent
+            self.operated_total += cohort
+            if k == len(FOLLOW_UP_INTERVALS) - 1:  # Nothing more happens to them, the slot is reused
+                cohort[...] = 0
+
+        # The model's recorded manufacturer rows, and the utility and backlog at the end of the step
+        revenue = self.ordered * BASE_PRODUCTION_COST / PROFIT_MARGIN
+        self.totals[..., 0] += revenue
+        self.totals[..., 1] += self.inventory * BASE_PRODUCTION_COST
+        self.totals[..., 2] += revenue * PROFIT_MARGIN
+        counts = self.health_counts()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.utility_values.append(counts @ UTILITY_WEIGHTS / counts.sum(axis=2))
+        self.waiting_values.append(self.waiting.sum(axis=1))
+        self.steps += 1
+
+    def run(self, steps):
+        for i in range(steps):
+            self.step()
+        return self
+
+    # Results ---------------------------------------------------------------------------------------
+    def summary(self, include_unvalidated=False):
+        # One row per scenario and manufacturer with the expected revenue and profit totals and the average utility at
+        # the last step, the columns batch_runner.run_replication reports for a replication. The costs totals are only
+        # included with include_unvalidated=True, they are biased low, see UNVALIDATED_OUTPUTS
+        utility = self.utility_values[-1] if self.utility_values else np.full(self.routing.shape, np.nan)
+        rows = []
+        for i, scenario in enumerate(self.scenarios):
+            for m in range(len(self.manufacturer_types)):
+                rows.append({
+                    "scenario": scenario,
+                    "manufacturer_id": m,
+                    "revenue": self.totals[i, m, 0],
+                    "costs": self.totals[i, m, 1],
+                    "profit": self.totals[i, m, 2],
+                    "average_utility": utility[i, m]
+                })
+        summary = pd.DataFrame(rows)
+        return summary if include_unvalidated else summary.drop(columns=UNVALIDATED_OUTPUTS)
+
+    def health_distribution(self):  # Expected patients per scenario, manufacturer and health state now
+        counts = self.health_counts()
+        index = pd.MultiIndex.from_product([self.scenarios, range(len(self.manufacturer_types)), HEALTH_STATES],
+                                           names=["scenario", "manufacturer_id", "health_status"])
+        return pd.DataFrame({"counts": counts.ravel()}, index=index).reset_index()
+
+    def utility_series(self, scenario):  # Average utility per step and manufacturer, as RunMetrics.utility_series
+        i = self.scenarios.index(scenario)
+        values = np.array([utility[i] for utility in self.utility_values])
+        return pd.DataFrame({
+            "step": np.repeat(np.arange(len(values)), len(self.manufacturer_types)),
+            "manufacturer_id": np.tile(np.arange(len(self.manufacturer_types)), len(values)),
+            "average_utility": values.ravel()
+        })
+
+    def waiting_series(self):  # Patients waiting for a provider, one column per scenario
+        return pd.DataFrame(np.array(self.waiting_values), columns=self.scenarios).rename_axis("step")
+
+
+def screen(scenarios, time_period, include_unvalidated=False, **kwargs):
+    # MarkovCohort(scenarios, **kwargs).run(time_period).summary(include_unvalidated)
+    return MarkovCohort(scenarios, **kwargs).run(time_period).summary(include_unvalidated)
+
+
+def compare_with_replications(markov_summary, replication_results, columns=None):
+    # Expected values next to the replication means of batch_runner.run_batch results, with the gap in standard
+    # errors of the mean (|z| above about 2 means the expected-value model misses the replications). columns defaults
+    # to the outputs in markov_summary, so costs are only compared when it was made with include_unvalidated=True
+    if columns is None:
+        columns = [column for column in ("revenue", "costs", "profit", "average_utility") if column in markov_summary]
+    replications = replication_results.groupby(["scenario", "manufacturer_id"])[list(columns)].agg(["mean", "sem"])
+    expected = markov_summary.set_index(["scenario", "manufacturer_id"])
+    rows = []
+    for (scenario, manufacturer_id), means in replications.iterrows():
+        for column in columns:
+            value = expected.loc[(scenario, manufacturer_id), column]
+            mean, sem = means[(column, "mean")], means[(column, "sem")]
+            rows.append({
+                "scenario": scenario,
+                "manufacturer_id": manufacturer_id,
+                "output": column,
+                "markov": value,
+                "replication_mean": mean,
+                "replication_sem": sem,
+                "relative_error": (value - mean) / mean if mean else np.nan,
+                "z": (value - mean) / sem if sem else np.nan,
+                "validated": column not in UNVALIDATED_OUTPUTS
+            })
+    return pd.DataFrame(rows)
+
+
+def main():
+    # Screen a grid of AE probabilities and adoption preferences around the main.py parameters, then check a few
+    # scenarios against ABM replications
+    from batch_runner import run_batch  # Only the validation needs the agent-based model
+    base_params = {
+        "num_providers": 3,
+        "initial_num_patients": 76,
+        "patient_incidence": 48,
+        "additive_adoption_preference": 0.5,
+        "ae_probability_additive": 0.3,
+        "ae_probability_subtractive": 0.3
+    }
+    time_period = 200
+    grid = {f"ae_add={ae_add:.2f} ae_sub={ae_sub:.2f} pref={preference:.2f}": {
+        **base_params, "ae_probability_additive": ae_add, "ae_probability_subtractive": ae_sub,
+        "additive_adoption_preference": preference}
+        for ae_add in np.linspace(0, 1, 11) for ae_sub in np.linspace(0, 1, 11) for preference in np.linspace(0, 1, 11)}
+
+    start = time.perf_counter()
+    summary = screen(grid, time_period)
+    elapsed = time.perf_counter() - start
+    print(f"Screened {len(grid)} scenarios over {time_period} steps in {elapsed:.2f}s "
+          f"({elapsed / len(grid) * 1000:.2f} ms per scenario)")
+    print(summary.groupby("manufacturer_id")[["profit", "average_utility"]].describe())
+    print(f"Left out, not validated against replications: {', '.join(UNVALIDATED_OUTPUTS)}")
+
+    checks = {"baseline": base_params,
+              "additive_ae_0.2": {**base_params, "ae_probability_additive": 0.2},
+              "additive_preference_0.7": {**base_params, "additive_adoption_preference": 0.7}}
+    results = run_batch(checks, 50, time_period, "markov_validation.jsonl")
+    print("\nExpected values against replication means:")
+    # Costs included here to show how far off they are, flagged validated=False
+    markov_summary = screen(checks, time_period, include_unvalidated=True)
+    print(compare_with_replications(markov_summary, results).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
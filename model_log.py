@@ -0,0 +1,57 @@
+import collections
+import json
+import sys
+
+# Model logging and metrics sinks
+# ModelLog replaces the unconditional print() calls of ImplantMarketModel. Each model has its own level, so runs side
+# by side can log differently, and callers check info_enabled/verbose_enabled before building a message, so the
+# "silent" level skips the string formatting as well as the writing.
+# Levels:
+#   "verbose"  every step's header, spawn and waiting counts, and the recorded manufacturer and provider rows
+#   "info"     every step's header, spawn and waiting counts
+#   "silent"   nothing, the default
+# Structured per-step metrics go to an optional sink instead, any object with emit(metrics) and close(), so the app
+# and batch runs can follow a run without parsing stdout.
+
+LOG_LEVELS = ["silent", "info", "verbose"]
+
+
+class ModelLog:
+    def __init__(self, level="silent", stream=None):
+        if level not in LOG_LEVELS:
+            raise ValueError(f"Unknown log level {level!r}, expected one of {LOG_LEVELS}")
+        self.level = level
+        self.info_enabled = LOG_LEVELS.index(level) >= LOG_LEVELS.index("info")
+        self.verbose_enabled = level == "verbose"
+        self.stream = stream  # None writes to sys.stdout as it is at the time of the call
+
+    def write(self, message):
+        print(message, file=sys.stdout if self.stream is None else self.stream)
+
+
+# Metrics sinks ---------------------------------------------------------------------------------------
+# A step's metrics: {"step", "new_patients", "patients_waiting", "manufacturers": [rows], "providers": [rows]}, the
+# rows being the ones recorded in the manufacturer and provider tables.
+class RingBufferSink:  # Keeps the metrics of the last capacity steps in memory
+    def __init__(self, capacity=1000):
+        self.metrics = collections.deque(maxlen=capacity)
+
+    def emit(self, metrics):
+        self.metrics.append(metrics)
+
+    def latest(self):
+        return self.metrics[-1] if self.metrics else None
+
+    def close(self):
+        pass
+
+
+class JsonLinesSink:  # Appends one JSON line per step to a file
+    def __init__(self, path):
+        self.file = open(path, "w")
+
+    def emit(self, metrics):
+        self.file.write(json.dumps(metrics) + "\n")
+
+    def close(self):
+        self.file.close()
@@ -1,5 +1,7 @@
+import array
+import enum
 from mesa import Agent
-import random
+from random_streams import keyed_uniform, patient_key
 
 # Define PatientAgent
 # Patients will spawn randomly every step with one of the 3 worse health statuses
@@ -7,12 +9,46 @@ import random
 # TODO add word-of-mouth behavior that influences new patients if made significant improvement post-surgery
 # TODO implement future chance of adverse events, would affect health state
 
+HEALTH_STATES = ["minimal", "moderate", "severe", "crippled", "bedbound"]  # Health states ordered from best to worst
+
+
+class HealthState(enum.IntEnum):  # A patient's health_status, lower is better, the value indexes HEALTH_STATES
+    MINIMAL = 0
+    MODERATE = 1
+    SEVERE = 2
+    CRIPPLED = 3
+    BEDBOUND = 4
+
+
+HEALTH_STATE_RANK = {state: HealthState(rank) for rank, state in enumerate(HEALTH_STATES)}  # Name: HealthState
+
+# health_status_history is kept as one flat array of (event code, step, health state) triples per patient
+HISTORY_EVENTS = ["pre-surgery", "post-surgery", "follow-up"]
+HISTORY_EVENT_CODES = {event: code for code, event in enumerate(HISTORY_EVENTS)}
+
+
+def decode_history(entries):  # History triples to the (label, health state name) pairs the model used to keep
+    return [("follow-up at step " + str(entries[k + 1]) if entries[k] == HISTORY_EVENT_CODES["follow-up"]
+             else HISTORY_EVENTS[entries[k]], HEALTH_STATES[entries[k + 2]]) for k in range(0, len(entries), 3)]
+
+
 class PatientAgent(Agent):
-    def __init__(self, unique_id, model):
+    # mesa.Agent has no __slots__, so every patient still has an instance __dict__ (for unique_id, model and pos). The
+    # slots keep the attributes below out of it, but against CPython's key-sharing instance dicts that saves next to
+    # nothing: the memory saved per patient comes from the history array, see record_health
+    __slots__ = ("step_spawned", "health_status", "history", "outcome_category", "assigned_y_n", "manufacturer_id",
+                 "provider_id", "days_waiting_for_surgery", "received_surgery", "step_received_treatment",
+                 "follow_up_steps", "next_follow_up", "next_follow_up_index", "needs_urgent_surgery",
+                 "step_followup_treatment", "draw_key", "draws")
+
+    def __init__(self, unique_id, model, health_status=None):
         super().__init__(unique_id, model)
         self.step_spawned = self.model.schedule.steps  # Record the step when the patient is spawned
-        self.health_status = random.choice(["severe", "crippled", "bedbound"])  # Initial health status will be one of these poor states
-        self.health_status_history = []  # For recording entire health status history dictionary to record the health status at each step
+        if health_status is None:  # Given for a patient referred from another region
+            health_status = self.model.spawn_health.draw()  # Initial health status will be one of severe, crippled or bedbound
+        self.health_status = health_status
+        self.history = array.array("i")  # Health status at each surgery and follow-up, see record_health
+        self.outcome_category = None  # same/improved/worsened between the last two history entries, counted by the provider
         self.assigned_y_n = False  # Initialize assigned_y_n as False
 
         self.manufacturer_id = None  # Initialize manufacturer_id as None will record the manufacturer ID received
@@ -22,13 +58,30 @@ class PatientAgent(Agent):
         self.received_surgery = False  # Initialize received_surgery as False
         self.step_received_treatment = None  # Initialize step_received_treatment as None
 
-        self.follow_up_steps = []  # Initialize follow_up_steps as an empty list
+        self.follow_up_steps = ()  # Initialize follow_up_steps as an empty tuple
         self.next_follow_up = None  # Initialize next_follow_up as None will record the next follow-up step
         self.next_follow_up_index = 0  # Initialize next_follow_up_index as 0
 
         self.needs_urgent_surgery = False  # Initialize needs_urgent_surgery as False
         self.step_followup_treatment = None  # Initialize step_followup_treatment as None
 
+        self.draw_key = patient_key(unique_id)  # Keys the patient's own random draws, see draw
+        self.draws = 0  # Keyed draws taken so far
+
+    def draw(self, stream):  # The patient's next uniform in [0, 1) on the stream, see RandomStreams
+        self.draws += 1
+        return keyed_uniform(self.model.streams.keys[stream], self.draw_key, self.draws - 1)
+
+    def record_health(self, event, step):  # Append the current health status to the history, event in HISTORY_EVENTS
+        self.history.extend((HISTORY_EVENT_CODES[event], step, self.health_status))
+
+    def last_health_states(self):  # (second to last, last) health state in the history
+        return self.history[-4], self.history[-1]
+
+    @property
+    def health_status_history(self):  # Decoded history, e.g. [('pre-surgery', 'severe'), ('post-surgery', 'minimal')]
+        return decode_history(self.history)
+
     def step(self):
         if self.needs_urgent_surgery or not self.received_surgery:
             self.days_waiting_for_surgery += 1  # Increment days_waiting_for_surgery
@@ -0,0 +1,57 @@
+import array
+import collections
+from patient_agent import decode_history
+
+# Define PatientArchive
+# Patients past their last follow-up never change again, so ImplantMarketModel moves them out of the schedule, the
+# patient list and the providers' all_patients into this archive (PatientAgent engine, retire_patients=True). The
+# archive keeps each patient's final recorded fields in typed arrays, their history triples (see PatientAgent) and
+# running counts of final health per manufacturer, so the active set and the per-step cost stay flat at steady state
+# while aggregate queries still see every patient. With keep_rows=False (record_mode="summary") only the step each
+# patient retired and the health counts are kept.
+
+# (array typecode) for each column of ImplantMarketModel.patient_columns, values are stored already coded
+ARCHIVED_COLUMNS = {
+    "patient_id": None,  # Kept as a list, ids are ints or strings
+    "health_status": "b",
+    "received_surgery": "b",
+    "days_waiting_for_surgery": "i",
+    "step_received_treatment": "i",
+    "manufacturer_id": "b",
+    "next_follow_up": "i",
+    "needs_urgent_surgery": "b",
+    "step_followup_treatment": "i"
+}
+
+
+class PatientArchive:
+    def __init__(self, keep_rows=True):
+        self.keep_rows = keep_rows
+        self.columns = {name: [] if typecode is None else array.array(typecode)
+                        for name, typecode in ARCHIVED_COLUMNS.items()}
+        self.provider_ids = array.array("i")
+        self.step_spawned = array.array("i")
+        self.step_retired = array.array("i")
+        self.history = array.array("i")  # The patients' PatientAgent.history triples, one after the other
+        self.history_offsets = array.array("q", [0])  # Patient i's entries are history[offsets[i]:offsets[i + 1]]
+        self.health_counts = collections.Counter()  # (manufacturer code, health rank): archived patients
+
+    def __len__(self):
+        return len(self.step_retired)
+
+    def add(self, patients, columns, step):  # columns: ImplantMarketModel.patient_columns(patients)
+        self.health_counts.update(zip(columns["manufacturer_id"], columns["health_status"]))
+        if not self.keep_rows:
+            self.step_retired.extend([step] * len(patients))
+            return
+        for name, values in columns.items():
+            self.columns[name].extend(values)
+        for patient in patients:
+            self.provider_ids.append(-1 if patient.provider_id is None else patient.provider_id)
+            self.step_spawned.append(patient.step_spawned)
+            self.step_retired.append(step)
+            self.history.extend(patient.history)
+            self.history_offsets.append(len(self.history))
+
+    def health_status_history(self, i):  # Patient i's history in the PatientAgent.health_status_history format
+        return decode_history(self.history[self.history_offsets[i]:self.history_offsets[i + 1]])
@@ -0,0 +1,23 @@
+# Define ProductionPipeline
+# Implants ordered from a manufacturer and not produced yet. Orders scheduled at a step come out lead_time steps later,
+# so only lead_time + 1 steps can ever be in flight and the pipeline is a fixed ring buffer indexed by step, instead
+# of a dict that keeps one entry for every step of the run.
+
+class ProductionPipeline:
+    def __init__(self, lead_time):
+        if lead_time < 1:
+            raise ValueError(f"Lead time must be at least one step, got {lead_time}")
+        self.lead_time = lead_time
+        self.slots = [0] * (lead_time + 1)  # Implants due at step s are in slots[s % len(slots)]
+
+    def schedule(self, step, quantity):  # Start producing quantity implants at step, ready at step + lead_time
+        self.slots[(step + self.lead_time) % len(self.slots)] += quantity
+
+    def pop_due(self, step):  # Remove and return the implants ready at step
+        slot = step % len(self.slots)
+        quantity = self.slots[slot]
+        self.slots[slot] = 0
+        return quantity
+
+    def in_flight(self):  # Implants scheduled and not produced yet
+        return sum(self.slots)
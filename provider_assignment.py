@@ -0,0 +1,66 @@
+import heapq
+import numpy as np
+
+# Define ProviderAssignment
+# Assigns a whole batch of waiting patients to providers in one pass. The free capacity of every provider is read once
+# per batch and the providers that still have room are kept in an index, so each patient costs O(1) ("random") or
+# O(log providers) ("least_loaded") instead of a scan over all providers.
+# Policies:
+#   "random"        each patient in turn picks uniformly among the providers with capacity left (the original rule)
+#   "least_loaded"  each patient goes to the provider with the fewest surgery patients, ties broken at random
+
+ASSIGNMENT_POLICIES = ["random", "least_loaded"]
+
+
+class ProviderAssignment:
+    def __init__(self, providers, rng, policy="random"):
+        if policy not in ASSIGNMENT_POLICIES:
+            raise ValueError(f"Unknown assignment policy {policy!r}, expected one of {ASSIGNMENT_POLICIES}")
+        self.providers = providers  # The model's provider list, positions are returned
+        self.rng = rng  # NumPy Generator
+        self.policy = policy
+
+    def free_capacity(self):
+        return np.array([provider.patient_max_capacity - len(provider.surgery_patients)
+                         for provider in self.providers], dtype=np.int64)
+
+    def assign(self, count):  # Provider positions for up to count patients, in queue order
+        free_capacity = self.free_capacity()
+        count = min(count, int(free_capacity[free_capacity > 0].sum()))
+        if self.policy == "least_loaded":
+            return self.assign_least_loaded(count, free_capacity)
+        return self.assign_random(count, free_capacity)
+
+    def assign_random(self, count, free_capacity):
+        available = np.flatnonzero(free_capacity > 0).tolist()
+        free_capacity = free_capacity.tolist()
+        chosen = np.empty(count, dtype=np.int32)
+        draws = self.rng.random(count)
+        for k in range(count):
+            j = int(draws[k] * len(available))
+            i = available[j]
+            chosen[k] = i
+            free_capacity[i] -= 1
+            if free_capacity[i] == 0:  # Swap-remove the full provider
+                available[j] = available[-1]
+                available.pop()
+        return chosen
+
+    def assign_least_loaded(self, count, free_capacity):
+        # Heap of (surgery patients, random tie-break, position) for the providers with capacity left
+        available = np.flatnonzero(free_capacity > 0)
+        tie_breaks = self.rng.random(len(available)).tolist()
+        heap = [(len(self.providers[i].surgery_patients), tie_break, i)
+                for i, tie_break in zip(available.tolist(), tie_breaks)]
+        heapq.heapify(heap)
+        free_capacity = free_capacity.tolist()
+        chosen = np.empty(count, dtype=np.int32)
+        for k in range(count):
+            load, tie_break, i = heap[0]
+            chosen[k] = i
+            free_capacity[i] -= 1
+            if free_capacity[i] == 0:
+                heapq.heappop(heap)
+            else:
+                heapq.heapreplace(heap, (load + 1, tie_break, i))
+        return chosen
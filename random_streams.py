@@ -0,0 +1,69 @@
+import hashlib
+import random
+import numpy as np
+
+# Define RandomStreams
+# Every stochastic draw of an ImplantMarketModel comes from the model's own RandomStreams instead of the process-wide
+# random module, so a seeded run is reproducible bit for bit and several models can run side by side without
+# disturbing each other. The seed is split with a NumPy SeedSequence into one independent substream per subsystem,
+# so e.g. changing how surgery outcomes are drawn does not shift the spawning or routing draws.
+# Each substream comes as a random.Random, for the agent shuffle and the few single draws left in PatientAgent mode, and
+# as a NumPy Generator for the batch draws of the cohort engine and the pre-drawn blocks of VariateSupply.
+# A patient's own health draws (surgery outcomes, follow-up changes, adverse events) use keyed draws instead: the
+# n-th draw of a patient is a counter-based hash (SplitMix64) of the stream's key, the patient's key and n, so it does
+# not depend on how many draws other patients took before it. With common random numbers a patient then gets the same
+# draws in every scenario until its own events differ, where a sequential stream hands every later patient another
+# patient's draw as soon as one scenario takes an extra draw (an urgent surgery, a different queue order). Routing stays
+# sequential, one draw per order: revenue counts orders, not patients, so pairing the i-th order of each scenario keeps
+# it better matched than pairing patients whose assignments differ between scenarios.
+
+RANDOM_STREAMS = [
+    "schedule",  # Agent activation order
+    "spawning",  # Number of new patients and their initial health
+    "assignment",  # Provider chosen for a waiting patient
+    "routing",  # Manufacturer chosen by the provider
+    "surgery",  # Surgery outcomes
+    "follow_up",  # Health changes at follow-ups
+    "adverse_events"  # Urgent re-surgery after getting worse
+]
+MASK64 = (1 << 64) - 1
+GOLDEN_GAMMA = 0x9E3779B97F4A7C15  # SplitMix64 counter increment
+
+
+def mix64(z):  # SplitMix64 finalizer of a 64-bit int
+    z = (z ^ (z >> 30)) * 0xBF58476D1CE4E5B9 & MASK64
+    z = (z ^ (z >> 27)) * 0x94D049BB133111EB & MASK64
+    return z ^ (z >> 31)
+
+
+def mix64_array(z):  # mix64 of a uint64 array, products wrap around like the masked ints
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+def patient_key(unique_id):  # 64-bit draw key of a patient, the same for its unique_id in every run and region
+    return int.from_bytes(hashlib.blake2b(str(unique_id).encode(), digest_size=8).digest(), "little")
+
+
+def keyed_uniform(stream_key, key, n):  # n-th uniform in [0, 1) of key on the stream
+    return (mix64((mix64(stream_key ^ key) + n * GOLDEN_GAMMA) & MASK64) >> 11) * 2.0 ** -53
+
+
+def keyed_uniforms(stream_key, keys, n):  # keyed_uniform for uint64 arrays of keys and draw numbers
+    z = mix64_array(np.uint64(stream_key) ^ keys) + n.astype(np.uint64) * np.uint64(GOLDEN_GAMMA)
+    return (mix64_array(z) >> np.uint64(11)) * 2.0 ** -53
+
+
+class RandomStreams:
+    def __init__(self, seed=None):
+        self.seed_sequence = np.random.SeedSequence(seed)
+        self.seed = self.seed_sequence.entropy  # Passing this back as the seed repeats the run, also when seed is None
+        self.random = {}  # Stream name: random.Random
+        self.generator = {}  # Stream name: numpy.random.Generator
+        self.keys = {}  # Stream name: 64-bit key of its keyed draws
+        for name, stream_sequence in zip(RANDOM_STREAMS, self.seed_sequence.spawn(len(RANDOM_STREAMS))):
+            python_sequence, numpy_sequence, key_sequence = stream_sequence.spawn(3)
+            self.random[name] = random.Random(int.from_bytes(python_sequence.generate_state(8).tobytes(), "little"))
+            self.generator[name] = np.random.Generator(np.random.PCG64(numpy_sequence))
+            self.keys[name] = int(key_sequence.generate_state(1, np.uint64)[0])
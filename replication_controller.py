@@ -0,0 +1,210 @@
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import os
+import time
+import numpy as np
+import pandas as pd
+from batch_runner import COMMON_SEED_NAME, replication_seed, run_replication, t_quantile
+
+# Define ReplicationController
+# Runs replications of several scenarios until the confidence interval of every chosen output is narrow enough, instead
+# of a fixed number of replications. Outputs are the columns of batch_runner.run_replication rows: per-manufacturer ones
+# (average_utility, profit, revenue, costs) are tracked for each manufacturer, patients_waiting (the waiting backlog
+# at the end of the run) once per replication. The running mean and variance of each output are updated as replications
+# come in (Welford), and a scenario stops once it has min_replications and every output's confidence interval half
+# width is at most relative_precision times its mean (or it reaches max_replications).
+# The first wave starts min_replications of every scenario. After that, each worker that frees up is handed the next
+# replication of the unfinished scenario furthest from its target, so workers move from the scenarios that have
+# converged to the ones that have not. Replications queued for a scenario that has just converged are cancelled.
+# Seeds are derived as in batch_runner, with common_random_numbers pairing replication r of every scenario.
+#
+#   controller = ReplicationController(scenarios, time_period=200, relative_precision=0.02)
+#   summary = controller.run()
+
+PER_MANUFACTURER_OUTPUTS = ["average_utility", "profit", "revenue", "costs"]
+MODEL_OUTPUTS = ["patients_waiting"]
+MIN_REPLICATIONS = 5  # Lowest min_replications, with fewer the variance estimate is too rough to stop on
+
+
+class RunningStatistic:  # Mean and variance of the values seen so far, NaN values are skipped
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.sum_of_squares = 0.0  # Sum of squared differences from the mean
+
+    def add(self, value):
+        if np.isnan(value):
+            return
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.sum_of_squares += delta * (value - self.mean)
+
+    def half_width(self, confidence):  # Half width of the t confidence interval of the mean
+        if self.count < 2:
+            return np.inf
+        return t_quantile(confidence, self.count - 1) * np.sqrt(self.sum_of_squares / (self.count - 1) / self.count)
+
+    def relative_precision(self, confidence):  # Half width over the mean, 0 when every value was the same
+        half_width = self.half_width(confidence)
+        if half_width == 0:
+            return 0.0
+        return half_width / abs(self.mean) if self.mean else np.inf
+
+
+class ScenarioProgress:
+    def __init__(self, name, params, outputs):
+        self.name = name
+        self.params = params
+        self.outputs = outputs  # Output names, see PER_MANUFACTURER_OUTPUTS and MODEL_OUTPUTS
+        self.statistics = {}  # (output, manufacturer_id or None): RunningStatistic, added with the first replication
+        self.next_replication = 0
+        self.completed = 0
+        self.done = False
+
+    def add(self, rows):  # One replication, as returned by run_replication
+        for row in rows:
+            for output in self.outputs:
+                if output in PER_MANUFACTURER_OUTPUTS:
+                    self.statistics.setdefault((output, row["manufacturer_id"]), RunningStatistic()).add(row[output])
+        for output in self.outputs:
+            if output in MODEL_OUTPUTS:
+                self.statistics.setdefault((output, None), RunningStatistic()).add(rows[0][output])
+        self.completed += 1
+
+    def worst_precision(self, confidence):  # Relative precision of the least precise output
+        if not self.statistics:
+            return np.inf
+        return max(statistic.relative_precision(confidence) for statistic in self.statistics.values())
+
+
+class ReplicationController:
+    def __init__(self, scenarios, time_period, outputs=("average_utility", "profit", "patients_waiting"),
+                 relative_precision=0.05, confidence=0.95, min_replications=5, max_replications=200, base_seed=0,
+                 engine="agent", workers=None, common_random_numbers=False):
+        # scenarios: {scenario name: {model parameter: value}}, as for batch_runner.run_batch
+        unknown = sorted(set(outputs) - set(PER_MANUFACTURER_OUTPUTS) - set(MODEL_OUTPUTS))
+        if unknown:
+            raise ValueError(f"Unknown outputs {unknown}, expected some of {PER_MANUFACTURER_OUTPUTS + MODEL_OUTPUTS}")
+        if relative_precision <= 0:
+            raise ValueError(f"relative_precision must be positive, got {relative_precision}")
+        if not MIN_REPLICATIONS <= min_replications <= max_replications:
+            raise ValueError(f"Need {MIN_REPLICATIONS} <= min_replications <= max_replications, got {min_replications} "
+                             f"and {max_replications}")
+        self.scenarios = {name: ScenarioProgress(name, params, list(outputs)) for name, params in scenarios.items()}
+        self.time_period = time_period
+        self.relative_precision = relative_precision
+        self.confidence = confidence
+        self.min_replications = min_replications
+        self.max_replications = max_replications
+        self.base_seed = base_seed
+        self.engine = engine
+        self.workers = workers or os.cpu_count() or 1
+        self.common_random_numbers = common_random_numbers
+        self.rows = []  # Every replication's rows, as from run_replication
+
+    def next_job(self, scenario):
+        replication = scenario.next_replication
+        scenario.next_replication += 1
+        seed_name = COMMON_SEED_NAME if self.common_random_numbers else scenario.name
+        return {
+            "scenario": scenario.name,
+            "replication": replication,
+            "seed": replication_seed(self.base_seed, seed_name, replication),
+            "params": scenario.params,
+            "time_period": self.time_period,
+            "engine": self.engine
+        }
+
+    def check_done(self, scenario):
+        scenario.done = scenario.completed >= self.max_replications or (
+            scenario.completed >= self.min_replications and
+            scenario.worst_precision(self.confidence) <= self.relative_precision)
+        return scenario.done
+
+    def neediest_scenario(self):  # Unfinished scenario furthest from its target that can still start a replication
+        candidates = [scenario for scenario in self.scenarios.values()
+                      if not scenario.done and scenario.next_replication < self.max_replications]
+        return max(candidates, key=lambda scenario: (scenario.worst_precision(self.confidence),
+                                                     -scenario.next_replication), default=None)
+
+    def run(self):  # Returns the summary table, see summary()
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            # First wave: the minimum number of replications of every scenario
+            futures = {executor.submit(run_replication, self.next_job(scenario)): scenario
+                       for scenario in self.scenarios.values() for i in range(self.min_replications)}
+            while futures:
+                finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    scenario = futures.pop(future)
+                    if future.cancelled():
+                        continue
+                    rows = future.result()
+                    self.rows.extend(rows)
+                    scenario.add(rows)
+                    if not scenario.done and self.check_done(scenario):
+                        for queued, queued_scenario in futures.items():  # Not started yet, no longer needed
+                            if queued_scenario is scenario:
+                                queued.cancel()
+                        print(f"{scenario.name} done after {scenario.completed} replications, "
+                              f"relative precision {scenario.worst_precision(self.confidence):.4f}, "
+                              f"{time.perf_counter() - start:.0f}s elapsed", flush=True)
+
+                # Keep every worker busy with the scenarios furthest from their target
+                while sum(not future.done() for future in futures) < self.workers:
+                    scenario = self.neediest_scenario()
+                    if scenario is None:
+                        break
+                    futures[executor.submit(run_replication, self.next_job(scenario))] = scenario
+        return self.summary()
+
+    def summary(self):  # One row per scenario and output with the mean, its confidence interval and precision
+        rows = []
+        for scenario in self.scenarios.values():
+            for (output, manufacturer_id), statistic in scenario.statistics.items():
+                half_width = statistic.half_width(self.confidence)
+                rows.append({
+                    "scenario": scenario.name,
+                    "output": output,
+                    "manufacturer_id": manufacturer_id,
+                    "replications": statistic.count,
+                    "mean": statistic.mean,
+                    "ci_low": statistic.mean - half_width,
+                    "ci_high": statistic.mean + half_width,
+                    "relative_precision": statistic.relative_precision(self.confidence),
+                    "converged": statistic.relative_precision(self.confidence) <= self.relative_precision
+                })
+        return pd.DataFrame(rows).astype({"manufacturer_id": "Int64"})  # Missing for the model outputs
+
+    def results(self):  # Every replication's rows as a table, like batch_runner.run_batch returns
+        return pd.DataFrame(self.rows)
+
+
+def main():
+    # Model parameters, as in batch_runner.py
+    base_params = {
+        "num_providers": 3,
+        "initial_num_patients": 76,
+        "patient_incidence": 48,
+        "additive_adoption_preference": 0.5,
+        "ae_probability_additive": 0.3,
+        "ae_probability_subtractive": 0.3
+    }
+    time_period = 200
+
+    # Scenarios override some of the base parameters
+    scenarios = {
+        "baseline": base_params,
+        "additive_ae_0.2": {**base_params, "ae_probability_additive": 0.2},
+        "subtractive_ae_0.4": {**base_params, "ae_probability_subtractive": 0.4},
+        "additive_preference_0.7": {**base_params, "additive_adoption_preference": 0.7}
+    }
+
+    controller = ReplicationController(scenarios, time_period, relative_precision=0.01)
+    summary = controller.run()
+    print("\nReplication Summary (means with 95% confidence intervals):")
+    print(summary.to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
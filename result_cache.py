@@ -0,0 +1,140 @@
+import glob
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import time
+import uuid
+import mesa
+import pandas as pd
+from data_recorder import DataRecorder
+from implant_market_model import ImplantMarketModel
+
+# Define ResultCache
+# On-disk cache of finished runs, shared by main.py and app.py. An entry is keyed by a hash of everything that decides
+# the result: every ImplantMarketModel constructor argument (the ones the caller passed, the defaults for the rest, see
+# run_arguments), the time period and the model code version (a hash of MODEL_MODULES and the Mesa version, so
+# editing the model invalidates old entries). Each entry holds the run's recorded tables (a closed DataRecorder output
+# directory) and its summaries.
+# Entries are built in a staging directory and renamed into place when complete, so a run that is stopped or fails
+# never leaves a partial entry. The cache is kept under max_bytes by evicting the least recently used entries.
+
+MODEL_MODULES = ["implant_market_model.py", "manufacturer_agent.py", "healthcare_provider_agent.py",
+                 "patient_agent.py", "cohort_engine.py", "random_streams.py", "variate_supply.py",
+                 "provider_assignment.py", "waiting_queue.py", "follow_up_calendar.py", "production_pipeline.py",
+                 "manufacturer_registry.py", "patient_archive.py", "run_metrics.py", "summaries.py", "event_log.py",
+                 "data_recorder.py", "model_log.py"]  # Every source implant_market_model.py imports
+RUN_INDEPENDENT_ARGUMENTS = ["recorder", "log_level", "log_stream", "metrics_sink",
+                             "profiler"]  # ImplantMarketModel arguments that do not change a run's results
+
+
+def model_code_version():
+    source_dir = os.path.dirname(os.path.abspath(__file__))
+    digest = hashlib.sha256(f"mesa {mesa.__version__}".encode())  # RandomActivation decides the agent order
+    for name in MODEL_MODULES:
+        with open(os.path.join(source_dir, name), "rb") as source_file:
+            digest.update(name.encode() + source_file.read())
+    return digest.hexdigest()[:16]
+
+
+def run_arguments(run_params):
+    # run_params: ImplantMarketModel arguments by name plus time_period. Returns every constructor argument that can
+    # change the results, with the defaults filled in, so an option the caller left at its default is still in the key
+    params = dict(run_params)
+    if "time_period" not in params:
+        raise ValueError("run_params need the time_period")
+    time_period = params.pop("time_period")
+    try:
+        arguments = inspect.signature(ImplantMarketModel.__init__).bind(None, **params)
+    except TypeError as error:
+        raise ValueError(f"run_params do not match the ImplantMarketModel arguments: {error}") from None
+    arguments.apply_defaults()
+    return {**{name: value for name, value in list(arguments.arguments.items())[1:]
+               if name not in RUN_INDEPENDENT_ARGUMENTS}, "time_period": time_period}
+
+
+class CachedRun:
+    def __init__(self, entry_dir):
+        self.entry_dir = entry_dir
+        with open(os.path.join(entry_dir, "meta.json")) as meta_file:
+            self.meta = json.load(meta_file)
+        self.recorder = DataRecorder.load(os.path.join(entry_dir, "recorded"))
+        self.summaries = {name: pd.read_pickle(os.path.join(entry_dir, "summaries", f"{name}.pkl"))
+                          for name in self.meta["summaries"]}
+
+
+class ResultCache:
+    def __init__(self, cache_dir="model_cache", max_bytes=2 * 2 ** 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.code_version = model_code_version()
+        os.makedirs(os.path.join(cache_dir, "staging"), exist_ok=True)
+
+    def key(self, run_params):  # run_params: the ImplantMarketModel arguments by name and time_period, see run_arguments
+        run_params = run_arguments(run_params)
+        if run_params["seed"] is None:
+            raise ValueError("Only seeded runs can be cached")
+        key_source = json.dumps({"params": run_params, "code_version": self.code_version}, sort_keys=True)
+        return hashlib.sha256(key_source.encode()).hexdigest()[:32]
+
+    def entry_dir(self, key):
+        return os.path.join(self.cache_dir, "entries", key)
+
+    def load(self, key):  # CachedRun, or None on a miss
+        entry_dir = self.entry_dir(key)
+        if not os.path.exists(os.path.join(entry_dir, "meta.json")):
+            return None
+        os.utime(entry_dir)  # The directory's modification time records the last use
+        return CachedRun(entry_dir)
+
+    def staging_dir(self):  # Fresh directory to record a run into, pass it to store() once the run is complete
+        staging_dir = os.path.join(self.cache_dir, "staging", uuid.uuid4().hex)
+        os.makedirs(staging_dir)
+        return staging_dir
+
+    def recorder_dir(self, staging_dir):  # Where the run's DataRecorder writes inside a staging directory
+        return os.path.join(staging_dir, "recorded")
+
+    def store(self, key, staging_dir, run_params, summaries):  # summaries: {name: DataFrame}
+        os.makedirs(os.path.join(staging_dir, "summaries"), exist_ok=True)
+        for name, frame in summaries.items():
+            frame.to_pickle(os.path.join(staging_dir, "summaries", f"{name}.pkl"))
+        with open(os.path.join(staging_dir, "meta.json"), "w") as meta_file:
+            json.dump({"params": run_arguments(run_params), "code_version": self.code_version, "created": time.time(),
+                       "summaries": list(summaries)}, meta_file)
+
+        entry_dir = self.entry_dir(key)
+        os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+        try:
+            os.rename(staging_dir, entry_dir)
+        except OSError:  # Stored meanwhile by another run with the same key
+            shutil.rmtree(staging_dir, ignore_errors=True)
+        os.utime(entry_dir)
+        self.evict(keep=entry_dir)
+
+    def discard(self, staging_dir):  # Drop the staging directory of a run that did not finish
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+    # Size limit ------------------------------------------------------------------------------------
+    def entries(self):  # (last use, bytes, entry directory) for every complete entry
+        entries = []
+        for entry_dir in glob.glob(os.path.join(self.cache_dir, "entries", "*")):
+            size = sum(os.path.getsize(os.path.join(root, name))
+                       for root, _, names in os.walk(entry_dir) for name in names)
+            entries.append((os.path.getmtime(entry_dir), size, entry_dir))
+        return entries
+
+    def evict(self, keep=None):  # Remove least recently used entries until the cache fits in max_bytes
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in entries:
+            if total <= self.max_bytes:
+                break
+            if entry_dir != keep:
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                total -= size
+
+    def clear(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        os.makedirs(os.path.join(self.cache_dir, "staging"), exist_ok=True)
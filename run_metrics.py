@@ -0,0 +1,90 @@
+import numpy as np
+import pandas as pd
+from patient_agent import HEALTH_STATES
+from summaries import UTILITY_VALUES, average_utility
+
+# Define RunMetrics
+# The run summaries main.py and app.py print, kept up to date by the model as the run goes instead of being computed
+# afterwards from the recorded tables. Providers (and the cohort engine, in batch) report every patient assigned to a
+# manufacturer and every change of an assigned patient's health, so the current health counts per manufacturer are
+# always known. At the end of each step the model adds its manufacturer rows to the totals and the average utility of
+# each manufacturer's patients is appended to a per-step series. Everything is O(manufacturers x health states) per
+# step, so a run with record_mode="summary" never holds per-patient history.
+# Frames come in the formats of summaries.py: manufacturer_summary, patient_health_summary, average_utility, plus
+# utility_series (step, manufacturer_id, average_utility) with NaN for a manufacturer that has no patients yet.
+
+TOTAL_COLUMNS = ["revenue", "costs", "profit"]  # Recorded manufacturer columns summed over all steps
+
+
+class RunMetrics:
+    def __init__(self, manufacturer_ids):
+        self.manufacturer_ids = list(manufacturer_ids)  # Positions match model.manufacturers
+        self.health_counts = np.zeros((len(self.manufacturer_ids), len(HEALTH_STATES)), dtype=np.int64)
+        self.totals = np.zeros((len(self.manufacturer_ids), len(TOTAL_COLUMNS)))
+        self.utility_weights = np.array([UTILITY_VALUES[state] for state in HEALTH_STATES])
+        self.utility_steps = []  # Step of each entry of utility_values
+        self.utility_values = []  # Average utility per manufacturer position at the end of each step, NaN if none
+
+    # Updates from the model ------------------------------------------------------------------------
+    def patient_assigned(self, position, health_status):  # A patient chose the manufacturer at position
+        self.health_counts[position, health_status] += 1
+
+    def health_changed(self, position, before, after):
+        if before != after:
+            self.health_counts[position, before] -= 1
+            self.health_counts[position, after] += 1
+
+    def patients_assigned(self, positions, health_status):  # Batch versions for the cohort engine
+        np.add.at(self.health_counts, (positions, health_status), 1)
+
+    def health_changed_many(self, positions, before, after):
+        np.subtract.at(self.health_counts, (positions, before), 1)
+        np.add.at(self.health_counts, (positions, after), 1)
+
+    def end_step(self, step, manufacturer_rows):  # manufacturer_rows: the rows recorded in the manufacturer table
+        for position, row in enumerate(manufacturer_rows):
+            for column, name in enumerate(TOTAL_COLUMNS):
+                self.totals[position, column] += row[name]
+        self.utility_steps.append(step)
+        self.utility_values.append(self.current_utility())
+
+    # Reading ---------------------------------------------------------------------------------------
+    def current_utility(self):  # Average utility of each manufacturer's patients now, NaN without patients
+        patients = self.health_counts.sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.health_counts @ self.utility_weights / patients
+
+    def manufacturer_summary(self):
+        return pd.DataFrame(self.totals, columns=TOTAL_COLUMNS,
+                            index=pd.CategoricalIndex(self.manufacturer_ids, categories=self.manufacturer_ids,
+                                                      name='manufacturer_id'))
+
+    def patient_health_summary(self):
+        positions, states = np.nonzero(self.health_counts)
+        summary = pd.DataFrame({
+            'manufacturer_id': [self.manufacturer_ids[position] for position in positions.tolist()],
+            'health_status': pd.Categorical([HEALTH_STATES[state] for state in states.tolist()],
+                                            categories=HEALTH_STATES),
+            'counts': self.health_counts[positions, states]
+        })
+        return summary.sort_values(['manufacturer_id', 'health_status']).reset_index(drop=True)
+
+    def average_utility(self):
+        return average_utility(self.patient_health_summary())
+
+    def utility_series(self):  # One row per step and manufacturer
+        values = np.array(self.utility_values).reshape(len(self.utility_steps), len(self.manufacturer_ids))
+        return pd.DataFrame({
+            'step': np.repeat(self.utility_steps, len(self.manufacturer_ids)),
+            'manufacturer_id': np.tile(self.manufacturer_ids, len(self.utility_steps)),
+            'average_utility': values.ravel()
+        })
+
+    def summaries(self):  # The summaries.run_summaries frames plus utility_series
+        health_summary = self.patient_health_summary()
+        return {
+            "manufacturer_summary": self.manufacturer_summary(),
+            "patient_health_summary": health_summary,
+            "average_utility": average_utility(health_summary),
+            "utility_series": self.utility_series()
+        }
@@ -0,0 +1,284 @@
+import multiprocessing
+import os
+import sys
+import tempfile
+import traceback
+import numpy as np
+import pyarrow as pa
+from implant_market_model import ImplantMarketModel
+from data_recorder import DataRecorder, column_specs
+from event_log import reconstruct_cross_section
+
+# Define ShardedSimulation
+# Runs one national market as several regions, each an ImplantMarketModel with its own providers and patients in its
+# own process, so the regions step in parallel. Every region model has a replica of the shared manufacturers. Orders,
+# revenue and production stay with the replica of the region that placed them. Every sync_interval steps the
+# coordinator reconciles the manufacturers' books:
+#   inventory  the implants on hand in all regions are pooled and handed back in proportion to each region's surgery
+#              patients waiting for an implant of that manufacturer (what is left over stays where it was)
+#   orders     the regions' cumulative orders are added up in order_book
+# With referrals=True, unassigned patients a region has no capacity for are also referred to regions with free
+# capacity at each sync (engine="agent" only).
+# Each region records into output_dir/regions/<region>, and close() merges them into output_dir in the single model
+# schema: manufacturer rows summed over regions, provider ids renumbered as if all providers were in one model and
+# patient ids prefixed with the region ("r0:", "r1:", ...). A referred patient keeps the id of the region it spawned in,
+# and the admitting region records a "referral" event for it.
+# Running this file checks that the merged event log of a run with referrals rebuilds the same patient table as
+# snapshot mode at every step, see check_event_log.
+#
+#   simulation = ShardedSimulation(split_regions(300, 20_000, 96, 8), 0.5, 0.3, 0.3, "national", seed=1)
+#   simulation.run(3650)
+#   recorder = simulation.close()  # DataRecorder of the merged tables
+
+
+def split_regions(num_providers, initial_num_patients, patient_incidence, num_regions):
+    # Region sizes for an even split of the providers, initial patients and incidence
+    def split(total):
+        return [total // num_regions + (region < total % num_regions) for region in range(num_regions)]
+    return [{"num_providers": providers, "initial_num_patients": patients, "patient_incidence": incidence}
+            for providers, patients, incidence in zip(split(num_providers), split(initial_num_patients),
+                                                      split(patient_incidence))]
+
+
+def region_seeds(seed, num_regions):  # Independent seeds for the region models, derived from the simulation seed
+    return [int(sequence.generate_state(1)[0]) for sequence in np.random.SeedSequence(seed).spawn(num_regions)]
+
+
+def allocate_inventory(inventories, demands):
+    # Split the pooled inventory of one manufacturer between the regions, in proportion to demand up to the demand
+    total = sum(inventories)
+    wanted = sum(demands)
+    if wanted == 0:
+        return list(inventories)
+    if total >= wanted:  # Every region gets its demand, the rest stays with the regions holding it now
+        spare = [max(inventory - demand, 0) for inventory, demand in zip(inventories, demands)]
+        allocation = list(demands)
+        leftover = total - wanted
+        for region in np.argsort(spare, kind='stable')[::-1].tolist():
+            share = min(spare[region], leftover)
+            allocation[region] += share
+            leftover -= share
+        return allocation
+    shares = np.array(demands, dtype=float) * total / wanted  # Shortage, largest remainders get the odd implants
+    allocation = np.floor(shares).astype(int)
+    for region in np.argsort(allocation - shares, kind='stable')[:total - int(allocation.sum())].tolist():
+        allocation[region] += 1
+    return allocation.tolist()
+
+
+# Region processes ------------------------------------------------------------------------------------
+def region_report(model):
+    return {
+        "step": model.schedule.steps,
+        "inventory": [manufacturer.inventory for manufacturer in model.manufacturers],
+        "implants_ordered": [manufacturer.implants_ordered for manufacturer in model.manufacturers],
+        "demand": model.implant_demand(),
+        "waiting": len(model.patients_needing_surgery),
+        "free_capacity": model.free_capacity()
+    }
+
+
+def run_region(connection, model_args, model_kwargs, output_dir):
+    # Region process: builds the model, then carries out the coordinator's commands until "close"
+    try:
+        recorder = DataRecorder(output_dir)
+        model = ImplantMarketModel(*model_args, recorder=recorder, **model_kwargs)
+        connection.send(("ok", region_report(model)))
+        while True:
+            command, argument = connection.recv()
+            if command == "run":
+                for i in range(argument):
+                    model.step()
+                reply = region_report(model)
+            elif command == "set_inventory":
+                for manufacturer, inventory in zip(model.manufacturers, argument):
+                    manufacturer.inventory = inventory
+                reply = None
+            elif command == "release":
+                reply = model.release_waiting(argument)
+            elif command == "admit":
+                model.admit_referrals(argument)
+                reply = None
+            elif command == "close":
+                recorder.close()
+                connection.send(("ok", None))
+                return
+            else:
+                raise ValueError(f"Unknown region command {command!r}")
+            connection.send(("ok", reply))
+    except Exception:
+        connection.send(("error", traceback.format_exc()))
+    finally:
+        connection.close()
+
+
+class ShardedSimulation:
+    def __init__(self, regions, additive_adoption_preference, ae_probability_additive, ae_probability_subtractive,
+                 output_dir, sync_interval=7, referrals=False, seed=None, engine="agent", record_mode="events",
+                 **model_kwargs):
+        # regions: one dict per region with num_providers, initial_num_patients and patient_incidence, see
+        # split_regions. model_kwargs go to every region's ImplantMarketModel
+        if sync_interval < 1:
+            raise ValueError(f"sync_interval must be at least one step, got {sync_interval}")
+        if referrals and engine != "agent":
+            raise ValueError("Referrals between regions need engine='agent'")
+        self.regions = regions
+        self.output_dir = output_dir
+        self.sync_interval = sync_interval
+        self.referrals = referrals
+        self.record_mode = record_mode
+        self.steps = 0
+        self.order_book = None  # Implants ordered from each manufacturer over all regions, updated at every sync
+        self.referred = 0  # Patients referred between regions so far
+        self.region_dirs = [os.path.join(output_dir, "regions", str(region)) for region in range(len(regions))]
+        self.connections = []
+        self.processes = []
+        context = multiprocessing.get_context("spawn")  # Fresh interpreters, the same on every platform
+        for region, (sizes, region_seed) in enumerate(zip(regions, region_seeds(seed, len(regions)))):
+            model_args = (sizes["num_providers"], sizes["initial_num_patients"], sizes["patient_incidence"],
+                          additive_adoption_preference, ae_probability_additive, ae_probability_subtractive)
+            kwargs = {"log_level": "silent", **model_kwargs, "engine": engine, "record_mode": record_mode,
+                      "seed": region_seed, "patient_id_prefix": f"r{region}:"}
+            parent_connection, child_connection = context.Pipe()
+            process = context.Process(target=run_region, daemon=True,
+                                      args=(child_connection, model_args, kwargs, self.region_dirs[region]))
+            process.start()
+            child_connection.close()
+            self.connections.append(parent_connection)
+            self.processes.append(process)
+        self.reports = self.receive_all()  # The first reconcile comes after the first sync_interval steps
+
+    # Talking to the regions ------------------------------------------------------------------------
+    def send(self, region, command, argument=None):
+        self.connections[region].send((command, argument))
+
+    def receive(self, region):
+        try:
+            status, reply = self.connections[region].recv()
+        except EOFError:
+            raise RuntimeError(f"Region {region} stopped unexpectedly") from None
+        if status == "error":
+            raise RuntimeError(f"Region {region} failed:\n{reply}")
+        return reply
+
+    def receive_all(self):
+        return [self.receive(region) for region in range(len(self.regions))]
+
+    def broadcast(self, command, arguments):  # One argument per region, every region works at the same time
+        for region, argument in enumerate(arguments):
+            self.send(region, command, argument)
+        return self.receive_all()
+
+    # Running ---------------------------------------------------------------------------------------
+    def run(self, steps):
+        while steps > 0:
+            chunk = min(steps, self.sync_interval - self.steps % self.sync_interval)
+            self.reports = self.broadcast("run", [chunk] * len(self.regions))
+            self.steps += chunk
+            steps -= chunk
+            if self.steps % self.sync_interval == 0:
+                self.reconcile()
+
+    def reconcile(self):
+        # Pool and reallocate every manufacturer's inventory, add up the order book and refer patients
+        num_manufacturers = len(self.reports[0]["inventory"])
+        allocations = [allocate_inventory([report["inventory"][m] for report in self.reports],
+                                          [report["demand"][m] for report in self.reports])
+                       for m in range(num_manufacturers)]
+        self.broadcast("set_inventory", [[allocations[m][region] for m in range(num_manufacturers)]
+                                         for region in range(len(self.regions))])
+        self.order_book = [sum(report["implants_ordered"][m] for report in self.reports)
+                           for m in range(num_manufacturers)]
+        if self.referrals:
+            self.refer_patients()
+
+    def refer_patients(self):
+        # Move waiting patients a region cannot take on next step to regions with capacity to spare
+        surplus = [max(report["waiting"] - report["free_capacity"], 0) for report in self.reports]
+        spare = [max(report["free_capacity"] - report["waiting"], 0) for report in self.reports]
+        moves = []  # (from region, to region, patients)
+        for source in np.argsort(surplus, kind='stable')[::-1].tolist():
+            for target in np.argsort(spare, kind='stable')[::-1].tolist():
+                count = min(surplus[source], spare[target])
+                if count == 0 or source == target:
+                    continue
+                moves.append((source, target, count))
+                surplus[source] -= count
+                spare[target] -= count
+        for source, target, count in moves:
+            self.send(source, "release", count)
+            referrals = self.receive(source)
+            self.send(target, "admit", referrals)
+            self.receive(target)
+            self.referred += len(referrals)
+
+    # Output ----------------------------------------------------------------------------------------
+    def close(self):  # Stop the regions and merge their recordings, returns the merged DataRecorder
+        self.broadcast("close", [None] * len(self.regions))
+        for process in self.processes:
+            process.join()
+        return merge_regions(self.region_dirs, self.output_dir, [sizes["num_providers"] for sizes in self.regions])
+
+
+def merge_regions(region_dirs, output_dir, region_providers):
+    # Merge closed region recordings into output_dir in the single model schema
+    region_recorders = [DataRecorder.load(region_dir) for region_dir in region_dirs]
+    merged = DataRecorder(output_dir)
+    provider_offsets = np.cumsum([0] + list(region_providers[:-1])).tolist()
+    for name, table in region_recorders[0].tables.items():
+        stored = []
+        for recorder, offset in zip(region_recorders, provider_offsets):
+            region_table = recorder[name].stored_table()
+            if name == "provider":  # Number the providers as one model would
+                region_table = region_table.set_column(
+                    region_table.schema.get_field_index("provider_id"), "provider_id",
+                    pa.array(region_table["provider_id"].to_numpy() + offset, type=pa.int32()))
+            stored.append(region_table)
+        rows = pa.concat_tables(stored)
+        if name == "manufacturer":  # The manufacturers are shared, their rows are summed over the regions
+            frame = rows.to_pandas().groupby(["step", "manufacturer_id"], as_index=False, sort=True).sum()
+            rows = pa.Table.from_pandas(frame[table.schema.names], schema=table.schema, preserve_index=False)
+        else:
+            order = np.argsort(rows["step"].to_numpy(), kind='stable')  # Step by step, regions in order
+            rows = rows.take(pa.array(order))
+        merged.add_table(name, column_specs(table.columns)).restore(rows)
+    merged.close()
+    return merged
+
+
+# Checking --------------------------------------------------------------------------------------------
+def check_event_log(regions, steps, output_dir, seed=0, **simulation_kwargs):
+    # Run the same sharded simulation in "events" and "snapshot" mode and return the steps whose patient table rebuilt
+    # from the merged event log differs from the merged snapshots, an empty list when every step matches
+    recorders = {}
+    for record_mode in ("events", "snapshot"):
+        simulation = ShardedSimulation(regions, 0.5, 0.3, 0.3, os.path.join(output_dir, record_mode), seed=seed,
+                                       record_mode=record_mode, **simulation_kwargs)
+        simulation.run(steps)
+        recorders[record_mode] = simulation.close()
+    events = recorders["events"].read_frame("patient_events")
+    mismatched = []
+    for step in range(1, steps + 1):
+        snapshot = recorders["snapshot"].read_frame("patient", step=step)
+        rebuilt = reconstruct_cross_section(events, step)[snapshot.columns]
+        snapshot, rebuilt = (frame.sort_values("patient_id").reset_index(drop=True).astype(str)
+                             for frame in (snapshot, rebuilt))
+        if not snapshot.equals(rebuilt):
+            mismatched.append(step)
+    return mismatched
+
+
+def main():
+    # A region with spare providers next to a crowded one, so patients are referred at every sync
+    regions = [{"num_providers": 6, "initial_num_patients": 0, "patient_incidence": 1},
+               {"num_providers": 1, "initial_num_patients": 60, "patient_incidence": 20}]
+    with tempfile.TemporaryDirectory() as output_dir:
+        mismatched = check_event_log(regions, 30, output_dir, seed=1, referrals=True, sync_interval=3)
+    if mismatched:
+        print(f"Event log and snapshots disagree at steps {mismatched}")
+        sys.exit(1)
+    print("Event log rebuilds the snapshot patient table at every step")
+
+
+if __name__ == "__main__":
+    main()
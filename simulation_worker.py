@@ -0,0 +1,166 @@
+import io
+import queue
+import threading
+import pandas as pd
+from implant_market_model import ImplantMarketModel
+from data_recorder import DataRecorder
+from summaries import average_utility
+
+# Define SimulationWorker
+# Runs an ImplantMarketModel on a background thread for the Streamlit app and publishes one small update per step
+# (the step's manufacturer rows and average utility, log text and, every summary_every steps, the patient health
+# summary from the model's RunMetrics) on a queue.
+# The UI drains the queue at its own refresh rate, so the model never waits for the charts. stop() ends the run after
+# the current step. The last item on the queue is None.
+# With a ResultCache and cache_key the run is recorded into a staging directory of the cache and stored under the key
+# when it completes. A stopped or failed run is discarded.
+
+
+class SimulationWorker(threading.Thread):
+    def __init__(self, model_args, time_period, summary_every=1, cache=None, cache_key=None, run_params=None,
+                 **model_kwargs):
+        super().__init__(daemon=True)
+        self.time_period = time_period
+        self.summary_every = summary_every
+        self.cache = cache if cache_key is not None else None
+        self.cache_key = cache_key
+        self.run_params = run_params
+        self.staging_dir = None
+        if self.cache is not None:
+            self.staging_dir = self.cache.staging_dir()
+            model_kwargs["recorder"] = DataRecorder(self.cache.recorder_dir(self.staging_dir))
+        self.updates = queue.Queue()
+        self.stop_requested = threading.Event()
+        self.log_buffer = io.StringIO()
+        self.step_metrics = None
+        model_kwargs.setdefault("record_mode", "events")  # The UI works from the updates, keep the recording small
+        model_kwargs.setdefault("log_level", "verbose")  # The app shows the log below the charts
+        self.model = ImplantMarketModel(*model_args, log_stream=self.log_buffer, metrics_sink=self, **model_kwargs)
+
+    def stop(self):
+        self.stop_requested.set()
+
+    # Metrics sink, see model_log.py
+    def emit(self, metrics):
+        self.step_metrics = metrics
+
+    def close(self):
+        pass
+
+    def run(self):
+        completed = False
+        try:
+            for i in range(self.time_period):
+                if self.stop_requested.is_set():
+                    break
+                self.model.step()
+                update = {"metrics": self.step_metrics, "log": self.log_buffer.getvalue()}
+                self.log_buffer.seek(0)
+                self.log_buffer.truncate()
+                if (i + 1) % self.summary_every == 0 or i == self.time_period - 1:
+                    update["health_summary"] = self.model.run_metrics.patient_health_summary()
+                self.updates.put(update)
+            else:
+                completed = True
+            if completed and self.cache is not None:
+                self.model.recorder.close()
+                self.cache.store(self.cache_key, self.staging_dir, self.run_params,
+                                 self.model.run_metrics.summaries())
+        except Exception as error:  # Shown by the UI instead of dying silently on the thread
+            completed = False
+            self.updates.put({"error": repr(error)})
+        finally:
+            if not completed and self.cache is not None:
+                self.cache.discard(self.staging_dir)
+            self.updates.put(None)
+
+
+# Define RunResults
+# What the UI has received so far from a SimulationWorker. Each drain only appends the new steps, so nothing is
+# recomputed from the full history while the run goes on.
+class RunResults:
+    def __init__(self, manufacturer_names):
+        self.manufacturer_names = manufacturer_names  # manufacturer_id: name shown in the charts and tables
+        self.revenue = []  # {step, <manufacturer name>: revenue} per step
+        self.profit = []
+        self.utility = []  # {step, <manufacturer name>: average utility of its patients} per step
+        self.totals = {}  # Manufacturer name: sums of the recorded columns over all steps
+        self.health_summary = None
+        self.log = ""
+        self.steps = 0
+        self.done = False
+        self.error = None
+
+    @classmethod
+    def from_cached(cls, cached_run, manufacturer_names):  # Results of a run loaded from a ResultCache entry
+        results = cls(manufacturer_names)
+        manufacturer_data = cached_run.recorder.read_frame('manufacturer')
+        for step, rows in manufacturer_data.groupby('step', sort=True):
+            results.apply({"metrics": {"step": step, "manufacturers": rows.to_dict('records')},
+                           "log": f"Loaded cached run from {cached_run.entry_dir}"})
+        if "utility_series" in cached_run.summaries:  # Entries stored before the series was kept have no utility chart
+            series = cached_run.summaries["utility_series"]
+            results.utility = series.assign(manufacturer_id=series["manufacturer_id"].map(manufacturer_names)).pivot(
+                index="step", columns="manufacturer_id", values="average_utility").reset_index().to_dict('records')
+        results.apply_health_summary(cached_run.summaries["patient_health_summary"])
+        results.done = True
+        return results
+
+    def drain(self, updates):  # Apply every update waiting on the queue, returns the number of new steps
+        new_steps = 0
+        while True:
+            try:
+                update = updates.get_nowait()
+            except queue.Empty:
+                return new_steps
+            if update is None:
+                self.done = True
+                return new_steps
+            if "error" in update:
+                self.error = update["error"]
+                continue
+            self.apply(update)
+            new_steps += 1
+
+    def apply(self, update):
+        metrics = update["metrics"]
+        revenue = {"step": metrics["step"]}
+        profit = {"step": metrics["step"]}
+        for row in metrics["manufacturers"]:
+            name = self.manufacturer_names[row["manufacturer_id"]]
+            revenue[name] = row["revenue"]
+            profit[name] = row["profit"]
+            totals = self.totals.setdefault(name, dict.fromkeys(["revenue", "costs", "profit", "inventory"], 0))
+            for column in totals:
+                totals[column] += row[column]
+        self.revenue.append(revenue)
+        self.profit.append(profit)
+        if "utility" in metrics:
+            utility = {"step": metrics["step"]}
+            for row, value in zip(metrics["manufacturers"], metrics["utility"]):
+                utility[self.manufacturer_names[row["manufacturer_id"]]] = value
+            self.utility.append(utility)
+        self.log = update["log"]
+        if "health_summary" in update:
+            self.apply_health_summary(update["health_summary"])
+        self.steps += 1
+
+    def apply_health_summary(self, health_summary):
+        self.health_summary = health_summary.assign(
+            manufacturer_id=health_summary["manufacturer_id"].map(self.manufacturer_names))
+
+    # Frames for the UI
+    def revenue_frame(self, start=0):  # Steps from start on, indexed by step
+        return pd.DataFrame(self.revenue[start:]).set_index("step")
+
+    def profit_frame(self, start=0):
+        return pd.DataFrame(self.profit[start:]).set_index("step")
+
+    def utility_frame(self, start=0):
+        return pd.DataFrame(self.utility[start:]).set_index("step")
+
+    def manufacturer_summary(self):
+        return pd.DataFrame.from_dict(self.totals, orient="index").rename_axis("manufacturer_id")
+
+    def average_utility(self):
+        return average_utility(self.health_summary)
@@ -0,0 +1,110 @@
+import collections
+import os
+import time
+import pandas as pd
+
+# Define StepProfiler
+# Optional instrumentation of ImplantMarketModel.step. When a StepProfiler is passed as the model's profiler it times
+# every phase of each step, the step() calls of each agent class, and counts the key operations. Without one the model
+# only pays for its "profiler is not None" checks.
+# Phases:
+#   spawn       try_spawn_patient
+#   assignment  assigning waiting patients to providers
+#   agents      schedule.step(), split by agent class in the "<class> step" columns
+#   waiting     the cohort engine's batch count of waiting days
+#   recording   building and recording the rows, logging and metrics
+# Counts: surgeries, follow-ups, get_patient_health_states calls and rows recorded in each step.
+
+PHASES = ["spawn", "assignment", "agents", "waiting", "recording"]
+COUNTS = ["surgeries", "follow_ups", "health_state_queries", "rows_recorded"]
+
+
+class StepProfiler:
+    def __init__(self):
+        self.rows = []  # One row of timings and counts per step
+        self.phase_seconds = dict.fromkeys(PHASES, 0.0)
+        self.agent_seconds = collections.defaultdict(float)  # Agent class name: seconds in step()
+        self.counts = dict.fromkeys(COUNTS, 0)
+        self.step = None
+        self.lap_start = None
+        self.step_start = None
+        self.surgeries_before = 0
+        self.rows_recorded_before = 0
+
+    # Hooks called by the model ---------------------------------------------------------------------
+    def instrument(self, agent):  # Time this agent's step() under its class name
+        name = type(agent).__name__
+        agent_step = agent.step
+
+        def timed_step():
+            start = time.perf_counter()
+            agent_step()
+            self.agent_seconds[name] += time.perf_counter() - start
+
+        agent.step = timed_step
+
+    def uninstrument(self, agent):  # Undo instrument, e.g. before the agent is pickled
+        vars(agent).pop("step", None)
+
+    def attach(self, model):  # Start profiling a model restored from a checkpoint
+        for agent in model.schedule.agents:
+            self.instrument(agent)
+        self.surgeries_before = sum(provider.cumulative_surgeries_performed for provider in model.providers)
+        self.rows_recorded_before = sum(table.rows_recorded for table in model.recorder.tables.values())
+
+    def start_step(self, step):
+        self.step = step
+        self.step_start = self.lap_start = time.perf_counter()
+
+    def lap(self, phase):  # Charge the time since the last lap to phase
+        now = time.perf_counter()
+        self.phase_seconds[phase] += now - self.lap_start
+        self.lap_start = now
+
+    def count(self, name, amount=1):
+        self.counts[name] += amount
+
+    def end_step(self, model):
+        self.lap("recording")
+        surgeries = sum(provider.cumulative_surgeries_performed for provider in model.providers)
+        rows_recorded = sum(table.rows_recorded for table in model.recorder.tables.values())
+        self.counts["surgeries"] = surgeries - self.surgeries_before
+        self.counts["rows_recorded"] = rows_recorded - self.rows_recorded_before
+        self.surgeries_before = surgeries
+        self.rows_recorded_before = rows_recorded
+
+        row = {"step": self.step, "total": time.perf_counter() - self.step_start}
+        row.update(self.phase_seconds)
+        row.update({f"{name} step": seconds for name, seconds in self.agent_seconds.items()})
+        row.update(self.counts)
+        self.rows.append(row)
+        self.phase_seconds = dict.fromkeys(PHASES, 0.0)
+        self.agent_seconds = collections.defaultdict(float)
+        self.counts = dict.fromkeys(COUNTS, 0)
+
+    # Results ---------------------------------------------------------------------------------------
+    def step_table(self):  # Seconds per phase and agent class, and the counts, for every step
+        return pd.DataFrame(self.rows).fillna(0.0)
+
+    def report(self):
+        table = self.step_table()
+        if table.empty:
+            return "No steps profiled"
+        timings = table.drop(columns=["step"] + COUNTS)
+        total = timings["total"].sum()
+        summary = pd.DataFrame({
+            "seconds": timings.sum(),
+            "ms_per_step": timings.mean() * 1000,
+            "share_of_total": timings.sum() / total
+        })
+        counts = table[COUNTS].agg(["sum", "mean"]).T
+        counts.columns = ["total", "per_step"]
+        return (f"Profiled {len(table)} steps in {total:.3f}s\n\n"
+                f"Time by phase and agent class (agent classes are part of 'agents'):\n{summary.to_string()}\n\n"
+                f"Operation counts:\n{counts.to_string()}")
+
+    def write_report(self, output_dir):  # step_timings.csv and timing_report.txt
+        os.makedirs(output_dir, exist_ok=True)
+        self.step_table().to_csv(os.path.join(output_dir, "step_timings.csv"), index=False)
+        with open(os.path.join(output_dir, "timing_report.txt"), "w") as report_file:
+            report_file.write(self.report() + "\n")
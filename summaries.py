@@ -0,0 +1,73 @@
+import collections
+import numpy as np
+import pandas as pd
+from patient_agent import HEALTH_STATES
+from event_log import read_patient_cross_section
+
+# Model summaries
+# The manufacturer and patient utility summaries printed by main.py, shared with the Streamlit app and the batch
+# runner so every entry point reports the same numbers.
+
+UTILITY_VALUES = {  # Utility of each health state
+    'minimal': 0.84,
+    'moderate': 0.61,
+    'severe': 0.55,
+    'crippled': 0.51,
+    'bedbound': 0.5
+}
+
+
+def manufacturer_summary(manufacturer_data, columns=('revenue', 'costs', 'profit')):
+    # Sum of each recorded column over all steps, per manufacturer
+    return manufacturer_data.groupby('manufacturer_id', observed=True).agg({column: 'sum' for column in columns})
+
+
+def patient_health_summary(final_step_data):  # Patient counts per manufacturer and health state
+    return final_step_data.groupby(['manufacturer_id', 'health_status'], observed=True).size().reset_index(
+        name='counts')
+
+
+def current_health_summary(model):
+    # patient_health_summary of the model's current state, counted from the patients instead of the recorded tables
+    manufacturer_ids = [manufacturer.unique_id for manufacturer in model.manufacturers]
+    if model.cohort is not None:
+        cohort = model.cohort
+        manufacturer_index = cohort.manufacturer_index[:len(cohort)]
+        assigned = manufacturer_index >= 0
+        codes = manufacturer_index[assigned].astype(np.int64) * len(HEALTH_STATES) + \
+            cohort.health_status[:len(cohort)][assigned]
+        counts = np.bincount(codes, minlength=len(manufacturer_ids) * len(HEALTH_STATES))
+        pairs = {(manufacturer_ids[code // len(HEALTH_STATES)], HEALTH_STATES[code % len(HEALTH_STATES)]): count
+                 for code, count in enumerate(counts.tolist()) if count}
+    else:
+        pairs = collections.Counter((patient.manufacturer_id, HEALTH_STATES[patient.health_status])
+                                    for patient in model.patients if patient.manufacturer_id is not None)
+        for (manufacturer_code, health_rank), count in model.patient_archive.health_counts.items():
+            if manufacturer_code >= 0:
+                pairs[manufacturer_ids[manufacturer_code], HEALTH_STATES[health_rank]] += count
+    summary = pd.DataFrame([(manufacturer_id, health_status, count)
+                            for (manufacturer_id, health_status), count in pairs.items()],
+                           columns=['manufacturer_id', 'health_status', 'counts'])
+    summary['health_status'] = pd.Categorical(summary['health_status'], categories=HEALTH_STATES)
+    return summary.sort_values(['manufacturer_id', 'health_status']).reset_index(drop=True)
+
+
+def average_utility(health_summary):  # Average patient utility per manufacturer, from patient_health_summary
+    health_summary = health_summary.assign(
+        total_utility=health_summary['health_status'].map(UTILITY_VALUES).astype(float) * health_summary['counts'])
+    # Total utility and number of patients for each manufacturer
+    manufacturer_total_utility = health_summary.groupby('manufacturer_id', observed=True)['total_utility'].sum()
+    manufacturer_patient_counts = health_summary.groupby('manufacturer_id', observed=True)['counts'].sum()
+    utility = (manufacturer_total_utility / manufacturer_patient_counts.astype(float)).reset_index()
+    utility.columns = ['manufacturer_id', 'average_utility']
+    return utility
+
+
+def run_summaries(recorder, step):
+    # The summaries main.py prints for a run recorded in events mode, patient states taken at step
+    health_summary = patient_health_summary(read_patient_cross_section(recorder, step))
+    return {
+        "manufacturer_summary": manufacturer_summary(recorder.read_frame('manufacturer')),
+        "patient_health_summary": health_summary,
+        "average_utility": average_utility(health_summary)
+    }
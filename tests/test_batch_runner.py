@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+import pytest
+from batch_runner import make_jobs, paired_differences, t_quantile
+from random_streams import RandomStreams, keyed_uniform, keyed_uniforms, patient_key
+
+
+@pytest.mark.parametrize("confidence, dof, expected", [
+    (0.95, 1, 12.7062), (0.95, 2, 4.3027), (0.95, 5, 2.5706), (0.95, 30, 2.0423), (0.99, 10, 3.1693),
+    (0.95, 31, 2.0395), (0.95, 120, 1.9799), (0.95, 100_000, 1.9600)])
+def test_t_quantile_matches_the_tables(confidence, dof, expected):
+    assert t_quantile(confidence, dof) == pytest.approx(expected, abs=1e-4)
+
+
+def test_t_quantile_needs_a_degree_of_freedom():
+    with pytest.raises(ValueError):
+        t_quantile(0.95, 0)
+
+
+def test_keyed_draws_match_their_batch_version():
+    key = RandomStreams(0).keys["surgery"]
+    keys = np.array([patient_key(unique_id) for unique_id in range(50)], dtype=np.uint64)
+    draws = np.arange(50) % 7
+    expected = [keyed_uniform(key, int(patient), int(n)) for patient, n in zip(keys, draws)]
+    np.testing.assert_array_equal(keyed_uniforms(key, keys, draws), expected)
+    uniforms = keyed_uniforms(key, np.repeat(keys, 200), np.tile(np.arange(200), 50))
+    assert ((uniforms >= 0) & (uniforms < 1)).all()
+    assert abs(uniforms.mean() - 0.5) < 0.01
+
+
+def test_streams_have_distinct_keys_repeated_by_the_seed():
+    keys = RandomStreams(5).keys
+    assert keys == RandomStreams(5).keys
+    assert len(set(keys.values())) == len(keys)
+    assert keys != RandomStreams(6).keys
+
+
+def test_common_random_numbers_share_seeds_across_scenarios():
+    scenarios = {"baseline": {}, "changed": {}}
+    paired = make_jobs(scenarios, 3, 10, common_random_numbers=True)
+    assert [job["seed"] for job in paired[:3]] == [job["seed"] for job in paired[3:]]
+    independent = make_jobs(scenarios, 3, 10)
+    assert not {job["seed"] for job in independent[:3]} & {job["seed"] for job in independent[3:]}
+
+
+def results_frame(seeds, values):  # One manufacturer's rows of two scenarios, replication by replication
+    return pd.DataFrame([{"scenario": scenario, "replication": replication, "seed": seed, "manufacturer_id": 0,
+                          "revenue": value}
+                         for scenario in ("baseline", "changed")
+                         for replication, (seed, value) in enumerate(zip(seeds[scenario], values[scenario]))])
+
+
+def test_paired_differences_reports_the_variance_reduction():
+    baseline = np.array([10.0, 12.0, 9.0, 14.0, 11.0])
+    changed = baseline + np.array([1.0, 1.5, 0.5, 1.0, 1.0])
+    seeds = {"baseline": [1, 2, 3, 4, 5], "changed": [1, 2, 3, 4, 5]}
+    row = paired_differences(results_frame(seeds, {"baseline": baseline, "changed": changed}), "baseline",
+                             metrics=("revenue",)).iloc[0]
+    differences = changed - baseline
+    assert row["pairs"] == 5
+    assert row["difference"] == pytest.approx(differences.mean())
+    half_width = t_quantile(0.95, 4) * differences.std(ddof=1) / np.sqrt(5)
+    assert row["ci_high"] - row["ci_low"] == pytest.approx(2 * half_width)
+    assert row["variance_reduction"] == pytest.approx(
+        (baseline.var(ddof=1) + changed.var(ddof=1)) / differences.var(ddof=1))
+
+
+def test_paired_differences_rejects_unpaired_seeds():
+    seeds = {"baseline": [1, 2, 3], "changed": [1, 2, 4]}
+    results = results_frame(seeds, {"baseline": [1.0, 2.0, 3.0], "changed": [1.0, 2.0, 3.0]})
+    with pytest.raises(ValueError):
+        paired_differences(results, "baseline", metrics=("revenue",))
@@ -0,0 +1,26 @@
+import itertools
+from benchmark import BASE_CASE, GRID_AXES, SCALING_AXES, compare, make_cases
+
+
+def test_axes_suite_varies_one_parameter_at_a_time():
+    for case in make_cases("axes", ["agent"]):
+        changed = [axis for axis in SCALING_AXES if case[axis] != BASE_CASE[axis]]
+        assert len(changed) <= 1
+
+
+def test_grid_suite_runs_every_combination():
+    cases = make_cases("grid", ["agent"])
+    combinations = {tuple(case[axis] for axis in GRID_AXES) for case in cases}
+    assert combinations == set(itertools.product(*GRID_AXES.values()))
+    assert len(cases) == len(combinations)
+
+
+def test_compare_flags_regressions():
+    baseline = {"results": [{"name": "a", "wall_seconds": 1.0, "peak_rss_mb": 100.0},
+                            {"name": "b", "wall_seconds": 1.0, "peak_rss_mb": 100.0}]}
+    current = {"results": [{"name": "a", "wall_seconds": 1.05, "peak_rss_mb": 100.0},
+                           {"name": "b", "wall_seconds": 1.5, "peak_rss_mb": 130.0},
+                           {"name": "c", "wall_seconds": 9.0, "peak_rss_mb": 100.0}]}
+    lines, regressions = compare(baseline, current, threshold=0.10)
+    assert regressions == 1
+    assert len(lines) == 2 and "SLOWER MORE MEMORY" in lines[1]
@@ -0,0 +1,59 @@
+import pandas as pd
+import pytest
+from checkpoint import fork_checkpoint, load_checkpoint, save_checkpoint
+from implant_market_model import ImplantMarketModel
+
+PARAMS = (3, 20, 4, 0.5, 0.3, 0.3)
+BURN_IN = 150  # Steps before the checkpoint, enough for surgeries, follow-ups and queued patients
+STEPS = 300
+
+
+def run_model(engine, record_mode, steps, model=None, **scenario):
+    if model is None:
+        model = ImplantMarketModel(*PARAMS, engine=engine, record_mode=record_mode, seed=5)
+    for name, value in scenario.items():  # Changed at the checkpoint, as fork_checkpoint does
+        setattr(model, name, value)
+    for i in range(steps - model.schedule.steps):
+        model.step()
+    return model
+
+
+def assert_same_run(model, expected):  # Every recorded table and every summary, row for row
+    assert model.schedule.steps == expected.schedule.steps
+    assert sorted(model.recorder.tables) == sorted(expected.recorder.tables)
+    for name in expected.recorder.tables:
+        pd.testing.assert_frame_equal(model.recorder.read_frame(name), expected.recorder.read_frame(name))
+    summaries, expected_summaries = model.run_metrics.summaries(), expected.run_metrics.summaries()
+    for name in expected_summaries:
+        pd.testing.assert_frame_equal(summaries[name], expected_summaries[name])
+
+
+@pytest.mark.parametrize("engine", ["agent", "cohort"])
+@pytest.mark.parametrize("record_mode", ["snapshot", "events", "summary"])
+def test_resumed_run_matches_uninterrupted_run(tmp_path, engine, record_mode):
+    path = tmp_path / "burn_in.ckpt"
+    save_checkpoint(run_model(engine, record_mode, BURN_IN), path)
+    resumed = run_model(engine, record_mode, STEPS, load_checkpoint(path))
+    assert_same_run(resumed, run_model(engine, record_mode, STEPS))
+
+
+@pytest.mark.parametrize("engine", ["agent", "cohort"])
+@pytest.mark.parametrize("record_mode", ["snapshot", "events", "summary"])
+def test_forks_are_deterministic(tmp_path, engine, record_mode):
+    path = tmp_path / "burn_in.ckpt"
+    save_checkpoint(run_model(engine, record_mode, BURN_IN), path)
+    scenarios = [{"ae_probability_additive": 0.1}, {"ae_probability_additive": 0.1}, {"patient_incidence": 8}]
+    branches = [run_model(engine, record_mode, STEPS, branch) for branch in fork_checkpoint(path, scenarios)]
+    assert_same_run(branches[0], branches[1])  # The same scenario forked twice
+    with pytest.raises(AssertionError):  # A different scenario really did change the run
+        assert_same_run(branches[0], branches[2])
+    for branch, scenario in zip(branches, scenarios):  # Each branch as if the parameter changed in a direct run
+        direct = run_model(engine, record_mode, BURN_IN)
+        assert_same_run(branch, run_model(engine, record_mode, STEPS, direct, **scenario))
+
+
+def test_restore_rejects_structural_parameters(tmp_path):
+    path = tmp_path / "burn_in.ckpt"
+    save_checkpoint(run_model("agent", "summary", 10), path)
+    with pytest.raises(ValueError):
+        load_checkpoint(path, num_providers=5)
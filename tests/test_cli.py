@@ -0,0 +1,41 @@
+import json
+import pandas as pd
+import pytest
+import cli
+from event_log import reconstruct_patient_frame
+from implant_market_model import ImplantMarketModel
+
+STEPS = 120
+FLAGS = ["--steps", str(STEPS), "--seed", "2", "--initial-num-patients", "30", "--patient-incidence", "6",
+         "--queue-policy", "most_severe", "--format", "parquet"]
+
+
+def recorded_events():  # The same run as FLAGS, recorded in memory
+    model = ImplantMarketModel(3, 30, 6, 0.5, 0.3, 0.3, record_mode="events", seed=2, queue_policy="most_severe")
+    for i in range(STEPS):
+        model.step()
+    return model.recorder.read_frame("patient_events")
+
+
+@pytest.mark.parametrize("granularity", ["step", "every", "final"])
+def test_patient_export_matches_the_rebuilt_table(tmp_path, monkeypatch, granularity):
+    monkeypatch.setattr(cli, "EXPORT_CHUNK_ROWS", 500)  # Several chunks
+    cli.main(FLAGS + ["--output-dir", str(tmp_path), "--granularity", granularity, "--every", "7",
+                      "--tables", "patient", "manufacturer"])
+    steps = cli.selected_steps(STEPS, granularity, 7)
+    expected = reconstruct_patient_frame(recorded_events(), STEPS)
+    expected = expected[expected["step"].isin(steps)].reset_index(drop=True)
+    exported = pd.read_parquet(tmp_path / "patient.parquet")
+    pd.testing.assert_frame_equal(exported, expected, check_dtype=False, check_categorical=False)
+    assert sorted(pd.read_parquet(tmp_path / "manufacturer.parquet")["step"].unique()) == steps
+
+
+def test_policies_are_checked(tmp_path, capsys):
+    with pytest.raises(SystemExit):
+        cli.main(["--queue-policy", "shortest_first", "--output-dir", str(tmp_path)])
+    assert "invalid choice" in capsys.readouterr().err
+    config = tmp_path / "scenario.json"
+    config.write_text(json.dumps({"assignment_policy": "round_robin"}))
+    with pytest.raises(SystemExit):
+        cli.main(["--config", str(config), "--output-dir", str(tmp_path)])
+    assert "round_robin" in capsys.readouterr().err
@@ -0,0 +1,53 @@
+import pandas as pd
+import pytest
+from implant_market_model import ImplantMarketModel
+from data_recorder import DataRecorder
+from event_log import iter_cross_sections, reconstruct_cross_section, reconstruct_patient_frame
+
+# Long enough for the last follow-up two years after a surgery, so retired patients are in both tables
+STEPS = 800
+PARAMS = (3, 10, 2, 0.5, 0.3, 0.3)
+
+
+def run_model(engine, record_mode, steps=STEPS):
+    model = ImplantMarketModel(*PARAMS, engine=engine, record_mode=record_mode, seed=3, log_level="silent")
+    for i in range(steps):
+        model.step()
+    return model
+
+
+def by_step_and_patient(frame):  # Snapshots list archived patients after the active ones
+    return frame.sort_values(["step", "patient_id"]).reset_index(drop=True)
+
+
+@pytest.mark.parametrize("engine", ["agent", "cohort"])
+def test_event_log_rebuilds_snapshot_table(engine):
+    snapshot = run_model(engine, "snapshot").recorder.read_frame("patient")
+    events = run_model(engine, "events").recorder.read_frame("patient_events")
+    rebuilt = reconstruct_patient_frame(events, STEPS)[snapshot.columns]
+    pd.testing.assert_frame_equal(by_step_and_patient(rebuilt), by_step_and_patient(snapshot))
+
+
+@pytest.mark.parametrize("engine", ["agent", "cohort"])
+def test_cross_section_matches_snapshot_step(engine):
+    snapshot_model = run_model(engine, "snapshot", 120)
+    events = run_model(engine, "events", 120).recorder.read_frame("patient_events")
+    for step in (1, 42, 120):
+        snapshot = snapshot_model.recorder.read_frame("patient", step=step)
+        rebuilt = reconstruct_cross_section(events, step)[snapshot.columns]
+        pd.testing.assert_frame_equal(by_step_and_patient(rebuilt), by_step_and_patient(snapshot))
+
+
+@pytest.mark.parametrize("engine", ["agent", "cohort"])
+def test_one_pass_cross_sections_match_the_rebuilt_table(engine):
+    model = ImplantMarketModel(*PARAMS, engine=engine, record_mode="events", seed=3,
+                               recorder=DataRecorder(chunk_size=500))  # Small chunks, so steps span several frames
+    for i in range(STEPS):
+        model.step()
+    events = model.recorder.read_frame("patient_events")
+    expected = reconstruct_patient_frame(events, STEPS)
+    frames = [frame for step, frame in iter_cross_sections(model.recorder.iter_frames("patient_events"),
+                                                           range(1, STEPS + 1))]
+    pd.testing.assert_frame_equal(pd.concat(frames, ignore_index=True), expected)
+    for step, frame in iter_cross_sections(model.recorder.iter_frames("patient_events"), [STEPS, 1, 333]):
+        pd.testing.assert_frame_equal(frame, reconstruct_cross_section(events, step))
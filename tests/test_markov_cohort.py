@@ -0,0 +1,39 @@
+import os
+import subprocess
+import sys
+import pandas as pd
+from markov_cohort import UNVALIDATED_OUTPUTS, MarkovCohort, compare_with_replications, screen
+
+BASE_PARAMS = {"num_providers": 3, "initial_num_patients": 76, "patient_incidence": 48,
+               "additive_adoption_preference": 0.5, "ae_probability_additive": 0.3, "ae_probability_subtractive": 0.3}
+SCENARIOS = {"baseline": BASE_PARAMS, "additive_ae_0.2": {**BASE_PARAMS, "ae_probability_additive": 0.2}}
+
+
+def test_summary_leaves_out_unvalidated_outputs_unless_asked():
+    cohort = MarkovCohort(SCENARIOS).run(50)
+    summary = cohort.summary()
+    assert not set(UNVALIDATED_OUTPUTS) & set(summary.columns)
+    assert list(summary.columns) == ["scenario", "manufacturer_id", "revenue", "profit", "average_utility"]
+    full = cohort.summary(include_unvalidated=True)
+    assert set(UNVALIDATED_OUTPUTS) <= set(full.columns)
+    pd.testing.assert_frame_equal(full.drop(columns=UNVALIDATED_OUTPUTS), summary)
+    pd.testing.assert_frame_equal(screen(SCENARIOS, 50), summary)
+
+
+def test_comparison_covers_the_outputs_in_the_summary():
+    replications = pd.DataFrame([{"scenario": scenario, "manufacturer_id": manufacturer_id, "revenue": 100.0 + r,
+                                  "costs": 10.0 + r, "profit": 30.0 + r, "average_utility": 0.6}
+                                 for scenario in SCENARIOS for manufacturer_id in (0, 1) for r in range(3)])
+    validated = compare_with_replications(screen(SCENARIOS, 50), replications)
+    assert set(validated["output"]) == {"revenue", "profit", "average_utility"}
+    assert validated["validated"].all()
+    everything = compare_with_replications(screen(SCENARIOS, 50, include_unvalidated=True), replications)
+    assert set(everything["output"]) == {"revenue", "costs", "profit", "average_utility"}
+    assert not everything[everything["output"] == "costs"]["validated"].any()
+
+
+def test_screening_does_not_import_the_batch_runner():
+    loaded = subprocess.run([sys.executable, "-c", "import sys, markov_cohort; print('batch_runner' in sys.modules)"],
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), capture_output=True,
+                            text=True, check=True).stdout.strip()
+    assert loaded == "False"
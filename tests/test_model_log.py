@@ -0,0 +1,43 @@
+import io
+import json
+from implant_market_model import ImplantMarketModel
+from model_log import JsonLinesSink, RingBufferSink
+
+PARAMS = (3, 20, 6, 0.5, 0.3, 0.3)
+
+
+def run_model(steps=5, **kwargs):
+    model = ImplantMarketModel(*PARAMS, seed=0, **kwargs)
+    for i in range(steps):
+        model.step()
+    return model
+
+
+def test_default_model_prints_nothing(capsys):
+    run_model()
+    assert capsys.readouterr().out == ""
+
+
+def test_log_levels():
+    lines = {}
+    for level in ("info", "verbose"):
+        stream = io.StringIO()
+        run_model(log_level=level, log_stream=stream)
+        lines[level] = stream.getvalue().splitlines()
+    assert "Current step: 0" in lines["info"]
+    assert not any("new_row" in line for line in lines["info"])
+    assert any(line.startswith("Manufacturer new_row") for line in lines["verbose"])
+
+
+def test_metrics_sinks(tmp_path):
+    ring = RingBufferSink(capacity=3)
+    run_model(metrics_sink=ring)
+    assert [metrics["step"] for metrics in ring.metrics] == [3, 4, 5]
+
+    path = tmp_path / "metrics.jsonl"
+    sink = JsonLinesSink(path)
+    run_model(metrics_sink=sink)
+    sink.close()
+    metrics = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [row["step"] for row in metrics] == [1, 2, 3, 4, 5]
+    assert metrics[-1] == ring.latest()  # Same seed, same metrics
@@ -0,0 +1,46 @@
+import pandas as pd
+from implant_market_model import ImplantMarketModel
+
+PARAMS = (3, 10, 2, 0.5, 0.3, 0.3)
+STEPS = 800  # Past the last follow-up two years after the first surgeries
+
+
+def run_model(engine, retire_patients, record_mode="snapshot"):
+    model = ImplantMarketModel(*PARAMS, engine=engine, record_mode=record_mode, seed=3, retire_patients=retire_patients)
+    for i in range(STEPS):
+        model.step()
+    return model
+
+
+def test_retiring_cohort_patients_leaves_the_results_unchanged():
+    # Not for the agent engine, where retired patients also leave the schedule and so change RandomActivation's order
+    retired, kept = run_model("cohort", True), run_model("cohort", False)
+    assert sum(provider.retired_patients for provider in retired.providers) > 0
+    assert sum(provider.retired_patients for provider in kept.providers) == 0
+    for name in ("manufacturer", "provider"):  # cumulative_patients counts the retired patients too
+        pd.testing.assert_frame_equal(retired.recorder.read_frame(name), kept.recorder.read_frame(name))
+    patients, kept_patients = (model.recorder.read_frame("patient").sort_values(["step", "patient_id"])
+                               .reset_index(drop=True) for model in (retired, kept))
+    pd.testing.assert_frame_equal(patients, kept_patients)
+
+
+def test_agent_engine_archives_only_finished_patients():
+    model = run_model("agent", True)
+    assert len(model.patients) + len(model.patient_archive) == model.patients_spawned
+    assert sum(provider.retired_patients for provider in model.providers) == len(model.patient_archive)
+    assert list(model.patients) == sorted(model.patients, key=lambda patient: patient.step_spawned)  # Spawn order
+    for provider in model.providers:
+        for patient in provider.all_patients:
+            assert patient in model.patients
+            assert patient.next_follow_up is not None or patient.needs_urgent_surgery
+
+
+def test_cohort_engine_drops_finished_rows_from_all_patients():
+    model = run_model("cohort", True)
+    cohort = model.cohort
+    finished = sum(provider.retired_patients for provider in model.providers)
+    operated = (cohort.step_received_treatment[:len(cohort)] >= 0).sum()
+    assert finished + sum(len(provider.all_patients) for provider in model.providers) == operated
+    for provider in model.providers:
+        for row in provider.all_patients:
+            assert cohort.next_follow_up[row] >= 0 or cohort.needs_urgent_surgery[row]
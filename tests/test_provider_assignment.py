@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+from provider_assignment import ProviderAssignment
+
+
+class Provider:  # The two fields ProviderAssignment reads
+    def __init__(self, surgery_patients, patient_max_capacity=15):
+        self.surgery_patients = [None] * surgery_patients
+        self.patient_max_capacity = patient_max_capacity
+
+
+def loads_after(providers, chosen):
+    return [len(provider.surgery_patients) + int((chosen == i).sum()) for i, provider in enumerate(providers)]
+
+
+def test_least_loaded_fills_the_emptiest_provider_first():
+    providers = [Provider(10), Provider(2), Provider(6)]
+    chosen = ProviderAssignment(providers, np.random.default_rng(0), "least_loaded").assign(4)
+    assert chosen.tolist() == [1, 1, 1, 1]  # Provider 1 is still the least loaded after three patients
+
+
+def test_least_loaded_evens_out_the_loads():
+    providers = [Provider(10), Provider(2), Provider(6)]
+    chosen = ProviderAssignment(providers, np.random.default_rng(0), "least_loaded").assign(12)
+    assert loads_after(providers, chosen) == [10, 10, 10]
+
+
+def test_least_loaded_breaks_ties_at_random():
+    firsts = {int(ProviderAssignment([Provider(3) for i in range(4)], np.random.default_rng(seed),
+                                     "least_loaded").assign(1)[0]) for seed in range(50)}
+    assert firsts == {0, 1, 2, 3}
+
+
+def test_least_loaded_skips_full_providers():
+    providers = [Provider(15), Provider(14), Provider(0, patient_max_capacity=2)]
+    chosen = ProviderAssignment(providers, np.random.default_rng(0), "least_loaded").assign(10)
+    assert sorted(chosen.tolist()) == [1, 2, 2]  # Only the free capacity is handed out
+
+
+@pytest.mark.parametrize("policy", ["random", "least_loaded"])
+def test_assignment_never_exceeds_capacity(policy):
+    rng = np.random.default_rng(1)
+    providers = [Provider(int(load)) for load in rng.integers(0, 16, size=20)]
+    chosen = ProviderAssignment(providers, rng, policy).assign(1000)
+    free = sum(provider.patient_max_capacity - len(provider.surgery_patients) for provider in providers)
+    assert len(chosen) == free
+    assert all(load <= 15 for load in loads_after(providers, chosen))
+
+
+def test_unknown_policy_is_rejected():
+    with pytest.raises(ValueError):
+        ProviderAssignment([Provider(0)], np.random.default_rng(0), "round_robin")
@@ -0,0 +1,112 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pytest
+import replication_controller
+from replication_controller import ReplicationController, RunningStatistic, ScenarioProgress
+
+PARAMS = {"num_providers": 2, "initial_num_patients": 10, "patient_incidence": 3, "additive_adoption_preference": 0.5,
+          "ae_probability_additive": 0.3, "ae_probability_subtractive": 0.3}
+
+
+def replication_rows(utility, waiting=10, profit=(100.0, 200.0)):  # run_replication rows of two manufacturers
+    return [{"manufacturer_id": manufacturer_id, "average_utility": utility, "profit": profit[manufacturer_id],
+             "patients_waiting": waiting} for manufacturer_id in (0, 1)]
+
+
+@pytest.mark.parametrize("kwargs", [{"min_replications": 4}, {"min_replications": 20, "max_replications": 10},
+                                    {"outputs": ("utility",)}, {"relative_precision": 0}])
+def test_rejects_bad_settings(kwargs):
+    with pytest.raises(ValueError):
+        ReplicationController({"baseline": PARAMS}, 10, **kwargs)
+
+
+def test_running_statistic_matches_numpy():
+    values = np.random.default_rng(1).normal(3.0, 2.0, 40)
+    statistic = RunningStatistic()
+    for value in [*values[:20], np.nan, *values[20:]]:  # NaN is skipped
+        statistic.add(value)
+    assert statistic.count == 40
+    assert statistic.mean == pytest.approx(values.mean())
+    assert statistic.sum_of_squares / 39 == pytest.approx(values.var(ddof=1))
+    assert statistic.half_width(0.95) == pytest.approx(2.0227 * values.std(ddof=1) / np.sqrt(40), rel=1e-4)
+    single = RunningStatistic()
+    single.add(1.0)
+    assert single.half_width(0.95) == np.inf
+    constant = RunningStatistic()
+    for i in range(3):
+        constant.add(2.0)
+    assert constant.relative_precision(0.95) == 0.0
+
+
+def test_does_not_stop_before_min_replications():
+    controller = ReplicationController({"baseline": PARAMS}, 10, min_replications=6, relative_precision=0.05)
+    scenario = controller.scenarios["baseline"]
+    for i in range(5):  # Identical replications, precise from the second one
+        scenario.add(replication_rows(0.5))
+        assert not controller.check_done(scenario)
+    scenario.add(replication_rows(0.5))
+    assert controller.check_done(scenario)
+
+
+def test_stops_once_every_output_is_precise():
+    controller = ReplicationController({"baseline": PARAMS}, 10, relative_precision=0.05)
+    scenario = controller.scenarios["baseline"]
+    for utility, waiting in ((0.50, 20), (0.51, 21), (0.49, 20), (0.50, 19), (0.50, 20)):
+        scenario.add(replication_rows(utility, waiting))
+    assert controller.check_done(scenario)
+    noisy = ScenarioProgress("noisy", PARAMS, ["average_utility", "profit"])
+    for profit in (10.0, 300.0, 50.0, 200.0, 5.0):  # Precise utility is not enough
+        noisy.add(replication_rows(0.5, profit=(profit, 200.0)))
+    assert not controller.check_done(noisy)
+
+
+def test_stops_at_max_replications():
+    controller = ReplicationController({"baseline": PARAMS}, 10, min_replications=5, max_replications=7,
+                                       relative_precision=0.001)
+    scenario = controller.scenarios["baseline"]
+    for utility in (0.1, 0.9, 0.3, 0.7, 0.2, 0.8):
+        scenario.add(replication_rows(utility))
+        assert not controller.check_done(scenario)
+    scenario.add(replication_rows(0.5))
+    assert controller.check_done(scenario)
+
+
+def test_neediest_scenario_is_the_least_precise_unfinished_one():
+    controller = ReplicationController({"precise": PARAMS, "noisy": PARAMS, "finished": PARAMS}, 10,
+                                       max_replications=10)
+    for name, utilities in (("precise", (0.50, 0.51, 0.49)), ("noisy", (0.1, 0.9, 0.5)), ("finished", (0.1, 0.9))):
+        for utility in utilities:
+            controller.scenarios[name].add(replication_rows(utility))
+            controller.next_job(controller.scenarios[name])
+    controller.scenarios["finished"].done = True
+    assert controller.neediest_scenario() is controller.scenarios["noisy"]
+    controller.scenarios["noisy"].next_replication = 10  # Every replication already started
+    assert controller.neediest_scenario() is controller.scenarios["precise"]
+    controller.scenarios["precise"].done = True
+    assert controller.neediest_scenario() is None
+
+
+def test_common_random_numbers_pair_the_seeds():
+    controller = ReplicationController({"baseline": PARAMS, "changed": {**PARAMS, "patient_incidence": 4}}, 10,
+                                       common_random_numbers=True)
+    baseline, changed = (controller.next_job(scenario) for scenario in controller.scenarios.values())
+    assert baseline["seed"] == changed["seed"] and baseline["replication"] == changed["replication"] == 0
+
+
+def test_run_stops_each_scenario_within_its_bounds(monkeypatch):
+    # Threads instead of worker processes, the replications are the same either way
+    monkeypatch.setattr(replication_controller, "ProcessPoolExecutor", ThreadPoolExecutor)
+    controller = ReplicationController({"baseline": PARAMS, "changed": {**PARAMS, "patient_incidence": 4}}, 30,
+                                       outputs=("patients_waiting",), relative_precision=0.2, max_replications=12,
+                                       engine="cohort", workers=2)
+    summary = controller.run()
+    for scenario in controller.scenarios.values():
+        assert scenario.done
+        assert 5 <= scenario.completed <= 12
+        assert scenario.completed == 12 or scenario.worst_precision(0.95) <= 0.2
+    results = controller.results()
+    assert results.groupby("scenario")["replication"].nunique().to_dict() == {
+        name: scenario.completed for name, scenario in controller.scenarios.items()}
+    assert set(summary["output"]) == {"patients_waiting"}
+    assert summary.set_index("scenario")["replications"].to_dict() == {
+        name: scenario.completed for name, scenario in controller.scenarios.items()}
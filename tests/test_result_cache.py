@@ -0,0 +1,91 @@
+import os
+import subprocess
+import sys
+import pandas as pd
+import pytest
+from data_recorder import DataRecorder
+from implant_market_model import ImplantMarketModel
+from result_cache import MODEL_MODULES, ResultCache, run_arguments
+
+MODEL_PARAMS = {"num_providers": 3, "initial_num_patients": 20, "patient_incidence": 6,
+                "additive_adoption_preference": 0.5, "ae_probability_additive": 0.3,
+                "ae_probability_subtractive": 0.3, "seed": 1, "record_mode": "events"}
+TIME_PERIOD = 10
+
+
+def run_and_store(cache, **overrides):  # Run the model into a staging directory and store it, returns the key
+    model_params = {**MODEL_PARAMS, **overrides}
+    run_params = {**model_params, "time_period": TIME_PERIOD}
+    key = cache.key(run_params)
+    staging_dir = cache.staging_dir()
+    recorder = DataRecorder(cache.recorder_dir(staging_dir))
+    model = ImplantMarketModel(**model_params, recorder=recorder)
+    for i in range(TIME_PERIOD):
+        model.step()
+    recorder.close()
+    cache.store(key, staging_dir, run_params, model.run_metrics.summaries())
+    return key
+
+
+def test_hit_returns_the_stored_run(tmp_path):
+    cache = ResultCache(tmp_path / "cache")
+    run_params = {**MODEL_PARAMS, "time_period": TIME_PERIOD}
+    assert cache.load(cache.key(run_params)) is None
+    key = run_and_store(cache)
+    cached_run = ResultCache(tmp_path / "cache").load(key)  # A new cache object, as in a later session
+    assert cached_run is not None
+    model = ImplantMarketModel(**MODEL_PARAMS)
+    for i in range(TIME_PERIOD):
+        model.step()
+    pd.testing.assert_frame_equal(cached_run.summaries["average_utility"], model.run_metrics.average_utility())
+    assert len(cached_run.recorder.read_frame("manufacturer")) == 2 * TIME_PERIOD
+
+
+def test_key_covers_every_model_argument(tmp_path):
+    cache = ResultCache(tmp_path / "cache")
+    run_params = {**MODEL_PARAMS, "time_period": TIME_PERIOD}
+    # Defaults are part of the key, so passing one explicitly is the same run
+    assert cache.key(run_params) == cache.key({**run_params, "queue_policy": "fifo", "retire_patients": True})
+    keys = {cache.key(run_params),
+            cache.key({**run_params, "queue_policy": "most_severe"}),
+            cache.key({**run_params, "assignment_policy": "least_loaded"}),
+            cache.key({**run_params, "retire_patients": False}),
+            cache.key({**run_params, "time_period": TIME_PERIOD + 1})}
+    assert len(keys) == 5
+    # Logging and recording targets do not change the results
+    assert cache.key(run_params) == cache.key({**run_params, "log_level": "verbose", "recorder": None})
+    assert "queue_policy" in run_arguments(run_params)
+
+
+def test_key_rejects_runs_it_cannot_describe(tmp_path):
+    cache = ResultCache(tmp_path / "cache")
+    with pytest.raises(ValueError):
+        cache.key({**MODEL_PARAMS, "time_period": TIME_PERIOD, "queue_polcy": "fifo"})
+    with pytest.raises(ValueError):
+        cache.key(MODEL_PARAMS)  # No time_period
+    with pytest.raises(ValueError):
+        cache.key({**MODEL_PARAMS, "seed": None, "time_period": TIME_PERIOD})
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = ResultCache(tmp_path / "cache")
+    keys = [run_and_store(cache, seed=seed) for seed in range(3)]
+    for age, key in enumerate(keys):  # Oldest first, in store order
+        os.utime(cache.entry_dir(key), (1_000_000 + age, 1_000_000 + age))
+    entry_size = max(size for _, size, _ in cache.entries())
+    assert cache.load(keys[0]) is not None  # Now the most recently used
+
+    cache.max_bytes = 3 * entry_size + entry_size // 2  # Room for three entries
+    new_key = run_and_store(cache, seed=3)
+    assert cache.load(keys[1]) is None  # The least recently used entry went
+    assert all(cache.load(key) is not None for key in (keys[0], keys[2], new_key))
+
+
+def test_model_modules_are_what_the_model_imports():
+    source_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    imported = subprocess.run([sys.executable, "-c", (
+        "import os, sys, implant_market_model\n"
+        "print('\\n'.join(os.path.basename(module.__file__) for module in list(sys.modules.values())\n"
+        "                 if os.path.dirname(os.path.abspath(getattr(module, '__file__', None) or '/')) == os.getcwd()))")],
+        cwd=source_dir, capture_output=True, text=True, check=True).stdout.split()
+    assert sorted(imported) == sorted(MODEL_MODULES)
@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+import pytest
+from implant_market_model import ImplantMarketModel
+from event_log import read_patient_cross_section
+from summaries import average_utility, current_health_summary, patient_health_summary, run_summaries
+
+PARAMS = (3, 10, 2, 0.5, 0.3, 0.3)
+STEPS = 800  # Long enough for patients to retire into the archive
+
+
+def run_model(engine):
+    model = ImplantMarketModel(*PARAMS, engine=engine, record_mode="events", seed=4)
+    for i in range(STEPS):
+        model.step()
+    return model
+
+
+def without_index_names(frame):  # Compare values, not how each summary happens to label its index
+    return frame.reset_index(drop=True).astype({"manufacturer_id": "int64"})
+
+
+@pytest.mark.parametrize("engine", ["agent", "cohort"])
+def test_online_summaries_match_groupby_of_recorded_tables(engine):
+    model = run_model(engine)
+    online = model.run_metrics.summaries()
+    recorded = run_summaries(model.recorder, STEPS)
+    if engine == "agent":
+        assert len(model.patient_archive) > 0  # Retired patients are counted too
+
+    pd.testing.assert_frame_equal(online["manufacturer_summary"].reset_index(drop=True),
+                                  recorded["manufacturer_summary"].reset_index(drop=True), check_exact=False)
+    for name in ("patient_health_summary", "average_utility"):
+        pd.testing.assert_frame_equal(without_index_names(online[name]), without_index_names(recorded[name]),
+                                      check_dtype=False)
+    pd.testing.assert_frame_equal(without_index_names(online["patient_health_summary"]),
+                                  without_index_names(current_health_summary(model)), check_dtype=False)
+
+
+@pytest.mark.parametrize("engine", ["agent", "cohort"])
+def test_utility_series_matches_each_steps_cross_section(engine):
+    model = run_model(engine)
+    series = model.run_metrics.utility_series()
+    assert len(series) == STEPS * len(model.manufacturers)
+    for step in (1, 100, 400, STEPS):
+        expected = average_utility(patient_health_summary(read_patient_cross_section(model.recorder, step)))
+        expected = expected.set_index("manufacturer_id")["average_utility"]
+        at_step = series[series["step"] == step].set_index("manufacturer_id")["average_utility"]
+        for manufacturer_id, utility in at_step.items():
+            if manufacturer_id in expected.index:
+                assert utility == pytest.approx(expected[manufacturer_id])
+            else:
+                assert np.isnan(utility)  # Nobody had chosen the manufacturer yet
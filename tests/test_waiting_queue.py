@@ -0,0 +1,82 @@
+import pickle
+import pytest
+from implant_market_model import ImplantMarketModel
+from waiting_queue import WaitingQueue
+
+# (name, health status, days waiting) of the queued items, in push order
+PATIENTS = [("a", 2, 1), ("b", 4, 5), ("c", 3, 9), ("d", 4, 2), ("e", 2, 9)]
+HEALTH = {name: health for name, health, _ in PATIENTS}
+STEP = 10
+WAIT_STARTED = {name: STEP - days for name, _, days in PATIENTS}
+
+
+def make_queue(policy):
+    priority = {"fifo": None,
+                "longest_waiting": lambda name: WAIT_STARTED[name],
+                "most_severe": lambda name: -HEALTH[name]}[policy]
+    queue = WaitingQueue(policy, priority)
+    queue.extend(name for name, _, _ in PATIENTS)
+    return queue
+
+
+@pytest.mark.parametrize("policy, order", [
+    ("fifo", ["a", "b", "c", "d", "e"]),
+    ("longest_waiting", ["c", "e", "b", "d", "a"]),  # Ties in push order
+    ("most_severe", ["b", "d", "c", "a", "e"])
+])
+def test_queue_order(policy, order):
+    queue = make_queue(policy)
+    assert queue.pop_many(2) + queue.pop_many(10) == order
+    assert len(queue) == 0
+
+
+@pytest.mark.parametrize("policy, last", [
+    ("fifo", ["d", "e"]),
+    ("longest_waiting", ["d", "a"]),
+    ("most_severe", ["a", "e"])
+])
+def test_pop_last_takes_the_back_of_the_queue(policy, last):
+    queue = make_queue(policy)
+    assert queue.pop_last(2) == last
+    assert len(queue) == 3 and not set(queue) & set(last)
+
+
+@pytest.mark.parametrize("policy", ["fifo", "longest_waiting", "most_severe"])
+def test_pickled_queue_keeps_its_order(policy):
+    queue = make_queue(policy)
+    restored = pickle.loads(pickle.dumps(queue))
+    restored.priority = queue.priority  # Set again by the owner on load
+    queue.push("a")  # Ties with the first "a", pushed later
+    restored.push("a")
+    assert restored.pop_many(10) == queue.pop_many(10)
+
+
+def test_unknown_policy_is_rejected():
+    with pytest.raises(ValueError):
+        WaitingQueue("random")
+
+
+@pytest.mark.parametrize("engine", ["agent", "cohort"])
+@pytest.mark.parametrize("policy", ["fifo", "longest_waiting", "most_severe"])
+def test_model_queue_order(engine, policy):
+    # A single provider leaves a backlog of patients that have waited different numbers of days
+    model = ImplantMarketModel(1, 60, 10, 0.5, 0.3, 0.3, engine=engine, queue_policy=policy, seed=2,
+                               log_level="silent")
+    for i in range(10):
+        model.step()
+    queue = model.patients_needing_surgery
+    if engine == "cohort":
+        cohort = model.cohort
+        order = [(row, int(cohort.step_spawned[row]), int(cohort.health_status[row]),
+                  int(cohort.days_waiting_for_surgery[row])) for row in queue.pop_many(len(queue))]
+    else:
+        order = [(patient.unique_id, patient.step_spawned, int(patient.health_status),
+                  patient.days_waiting_for_surgery) for patient in queue.pop_many(len(queue))]
+    assert len(order) > 20
+    if policy == "fifo":
+        expected = sorted(order, key=lambda item: item[1])
+    elif policy == "longest_waiting":
+        expected = sorted(order, key=lambda item: (-item[3], item[1]))
+    else:
+        expected = sorted(order, key=lambda item: (-item[2], item[1]))  # Equal health in spawn order
+    assert order == expected
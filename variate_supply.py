@@ -0,0 +1,76 @@
+import bisect
+import numpy as np
+
+# Define VariateSupply
+# Hands out the one-at-a-time draws of PatientAgent mode that are not tied to a patient's health (initial health,
+# routing) from blocks drawn in one NumPy call, instead of one random.choices or random.random call per draw with its
+# own setup. A patient's health draws are keyed instead, see RandomStreams, and mapped to outcomes with
+# CategoricalTable.outcome. Each block comes from the NumPy Generator of the draw's RandomStreams substream, so a
+# seeded run is still reproducible and the substreams stay independent of each other.
+# Blocks of block_size draws are made lazily when the previous one runs out. Categorical draws go through a
+# CategoricalTable, the cumulative weights computed once, and each (stream, table) pair keeps its own block of outcomes.
+#
+#   outcomes = model.variates.categorical("spawning", CategoricalTable(states, weights))
+#   health_status = outcomes.draw()
+
+
+EXHAUSTED = object()  # End of a block
+
+
+class CategoricalTable:
+    def __init__(self, outcomes, weights):  # weights need not sum to one, as for random.choices
+        self.outcomes = list(outcomes)
+        weights = np.asarray(list(weights), dtype=float)
+        if len(weights) != len(self.outcomes) or len(weights) == 0 or (weights < 0).any() or weights.sum() <= 0:
+            raise ValueError(f"Cannot draw from outcomes {self.outcomes} with weights {weights.tolist()}")
+        self.cumulative_weights = np.cumsum(weights) / weights.sum()
+        self.cumulative_weights[-1] = 1.0  # Guard against rounding, every uniform below one maps to an outcome
+        self.key = (tuple(self.outcomes), tuple(self.cumulative_weights.tolist()))
+        self.cumulative_list = self.cumulative_weights.tolist()  # For outcome, bisect is faster on a list
+
+    def sample(self, uniforms):  # Outcomes for an array of uniforms in [0, 1)
+        codes = np.searchsorted(self.cumulative_weights, uniforms, side='right')
+        return [self.outcomes[code] for code in codes.tolist()]
+
+    def outcome(self, uniform):  # Outcome for one uniform in [0, 1), the same as sample gives
+        return self.outcomes[bisect.bisect_right(self.cumulative_list, uniform)]
+
+
+class VariateBlock:  # Lazily refilled block of uniforms, or of table outcomes, draw() returns the next one
+    def __init__(self, generator, block_size, table=None):
+        self.generator = generator  # NumPy Generator of the stream
+        self.block_size = block_size
+        self.table = table  # CategoricalTable, None for uniforms
+        self.values = iter(())
+
+    def fill(self):
+        uniforms = self.generator.random(self.block_size)
+        return uniforms.tolist() if self.table is None else self.table.sample(uniforms)
+
+    def draw(self):
+        value = next(self.values, EXHAUSTED)
+        if value is EXHAUSTED:
+            self.values = iter(self.fill())
+            value = next(self.values)
+        return value
+
+
+class VariateSupply:
+    def __init__(self, streams, block_size=4096):
+        if block_size < 1:
+            raise ValueError(f"block_size must be at least one draw, got {block_size}")
+        self.streams = streams  # RandomStreams of the model
+        self.block_size = block_size
+        self.blocks = {}  # (stream, table key or None): VariateBlock
+
+    def uniform(self, stream):  # VariateBlock of uniforms in [0, 1) from the stream's Generator
+        key = (stream, None)
+        if key not in self.blocks:
+            self.blocks[key] = VariateBlock(self.streams.generator[stream], self.block_size)
+        return self.blocks[key]
+
+    def categorical(self, stream, table):  # VariateBlock of table outcomes, shared by every caller with the same table
+        key = (stream, table.key)
+        if key not in self.blocks:
+            self.blocks[key] = VariateBlock(self.streams.generator[stream], self.block_size, table)
+        return self.blocks[key]
@@ -0,0 +1,72 @@
+import collections
+import heapq
+import itertools
+
+# Define WaitingQueue
+# Patients waiting to be assigned to a provider. New patients are pushed when they spawn and assigned patients are
+# popped from the front, so a step only touches the new arrivals and the current backlog instead of scanning every
+# patient ever spawned.
+# Policies:
+#   "fifo"             first spawned, first assigned (the original order)
+#   "longest_waiting"  most days_waiting_for_surgery first
+#   "most_severe"      worst health status first, then first spawned
+# The priority of a waiting patient never changes while it waits (every waiting patient gains one day per step and
+# health only changes after surgery), so it is computed once, when the patient is pushed.
+# The priority function is left out when a queue is pickled (e.g. in a checkpoint), its owner sets it again on load.
+
+QUEUE_POLICIES = ["fifo", "longest_waiting", "most_severe"]
+
+
+class WaitingQueue:
+    def __init__(self, policy="fifo", priority=None):
+        if policy not in QUEUE_POLICIES:
+            raise ValueError(f"Unknown queue policy {policy!r}, expected one of {QUEUE_POLICIES}")
+        self.policy = policy
+        self.priority = priority  # Function of a queued item, lower is assigned first (unused for "fifo")
+        self.items = collections.deque() if policy == "fifo" else []  # deque, or heap of (priority, order, item)
+        self.order = itertools.count()  # Ties are popped in push order
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["priority"] = None
+        state["order"] = next(self.order)  # Skipping a number keeps the order, the counter itself is not pickled
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.order = itertools.count(state["order"])
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):  # Items in no particular order for the priority policies
+        if self.policy == "fifo":
+            return iter(self.items)
+        return (item for _, _, item in self.items)
+
+    def push(self, item):
+        if self.policy == "fifo":
+            self.items.append(item)
+        else:
+            heapq.heappush(self.items, (self.priority(item), next(self.order), item))
+
+    def extend(self, items):
+        for item in items:
+            self.push(item)
+
+    def pop_last(self, count):  # Remove and return the last count items in queue order, e.g. to refer them elsewhere
+        count = min(count, len(self.items))
+        if count == 0:
+            return []
+        if self.policy == "fifo":
+            return [self.items.pop() for _ in range(count)][::-1]
+        self.items.sort()
+        last = self.items[-count:]
+        del self.items[-count:]  # A sorted list is still a heap
+        return [item for _, _, item in last]
+
+    def pop_many(self, count):  # Remove and return the first count items in queue order
+        count = min(count, len(self.items))
+        if self.policy == "fifo":
+            return [self.items.popleft() for _ in range(count)]
+        return [heapq.heappop(self.items)[2] for _ in range(count)]